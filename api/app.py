@@ -1,14 +1,207 @@
 from flask import Flask, request, Response
+from collections import OrderedDict
+from types import MappingProxyType
+from xml.sax.saxutils import escape
+import fcntl
+import hashlib
+import json
 import logging
+import os
+import re
+import socket
+import sys
+import threading
+import time
+
+from gevent import monkey
+
+from prometheus_client import (
+    CONTENT_TYPE_LATEST,
+    REGISTRY,
+    CollectorRegistry,
+    Counter,
+    Histogram,
+    generate_latest,
+    multiprocess,
+)
 
 app = Flask(__name__)
-logging.basicConfig(level=logging.DEBUG)
-logger = logging.getLogger(__name__)
+
+# =============================================================================
+# LOGGING (JSON lines, written off the request path, sampled, runtime levels)
+# =============================================================================
+
+# Records waiting for the writer thread; beyond this they are dropped (and counted)
+LOG_QUEUE_SIZE = int(os.environ.get("LOG_QUEUE_SIZE", "10000"))
+# Per message template: this many records per second get through, then 1 in EVERY
+LOG_SAMPLE_BURST = int(os.environ.get("LOG_SAMPLE_BURST", "20"))
+LOG_SAMPLE_EVERY = int(os.environ.get("LOG_SAMPLE_EVERY", "100"))
+# {"logger name": "LEVEL"}, e.g. {"api.directory": "DEBUG"}; re-read on change
+LOG_LEVELS_FILE = os.environ.get("LOG_LEVELS_FILE", "/etc/fs-ec2/log_levels.json")
+LOG_LEVELS_POLL_INTERVAL = 2
+
+# Unpatched primitives: under gevent workers the writer must be a real thread
+_NativeQueue = monkey.get_original("queue", "SimpleQueue")
+_start_native_thread = monkey.get_original("_thread", "start_new_thread")
+
+# LogRecord attributes that are not user-supplied `extra` fields
+_RECORD_FIELDS = frozenset(vars(logging.LogRecord("", 0, "", 0, "", (), None))) | {
+    "message",
+    "asctime",
+    "sampled",
+}
+
+
+class JsonLogHandler(logging.Handler):
+    """
+    Queues raw records for a native writer thread, which formats them as
+    JSON lines. Request handlers never format or write log output.
+    """
+
+    def __init__(self, stream=None, maxsize=LOG_QUEUE_SIZE):
+        super().__init__()
+        self.stream = stream or sys.stderr
+        self.maxsize = maxsize
+        self.records = _NativeQueue()
+        self.dropped = 0
+        _start_native_thread(self._write_loop, ())
+
+    def emit(self, record):
+        if self.records.qsize() >= self.maxsize:
+            self.dropped += 1
+            return
+        self.records.put(record)
+
+    def to_json(self, record):
+        entry = {
+            "ts": round(record.created, 6),
+            "level": record.levelname,
+            "logger": record.name,
+            "pid": record.process,
+            "msg": record.getMessage(),
+        }
+        sampled = getattr(record, "sampled", 0)
+        if sampled:
+            entry["sampled_out"] = sampled
+        for key, value in vars(record).items():
+            if key not in _RECORD_FIELDS:
+                entry[key] = value
+        if record.exc_info:
+            entry["exc"] = logging.Formatter().formatException(record.exc_info)
+        return json.dumps(entry, default=str, ensure_ascii=False)
+
+    def _write_loop(self):
+        while True:
+            record = self.records.get()
+            try:
+                if self.dropped:
+                    dropped, self.dropped = self.dropped, 0
+                    self.stream.write(
+                        json.dumps(
+                            {
+                                "ts": round(record.created, 6),
+                                "level": "WARNING",
+                                "logger": "logging",
+                                "msg": f"log queue full, dropped {dropped} records",
+                            }
+                        )
+                        + "\n"
+                    )
+                self.stream.write(self.to_json(record) + "\n")
+                if self.records.empty():
+                    self.stream.flush()
+            except Exception:
+                # Bad format arguments or a broken stream: report it the
+                # standard way (traceback on stderr) and keep the thread alive
+                self.handleError(record)
+
+
+class LogSampler(logging.Filter):
+    """
+    Per message template, lets `burst` records a second through and then
+    one in `every`. ERROR and above always pass.
+    """
+
+    MAX_TEMPLATES = 5000
+
+    def __init__(self, burst=LOG_SAMPLE_BURST, every=LOG_SAMPLE_EVERY):
+        super().__init__()
+        self.burst = burst
+        self.every = every
+        # {template: [second, count in that second, skipped since last pass]}
+        self.windows = {}
+
+    def filter(self, record):
+        if record.levelno >= logging.ERROR:
+            return True
+        second = int(record.created)
+        window = self.windows.get(record.msg)
+        if window is None:
+            if len(self.windows) >= self.MAX_TEMPLATES:
+                self.windows.clear()
+            window = self.windows[record.msg] = [second, 0, 0]
+        elif window[0] != second:
+            window[0] = second
+            window[1] = 0
+        window[1] += 1
+        if window[1] <= self.burst or window[1] % self.every == 0:
+            if window[2]:
+                record.sampled = window[2]
+                window[2] = 0
+            return True
+        window[2] += 1
+        return False
+
+
+def apply_log_levels(levels):
+    """Set levels from {"logger name": "LEVEL"}; "" or "root" is the root logger"""
+    for name, level in levels.items():
+        target = logging.getLogger(None if name in ("", "root") else name)
+        target.setLevel(str(level).upper())
+
+
+def watch_log_levels(path=LOG_LEVELS_FILE):
+    """Re-apply LOG_LEVELS_FILE whenever it changes (each worker runs one)"""
+    seen = None
+    while True:
+        try:
+            st = os.stat(path)
+            stamp = (st.st_mtime_ns, st.st_size, st.st_ino)
+        except OSError:
+            stamp = None
+        if stamp != seen and stamp is not None:
+            try:
+                with open(path) as f:
+                    apply_log_levels(json.load(f))
+                logger.info("Log levels applied from %s", path)
+            except (OSError, ValueError) as e:
+                logger.error("Bad log levels file %s: %s", path, e)
+        seen = stamp
+        time.sleep(LOG_LEVELS_POLL_INTERVAL)
+
+
+def configure_logging(level=os.environ.get("LOG_LEVEL", "INFO")):
+    handler = JsonLogHandler()
+    handler.addFilter(LogSampler())
+    root = logging.getLogger()
+    root.handlers[:] = [handler]
+    root.setLevel(level.upper())
+    return handler
+
+
+configure_logging()
+# One logger per subsystem so levels can be changed independently
+logger = logging.getLogger("api")
+directory_logger = logging.getLogger("api.directory")
+config_logger = logging.getLogger("api.config")
+dialplan_logger = logging.getLogger("api.dialplan")
+threading.Thread(target=watch_log_levels, name="log-levels", daemon=True).start()
 
 # =============================================================================
 # DATA
 # =============================================================================
 
+# Built-in tenants, used only when TENANTS_FILE does not exist
 STORES = {
     "store1.local": {
         "name": "Store 1",
@@ -86,6 +279,296 @@ GATEWAYS = {
     # Add more gateways dynamically here
 }
 
+# Shared tenant configuration (same file as the ESL router, see config/tenants.json)
+TENANTS_FILE = os.environ.get("TENANTS_FILE", "/etc/fs-ec2/tenants.json")
+TENANTS_POLL_INTERVAL = 0.5
+
+# FreeSWITCH ESL, for pushing cache flushes. This is the only node unless
+# the tenant file lists "freeswitch_nodes" (same entries as the router).
+FREESWITCH_HOST = os.environ.get("FREESWITCH_HOST", "127.0.0.1")
+FREESWITCH_ESL_PORT = int(os.environ.get("FREESWITCH_ESL_PORT", "8021"))
+FREESWITCH_ESL_PASSWORD = os.environ.get("FREESWITCH_ESL_PASSWORD", "ClueCon")
+
+
+# =============================================================================
+# METRICS (Prometheus, served on /metrics)
+# =============================================================================
+
+# Under gunicorn every worker writes its samples to PROMETHEUS_MULTIPROC_DIR
+# (see gunicorn.conf.py) and /metrics merges them
+XML_CURL_SECONDS = Histogram(
+    "api_xml_curl_seconds",
+    "mod_xml_curl request handling time",
+    ["section"],
+    buckets=(0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.5, 1, 5),
+)
+XML_CURL_RESULTS = Counter(
+    "api_xml_curl_results",
+    "mod_xml_curl requests by section and outcome",
+    ["section", "result"],
+)
+XML_CURL_SECTIONS = ("directory", "configuration", "dialplan", "other")
+# Labelled children resolved once; .labels() costs more than observe()
+_xml_curl_timers = {section: XML_CURL_SECONDS.labels(section) for section in XML_CURL_SECTIONS}
+_xml_curl_results = {}
+
+
+def record_xml_curl(section, result, seconds):
+    if section not in _xml_curl_timers:
+        section = "other"
+    _xml_curl_timers[section].observe(seconds)
+    counter = _xml_curl_results.get((section, result))
+    if counter is None:
+        counter = _xml_curl_results[(section, result)] = XML_CURL_RESULTS.labels(section, result)
+    counter.inc()
+
+
+def metrics_registry():
+    if "PROMETHEUS_MULTIPROC_DIR" in os.environ:
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+        return registry
+    return REGISTRY
+
+
+# =============================================================================
+# TENANT CONFIGURATION (hot-reloaded, copy-on-write snapshots)
+# =============================================================================
+
+
+def _freeze(value):
+    """Recursively turn dicts into read-only mappings and lists into tuples"""
+    if isinstance(value, dict):
+        return MappingProxyType({k: _freeze(v) for k, v in value.items()})
+    if isinstance(value, list):
+        return tuple(_freeze(v) for v in value)
+    return value
+
+
+def _share(previous, current):
+    """Reuse `previous` (or its unchanged values) where `current` is equal"""
+    if previous == current:
+        return previous
+    return MappingProxyType(
+        {
+            key: previous[key] if previous.get(key) == value else value
+            for key, value in current.items()
+        }
+    )
+
+
+class TenantSnapshot:
+    """
+    Immutable stores and gateways. A request takes one snapshot and uses
+    it throughout, so a reload never changes data halfway through.
+    """
+
+    def __init__(self, stores, gateways, version=0, previous=None, nodes=None):
+        for domain, store in stores.items():
+            for key in ("context", "caller_id", "users"):
+                if key not in store:
+                    raise ValueError(f"store {domain}: missing '{key}'")
+        self.stores = _freeze(stores)
+        self.gateways = _freeze(gateways)
+        # {node name: {"host": ..., "esl_port": ...}}; empty = FREESWITCH_HOST
+        self.nodes = _freeze(nodes or {})
+        self.version = version
+        # {dialplan context: domain}
+        self.contexts = {store["context"]: domain for domain, store in self.stores.items()}
+
+        # Share unchanged stores and gateways with the previous snapshot, so
+        # caches keyed on object identity stay valid for whatever did not change
+        if previous is not None:
+            self.stores = _share(previous.stores, self.stores)
+            self.gateways = _share(previous.gateways, self.gateways)
+
+
+class TenantConfig:
+    """
+    Watches TENANTS_FILE from a daemon thread and swaps in a new
+    TenantSnapshot when it changes. Readers just take `current`; there
+    is no lock on the lookup path. A file that fails to parse is logged
+    and ignored, keeping the previous snapshot.
+    """
+
+    def __init__(self, path, default_stores, default_gateways, poll_interval=TENANTS_POLL_INTERVAL):
+        self.path = path
+        self.poll_interval = poll_interval
+        self._stat = None
+        self._listeners = []
+        self._thread = None
+        self.current = self._load() or TenantSnapshot(default_stores, default_gateways)
+
+    def on_change(self, callback):
+        """Call `callback(previous, snapshot)` after every successful reload"""
+        self._listeners.append(callback)
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._watch, name="tenant-watch", daemon=True)
+            self._thread.start()
+
+    def _file_stat(self):
+        try:
+            st = os.stat(self.path)
+        except FileNotFoundError:
+            return None
+        return (st.st_ino, st.st_size, st.st_mtime_ns)
+
+    def _load(self):
+        stat = self._file_stat()
+        if stat is None:
+            return None
+        self._stat = stat
+        try:
+            with open(self.path) as f:
+                data = json.load(f)
+            snapshot = TenantSnapshot(
+                data.get("stores", {}),
+                data.get("gateways", {}),
+                version=stat[2],
+                previous=getattr(self, "current", None),
+                nodes=data.get("freeswitch_nodes", {}),
+            )
+        except (OSError, ValueError, TypeError, AttributeError) as e:
+            logger.error("Ignoring invalid tenant file %s: %s", self.path, e)
+            return None
+        logger.info("Loaded %d stores from %s", len(snapshot.stores), self.path)
+        return snapshot
+
+    def reload(self):
+        """Reload the file now; returns True if a new snapshot was installed"""
+        snapshot = self._load()
+        if snapshot is None:
+            return False
+        previous, self.current = self.current, snapshot
+        for callback in self._listeners:
+            try:
+                callback(previous, snapshot)
+            except Exception:
+                logger.exception("Tenant change listener failed")
+        return True
+
+    def _watch(self):
+        while True:
+            time.sleep(self.poll_interval)
+            stat = self._file_stat()
+            if stat is not None and stat != self._stat:
+                self.reload()
+
+
+# Global tenant configuration; each gunicorn worker runs its own watcher
+tenants = TenantConfig(TENANTS_FILE, STORES, GATEWAYS)
+tenants.start()
+
+
+# =============================================================================
+# RESPONSE CACHE (pre-rendered directory documents)
+# =============================================================================
+
+DIRECTORY_CACHE_SIZE = 20000
+DIRECTORY_CACHE_TTL = 300
+# How long FreeSWITCH may keep a user from our answer (the `cacheable`
+# attribute, ms). Changes are pushed with xml_flush_cache, so this only
+# bounds staleness if a push is lost.
+DIRECTORY_CACHEABLE_MS = int(os.environ.get("DIRECTORY_CACHEABLE_MS", "900000"))
+
+
+class CachedResponse:
+    """Encoded XML document plus the tenant data it was rendered from"""
+
+    __slots__ = ("body", "etag", "source", "expires_at")
+
+    def __init__(self, body, source, expires_at):
+        self.body = body
+        self.etag = hashlib.blake2b(body, digest_size=12).hexdigest()
+        self.source = source
+        self.expires_at = expires_at
+
+
+class ResponseCache:
+    """
+    LRU cache of encoded responses with a TTL.
+
+    An entry only counts as a hit if it was rendered from the very store
+    object the current snapshot holds. Snapshots share unchanged stores,
+    so a reload only misses for tenants whose data actually changed.
+    """
+
+    def __init__(self, max_entries, ttl):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        # {key: CachedResponse}, least recently used first
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.stats = {"hits": 0, "misses": 0, "evictions": 0, "invalidations": 0}
+
+    def get(self, key, source):
+        with self._lock:
+            entry = self._entries.get(key)
+            if (
+                entry is None
+                or entry.source is not source
+                or entry.expires_at < time.monotonic()
+            ):
+                self.stats["misses"] += 1
+                return None
+            self._entries.move_to_end(key)
+            self.stats["hits"] += 1
+            return entry
+
+    def put(self, key, body, source):
+        entry = CachedResponse(body, source, time.monotonic() + self.ttl)
+        with self._lock:
+            self._entries[key] = entry
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.stats["evictions"] += 1
+        return entry
+
+    def invalidate(self, domain=None):
+        """Drop every entry, or only those whose key starts with `domain`"""
+        with self._lock:
+            if domain is None:
+                dropped = len(self._entries)
+                self._entries.clear()
+            else:
+                keys = [key for key in self._entries if key[0] == domain]
+                for key in keys:
+                    del self._entries[key]
+                dropped = len(keys)
+            self.stats["invalidations"] += dropped
+
+    def snapshot(self):
+        with self._lock:
+            return dict(self.stats, entries=len(self._entries))
+
+
+directory_cache = ResponseCache(DIRECTORY_CACHE_SIZE, DIRECTORY_CACHE_TTL)
+
+
+def _invalidate_changed_stores(previous, snapshot):
+    """Free cached directory and dialplan entries for tenants that changed or went away"""
+    for domain in set(previous.stores) | set(snapshot.stores):
+        if previous.stores.get(domain) is not snapshot.stores.get(domain):
+            directory_cache.invalidate(domain)
+            dialplan_cache.invalidate(domain)
+
+
+tenants.on_change(_invalidate_changed_stores)
+
+
+def xml_response(body, entry=None, max_age=None):
+    """text/xml response, with validators when it came from a cache entry"""
+    response = Response(body, mimetype="text/xml")
+    if entry is not None:
+        response.set_etag(entry.etag)
+        response.cache_control.private = True
+        if max_age is not None:
+            response.cache_control.max_age = max_age
+    return response
+
 
 def not_found_xml():
     return """<?xml version="1.0" encoding="UTF-8"?>
@@ -96,15 +579,12 @@ def not_found_xml():
 </document>"""
 
 
-def generate_sofia_conf_xml():
-    """Generate COMPLETE sofia.conf.xml with both profiles and dynamic gateways"""
-    local_ip = "0.0.0.0"
-    all_presence_hosts = ",".join(STORES.keys())
+NOT_FOUND_XML = not_found_xml().encode()
+
 
-    # Build gateway XML
-    gateway_xml = ""
-    for gw_name, gw_data in GATEWAYS.items():
-        gateway_xml += f"""
+def generate_gateway_xml(gw_name, gw_data):
+    """Render one <gateway> block of the external profile"""
+    return f"""
           <gateway name="{gw_name}">
             <param name="username" value="{gw_data['username']}"/>
             <param name="password" value="{gw_data['password']}"/>
@@ -119,6 +599,20 @@ def generate_sofia_conf_xml():
             <param name="ping-min" value="{gw_data.get('ping_min', '1')}"/>
           </gateway>"""
 
+
+def generate_sofia_conf_xml(snapshot, gateway_fragments=None):
+    """Generate COMPLETE sofia.conf.xml with both profiles and dynamic gateways"""
+    local_ip = "0.0.0.0"
+    all_presence_hosts = ",".join(snapshot.stores.keys())
+
+    # Build gateway XML (one join, fragments may come pre-rendered)
+    if gateway_fragments is None:
+        gateway_fragments = [
+            generate_gateway_xml(gw_name, gw_data)
+            for gw_name, gw_data in snapshot.gateways.items()
+        ]
+    gateway_xml = "".join(gateway_fragments)
+
     return f"""<?xml version="1.0" encoding="UTF-8"?>
 <document type="freeswitch/xml">
   <section name="configuration">
@@ -212,36 +706,414 @@ def generate_sofia_conf_xml():
 </document>"""
 
 
-def generate_user_xml(domain, user_id, user_data, store_data):
+# =============================================================================
+# SOFIA CONFIGURATION CACHE
+# =============================================================================
+
+
+class SofiaConfCache:
+    """
+    sofia.conf kept as an encoded, versioned blob.
+
+    Each gateway block is rendered once and reused until that gateway's
+    data changes; the document is only reassembled when a gateway or the
+    store list (presence-hosts) changes. Requests in between just send
+    the blob.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        # {gateway name: (gateway data, rendered fragment)}
+        self._fragments = {}
+        self._gateways = None
+        self._stores = None
+        self._hosts = None
+        self.entry = None
+        self.version = 0
+        self.stats = {"hits": 0, "builds": 0, "fragments_rendered": 0}
+
+    def get(self, snapshot):
+        entry = self.entry
+        if (
+            entry is not None
+            and snapshot.gateways is self._gateways
+            and snapshot.stores is self._stores
+        ):
+            self.stats["hits"] += 1
+            return entry
+
+        with self._lock:
+            hosts = tuple(snapshot.stores)
+            if self.entry is None or snapshot.gateways is not self._gateways or hosts != self._hosts:
+                self._build(snapshot)
+            else:
+                self.stats["hits"] += 1
+            self._gateways = snapshot.gateways
+            self._stores = snapshot.stores
+            self._hosts = hosts
+            return self.entry
+
+    def _build(self, snapshot):
+        fragments = {}
+        for gw_name, gw_data in snapshot.gateways.items():
+            cached = self._fragments.get(gw_name)
+            if cached is None or not (cached[0] is gw_data or cached[0] == gw_data):
+                cached = (gw_data, generate_gateway_xml(gw_name, gw_data))
+                self.stats["fragments_rendered"] += 1
+            fragments[gw_name] = cached
+        # Gateways that were removed drop out here
+        self._fragments = fragments
+
+        xml = generate_sofia_conf_xml(
+            snapshot, [fragment for _, fragment in fragments.values()]
+        )
+        self.version += 1
+        self.entry = CachedResponse(xml.encode(), snapshot.gateways, float("inf"))
+        self.stats["builds"] += 1
+        config_logger.info(
+            "Rendered sofia.conf v%s (%s gateways, %s bytes)",
+            self.version,
+            len(fragments),
+            len(self.entry.body),
+        )
+
+
+sofia_conf_cache = SofiaConfCache()
+
+
+def _attr(value):
+    """Escape a value for a double-quoted XML attribute"""
+    return escape(str(value), {'"': "&quot;"})
+
+
+def generate_user_element(domain, user_id, user_data, store_data):
+    """
+    One <user>; `cacheable` lets FreeSWITCH keep it (ms) instead of asking
+    again. Tenant values are escaped: one stray & or " would otherwise
+    break the whole domain document and every registration in it.
+    """
+    domain, user_id = _attr(domain), _attr(user_id)
+    return f"""
+        <user id="{user_id}" cacheable="{DIRECTORY_CACHEABLE_MS}">
+          <params>
+            <param name="password" value="{_attr(user_data['password'])}"/>
+            <param name="vm-password" value="{_attr(user_data['vm_password'])}"/>
+          </params>
+          <variables>
+            <variable name="toll_allow" value="{_attr(user_data['toll_allow'])}"/>
+            <variable name="accountcode" value="{domain}-{user_id}"/>
+            <variable name="user_context" value="{_attr(store_data['context'])}"/>
+            <variable name="effective_caller_id_name" value="{_attr(user_data['name'])}"/>
+            <variable name="effective_caller_id_number" value="{user_id}"/>
+            <variable name="outbound_caller_id_number" value="{_attr(store_data['caller_id'])}"/>
+          </variables>
+        </user>"""
+
+
+def generate_domain_xml(domain, store_data, user_elements):
+    """Directory document for a whole domain"""
     return f"""<?xml version="1.0" encoding="UTF-8"?>
 <document type="freeswitch/xml">
   <section name="directory">
-    <domain name="{domain}">
+    <domain name="{_attr(domain)}">
       <params>
         <param name="dial-string" value="{{^^:sip_invite_domain=${{dialed_domain}}:presence_id=${{dialed_user}}@${{dialed_domain}}}}${{sofia_contact(*/${{dialed_user}}@${{dialed_domain}})}}"/>
       </params>
-      <user id="{user_id}">
-        <params>
-          <param name="password" value="{user_data['password']}"/>
-          <param name="vm-password" value="{user_data['vm_password']}"/>
-        </params>
-        <variables>
-          <variable name="toll_allow" value="{user_data['toll_allow']}"/>
-          <variable name="accountcode" value="{domain}-{user_id}"/>
-          <variable name="user_context" value="{store_data['context']}"/>
-          <variable name="effective_caller_id_name" value="{user_data['name']}"/>
-          <variable name="effective_caller_id_number" value="{user_id}"/>
-          <variable name="outbound_caller_id_number" value="{store_data['caller_id']}"/>
-        </variables>
-      </user>
+      <users>{"".join(user_elements)}
+      </users>
     </domain>
   </section>
 </document>"""
 
 
+# =============================================================================
+# DIALPLAN (per-store contexts built from tenant data)
+# =============================================================================
+
+DIALPLAN_CACHE_SIZE = 20000
+# Entries stay valid until their store changes (see ResponseCache.get)
+DIALPLAN_CACHE_TTL = float("inf")
+# Where store contexts send calls: extensions via Kamailio, the store's own
+# DID to the ESL router (same hand-off as inbound trunk calls in public.xml)
+KAMAILIO_SIP_ADDRESS = os.environ.get("KAMAILIO_SIP_ADDRESS", "127.0.0.1:5060")
+ROUTER_SOCKET = os.environ.get("ROUTER_SOCKET", "127.0.0.1:5002")
+
+
+def _alternatives(values):
+    """PCRE alternation matching exactly `values`, escaped for an attribute"""
+    return _attr("|".join(re.escape(value) for value in sorted(values)))
+
+
+def generate_dialplan_xml(domain, store_data):
+    """Dialplan context for one store: extensions, park slots, its DID and outbound"""
+    extensions = []
+    # Tenant values end up in attributes; one stray & or " would make
+    # FreeSWITCH reject the whole context
+    xml_domain = _attr(domain)
+
+    users = store_data["users"]
+    if users:
+        extensions.append(f"""
+      <!-- Internal extension dialing - route through Kamailio -->
+      <extension name="local_extension">
+        <condition field="destination_number" expression="^({_alternatives(users)})$">
+          <action application="set" data="sip_invite_domain={xml_domain}"/>
+          <action application="bridge" data="sofia/internal/$1@{KAMAILIO_SIP_ADDRESS}"/>
+        </condition>
+      </extension>""")
+
+    park_slots = store_data.get("park_slots", ())
+    if park_slots:
+        extensions.append(f"""
+      <!-- Park slots using valet_park with BLF -->
+      <extension name="park_slot">
+        <condition field="destination_number" expression="^({_alternatives(park_slots)})$">
+          <action application="answer"/>
+          <action application="set" data="presence_id=$1@{xml_domain}"/>
+          <action application="valet_park" data="{xml_domain} $1"/>
+        </condition>
+      </extension>""")
+
+    did = re.sub(r"\D", "", store_data.get("did", ""))[-10:]
+    if did:
+        extensions.append(f"""
+      <!-- The store's own number rings the store without leaving the switch -->
+      <extension name="own_did">
+        <condition field="destination_number" expression="^\\+?1?{did}$">
+          <action application="set" data="domain_name={xml_domain}"/>
+          <action application="set" data="sip_invite_domain={xml_domain}"/>
+          <action application="set" data="sip_h_X-Store-Domain={xml_domain}"/>
+        </condition>
+        <condition field="${{router_call_mode}}" expression="^async$">
+          <action application="set" data="router_control=async"/>
+          <action application="park"/>
+          <anti-action application="socket" data="{ROUTER_SOCKET} async full"/>
+        </condition>
+      </extension>""")
+
+    gateway = store_data.get("gateway")
+    if gateway:
+        extensions.append(f"""
+      <!-- Outbound calls via the store's trunk -->
+      <extension name="outbound">
+        <condition field="destination_number" expression="^(\\+?1?\\d{{10}})$">
+          <action application="set" data="effective_caller_id_number={_attr(store_data['caller_id'])}"/>
+          <action application="bridge" data="sofia/gateway/{_attr(gateway)}/+1$1"/>
+        </condition>
+      </extension>""")
+
+    return f"""<?xml version="1.0" encoding="UTF-8"?>
+<document type="freeswitch/xml">
+  <section name="dialplan" description="{xml_domain}">
+    <context name="{_attr(store_data['context'])}">{"".join(extensions)}
+    </context>
+  </section>
+</document>"""
+
+
+dialplan_cache = ResponseCache(DIALPLAN_CACHE_SIZE, DIALPLAN_CACHE_TTL)
+
+
+# =============================================================================
+# FREESWITCH CACHE INVALIDATION (xml_flush_cache pushed over ESL)
+# =============================================================================
+
+# Changes are sent once the tenant file has been quiet this long, but never
+# later than XML_FLUSH_MAX_DELAY after the first one
+XML_FLUSH_DEBOUNCE = 1.0
+XML_FLUSH_MAX_DELAY = 5.0
+# More users than this changed at once: clear FreeSWITCH's whole user cache
+XML_FLUSH_MAX_TARGETED = 200
+ESL_TIMEOUT = 3.0
+# Every gunicorn worker sees the same changes; whoever holds this lock sends them
+XML_FLUSH_LOCK = os.environ.get("XML_FLUSH_LOCK", "/tmp/api-xml-flush.lock")
+
+# Store fields rendered into every user of the domain
+DIRECTORY_STORE_FIELDS = ("context", "caller_id")
+
+
+def changed_directory_users(previous, snapshot):
+    """{(user, domain)} FreeSWITCH may hold a stale copy of after a reload"""
+    changed = set()
+    for domain, old in previous.stores.items():
+        new = snapshot.stores.get(domain)
+        if new is old:
+            continue
+        if new is None or any(old.get(f) != new.get(f) for f in DIRECTORY_STORE_FIELDS):
+            changed.update((user, domain) for user in old["users"])
+            continue
+        # Users that were added were never cached (not found is not cached)
+        changed.update(
+            (user, domain)
+            for user, data in old["users"].items()
+            if new["users"].get(user) != data
+        )
+    return changed
+
+
+def _esl_read(reader):
+    """(headers, body) of the next ESL message"""
+    headers = {}
+    while True:
+        line = reader.readline()
+        if not line:
+            raise ConnectionError("ESL connection closed")
+        line = line.decode().rstrip("\n")
+        if line:
+            name, _, value = line.partition(": ")
+            headers[name] = value
+        elif headers:
+            break
+    length = int(headers.get("Content-Length", 0))
+    return headers, reader.read(length).decode() if length else ""
+
+
+def esl_api(host, port, password, commands, timeout=ESL_TIMEOUT):
+    """Run `api` commands over a short-lived inbound ESL connection; returns the replies"""
+    with socket.create_connection((host, port), timeout=timeout) as sock:
+        reader = sock.makefile("rb")
+        _esl_read(reader)
+        sock.sendall(f"auth {password}\n\n".encode())
+        headers, _ = _esl_read(reader)
+        if not headers.get("Reply-Text", "").startswith("+OK"):
+            raise ConnectionError(f"ESL auth failed: {headers.get('Reply-Text')}")
+        # Pipelined; FreeSWITCH answers in order
+        sock.sendall("".join(f"api {command}\n\n" for command in commands).encode())
+        replies = [_esl_read(reader)[1].strip() for _ in commands]
+        sock.sendall(b"exit\n\n")
+    return replies
+
+
+class CacheInvalidator:
+    """
+    Tells FreeSWITCH to drop cached directory users whose data changed.
+
+    Reloads are collected, debounced and coalesced: a burst of edits to
+    the tenant file becomes one ESL connection per node carrying one
+    `xml_flush_cache id <user> <domain>` per changed user, or a single
+    full `xml_flush_cache` when too many changed.
+    """
+
+    def __init__(
+        self,
+        debounce=XML_FLUSH_DEBOUNCE,
+        max_delay=XML_FLUSH_MAX_DELAY,
+        max_targeted=XML_FLUSH_MAX_TARGETED,
+        lock_path=XML_FLUSH_LOCK,
+    ):
+        self.debounce = debounce
+        self.max_delay = max_delay
+        self.max_targeted = max_targeted
+        self.lock_path = lock_path
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._users = set()
+        self._first = self._last = 0.0
+        self._leader = None
+        self._thread = None
+        self.stats = {"changes": 0, "pushes": 0, "commands": 0, "full_flushes": 0, "errors": 0}
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name="xml-flush", daemon=True)
+            self._thread.start()
+
+    def on_change(self, previous, snapshot):
+        users = changed_directory_users(previous, snapshot)
+        if not users:
+            return
+        now = time.monotonic()
+        with self._lock:
+            if not self._users:
+                self._first = now
+            self._users |= users
+            self._last = now
+            self.stats["changes"] += 1
+        self._wake.set()
+
+    def _is_leader(self):
+        if self._leader is None:
+            handle = open(self.lock_path, "a")
+            try:
+                fcntl.flock(handle, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                handle.close()
+                return False
+            # Held until the process exits
+            self._leader = handle
+        return True
+
+    def _run(self):
+        while True:
+            self._wake.wait()
+            while True:
+                with self._lock:
+                    due = min(self._last + self.debounce, self._first + self.max_delay)
+                remaining = due - time.monotonic()
+                if remaining <= 0:
+                    break
+                time.sleep(remaining)
+            with self._lock:
+                users, self._users = self._users, set()
+                self._wake.clear()
+            try:
+                self.push(users, tenants.current)
+            except Exception:
+                logger.exception("FreeSWITCH cache flush failed")
+
+    def push(self, users, snapshot):
+        if not users or not self._is_leader():
+            return
+        if len(users) > self.max_targeted:
+            commands = ["xml_flush_cache"]
+            self.stats["full_flushes"] += 1
+        else:
+            commands = [f"xml_flush_cache id {user} {domain}" for user, domain in sorted(users)]
+
+        nodes = snapshot.nodes or {"freeswitch": {"host": FREESWITCH_HOST}}
+        for name, node in nodes.items():
+            try:
+                replies = esl_api(
+                    node["host"],
+                    int(node.get("esl_port", FREESWITCH_ESL_PORT)),
+                    node.get("password", FREESWITCH_ESL_PASSWORD),
+                    commands,
+                )
+            except (OSError, ValueError) as e:
+                self.stats["errors"] += 1
+                logger.warning("Could not flush the directory cache on %s: %s", name, e)
+                continue
+            self.stats["pushes"] += 1
+            self.stats["commands"] += len(commands)
+            logger.info(
+                "🧹 Flushed %d changed user(s) from %s's directory cache (%d command(s), %d ok)",
+                len(users),
+                name,
+                len(commands),
+                sum(r.startswith("+OK") for r in replies),
+            )
+
+    def snapshot(self):
+        with self._lock:
+            return dict(self.stats, pending=len(self._users), leader=self._leader is not None)
+
+
+cache_invalidator = CacheInvalidator()
+tenants.on_change(cache_invalidator.on_change)
+cache_invalidator.start()
+
+
 @app.route("/freeswitch", methods=["POST"])
 def freeswitch_handler():
+    start = time.perf_counter()
     section = request.form.get("section", "")
+    response, result = xml_curl_lookup(section, tenants.current)
+    record_xml_curl(section, result, time.perf_counter() - start)
+    return response
+
+
+def xml_curl_lookup(section, snapshot):
+    """Answer one mod_xml_curl request; returns (response, result)"""
 
     # DIRECTORY
     if section == "directory":
@@ -250,43 +1122,85 @@ def freeswitch_handler():
         user = request.form.get("user", "")
         purpose = request.form.get("purpose", "")
 
-        logger.info(f"Directory: {user}@{lookup_domain} (purpose={purpose})")
-
-        if lookup_domain not in STORES:
-            return Response(not_found_xml(), mimetype="text/xml")
+        # Hot path: lazy formatting, only rendered when DEBUG is enabled
+        directory_logger.debug("Directory: %s@%s (purpose=%s)", user, lookup_domain, purpose)
 
-        store_data = STORES[lookup_domain]
+        store_data = snapshot.stores.get(lookup_domain)
+        if store_data is None:
+            return xml_response(NOT_FOUND_XML), "not_found"
+        # User-less lookups (purpose=gateways/network-list) have no use for
+        # credentials; the static directory answers them
+        if not user or user not in store_data["users"]:
+            return xml_response(NOT_FOUND_XML), "not_found"
 
-        # User lookup
-        if user not in store_data["users"]:
-            return Response(not_found_xml(), mimetype="text/xml")
+        # One document per domain answers every user lookup in it
+        key = (lookup_domain, response_domain)
+        entry = directory_cache.get(key, store_data)
+        result = "hit"
+        if entry is None:
+            domain = response_domain or lookup_domain
+            xml = generate_domain_xml(
+                domain,
+                store_data,
+                [
+                    generate_user_element(domain, user_id, user_data, store_data)
+                    for user_id, user_data in store_data["users"].items()
+                ],
+            )
+            entry = directory_cache.put(key, xml.encode(), store_data)
+            result = "miss"
 
-        xml = generate_user_xml(
-            response_domain or lookup_domain,
-            user,
-            store_data["users"][user],
-            store_data,
-        )
-        return Response(xml, mimetype="text/xml")
+        return xml_response(entry.body, entry, directory_cache.ttl), result
 
     # CONFIGURATION (sofia.conf for gateways)
     elif section == "configuration":
         key_value = request.form.get("key_value", "")
-        logger.info(f"Configuration request: {key_value}")
+        config_logger.debug("Configuration request: %s", key_value)
 
         if key_value == "sofia.conf":
-            xml = generate_sofia_conf_xml()
-            return Response(xml, mimetype="text/xml")
+            entry = sofia_conf_cache.get(snapshot)
+            response = xml_response(entry.body, entry)
+            response.headers["X-Config-Version"] = str(sofia_conf_cache.version)
+            return response, "hit"
 
         # Return not found for other configs (use static files)
-        return Response(not_found_xml(), mimetype="text/xml")
+        return xml_response(NOT_FOUND_XML), "not_found"
+
+    # DIALPLAN (store contexts; public, default etc. stay in static files)
+    elif section == "dialplan":
+        context = request.form.get("Hunt-Context") or request.form.get("Caller-Context", "")
+        domain = snapshot.contexts.get(context)
+        if domain is None:
+            return xml_response(NOT_FOUND_XML), "not_found"
+
+        store_data = snapshot.stores[domain]
+        key = (domain, context)
+        entry = dialplan_cache.get(key, store_data)
+        result = "hit"
+        if entry is None:
+            dialplan_logger.debug("Dialplan: building context %s for %s", context, domain)
+            xml = generate_dialplan_xml(domain, store_data)
+            entry = dialplan_cache.put(key, xml.encode(), store_data)
+            result = "miss"
+        return xml_response(entry.body, entry), result
 
-    return Response(not_found_xml(), mimetype="text/xml")
+    return xml_response(NOT_FOUND_XML), "not_found"
 
 
 @app.route("/health")
 def health():
-    return {"status": "ok"}
+    return {
+        "status": "ok",
+        "directory_cache": directory_cache.snapshot(),
+        "dialplan_cache": dialplan_cache.snapshot(),
+        "sofia_conf": dict(sofia_conf_cache.stats, version=sofia_conf_cache.version),
+        "cache_invalidation": cache_invalidator.snapshot(),
+    }
+
+
+@app.route("/metrics")
+def metrics():
+    return Response(generate_latest(metrics_registry()), mimetype=CONTENT_TYPE_LATEST)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,132 @@
+"""
+Dialplan benchmark: mod_xml_curl dialplan lookups across many stores.
+
+Writes a synthetic tenants file with --stores stores, then posts dialplan
+requests through the Flask test client. "cold" is the first lookup of
+every context (render + cache), "warm" is random lookups once every
+context is cached, "reload" changes one store and looks up every context
+again (only that store re-renders). "render" is generate_dialplan_xml on
+its own, i.e. what every request would cost without the cache.
+
+Usage:
+    python bench_dialplan.py [--stores 5000] [--requests 50000]
+"""
+
+import argparse
+import json
+import logging
+import os
+import random
+import sys
+import tempfile
+import time
+from urllib.parse import urlencode
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+TENANTS_FILE = os.path.join(tempfile.mkdtemp(prefix="bench-dialplan-"), "tenants.json")
+os.environ["TENANTS_FILE"] = TENANTS_FILE
+os.environ.setdefault("XML_FLUSH_LOCK", TENANTS_FILE + ".lock")
+sys.path.insert(0, HERE)
+
+from loadtest import dialplan_form  # noqa: E402
+
+logging.getLogger().setLevel(logging.WARNING)
+
+HEADERS = {"Content-Type": "application/x-www-form-urlencoded"}
+
+
+def synthetic_tenants(count):
+    stores = {}
+    for i in range(count):
+        users = {
+            str(1000 + u): {"password": "123456", "name": f"Store {i} - Ext {1000 + u}"}
+            for u in range(10)
+        }
+        stores[f"store{i}.local"] = {
+            "name": f"Store {i}",
+            "did": f"+1{5550000000 + i}",
+            "caller_id": f"+1{5550000000 + i}",
+            "context": f"store{i}",
+            "gateway": f"telnyx_store{i}",
+            "ring_group": list(users)[:3],
+            "park_slots": [str(700 + p) for p in range(10)],
+            "users": users,
+        }
+    return {"stores": stores, "gateways": {}}
+
+
+def write_tenants(data):
+    tmp = TENANTS_FILE + ".tmp"
+    with open(tmp, "w") as f:
+        json.dump(data, f)
+    os.replace(tmp, TENANTS_FILE)
+
+
+def percentile(sorted_values, pct):
+    index = min(len(sorted_values) - 1, int(round(pct / 100 * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+
+def run(name, client, bodies):
+    latencies = []
+    start = time.perf_counter()
+    for body in bodies:
+        t = time.perf_counter()
+        response = client.post("/freeswitch", data=body, headers=HEADERS)
+        response.get_data()
+        assert response.status_code == 200
+        latencies.append(time.perf_counter() - t)
+    elapsed = time.perf_counter() - start
+    latencies.sort()
+    print(
+        f"{name:<7} {len(bodies):>8} reqs  {elapsed:8.3f}s  {len(bodies) / elapsed:>9,.0f} req/s  "
+        f"p50 {percentile(latencies, 50) * 1000:.3f}  p99 {percentile(latencies, 99) * 1000:.3f} ms"
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--stores", type=int, default=5000)
+    parser.add_argument("--requests", type=int, default=50000)
+    args = parser.parse_args()
+
+    data = synthetic_tenants(args.stores)
+    write_tenants(data)
+    start = time.perf_counter()
+    import app as api_app
+
+    stores = api_app.tenants.current.stores
+    print(f"load: {len(stores)} stores in {(time.perf_counter() - start) * 1000:.1f} ms")
+
+    def body(domain):
+        store = data["stores"][domain]
+        return urlencode(dialplan_form(domain, store["context"], "1001")).encode()
+
+    domains = list(data["stores"])
+    every_context = [body(domain) for domain in domains]
+    rng = random.Random(1)
+    lookups = [body(rng.choice(domains)) for _ in range(args.requests)]
+    client = api_app.app.test_client()
+
+    start = time.perf_counter()
+    for domain in domains:
+        api_app.generate_dialplan_xml(domain, stores[domain])
+    elapsed = time.perf_counter() - start
+    print(f"render  {len(domains):>8} ctxs  {elapsed:8.3f}s  {elapsed / len(domains) * 1e6:>9.1f} us/ctx")
+
+    run("cold", client, every_context)
+    run("warm", client, lookups)
+
+    data["stores"][domains[0]]["park_slots"].append("799")
+    write_tenants(data)
+    start = time.perf_counter()
+    api_app.tenants.reload()
+    print(f"reload: 1 store changed, swapped in {(time.perf_counter() - start) * 1000:.1f} ms")
+    misses = api_app.dialplan_cache.stats["misses"]
+    run("reload", client, every_context)
+    print(f"re-rendered contexts after reload: {api_app.dialplan_cache.stats['misses'] - misses}")
+    print(f"cache: {api_app.dialplan_cache.snapshot()}")
+
+
+if __name__ == "__main__":
+    main()
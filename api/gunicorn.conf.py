@@ -0,0 +1,46 @@
+# Gunicorn settings for the FreeSWITCH XML API.
+#
+# mod_xml_curl gives us 5 seconds per request (xml_curl.conf.xml). After a
+# network blip every phone in a store re-registers at once, so the default
+# is an async (gevent) worker per core rather than a couple of sync workers.
+# Everything can be overridden from the environment.
+
+import multiprocessing
+import os
+import shutil
+
+bind = os.environ.get("API_BIND", "0.0.0.0:5000")
+
+# "gevent" (default) or "sync" for debugging
+worker_class = os.environ.get("API_WORKER_CLASS", "gevent")
+workers = int(os.environ.get("API_WORKERS", multiprocessing.cpu_count()))
+# Concurrent requests per gevent worker
+worker_connections = int(os.environ.get("API_WORKER_CONNECTIONS", 1000))
+
+# FreeSWITCH gives up after 5s; don't hold workers much longer than that
+timeout = int(os.environ.get("API_TIMEOUT", 30))
+graceful_timeout = 10
+keepalive = int(os.environ.get("API_KEEPALIVE", 15))
+backlog = 2048
+
+# Per-request access logging is off on the hot path; set API_ACCESS_LOG=- to enable
+accesslog = os.environ.get("API_ACCESS_LOG") or None
+errorlog = "-"
+loglevel = os.environ.get("LOG_LEVEL", "info").lower()
+
+# Workers write metric samples here and /metrics merges them
+# (prometheus_client multiprocess mode). Must be set before the app is
+# imported, and emptied whenever the master starts.
+os.environ.setdefault("PROMETHEUS_MULTIPROC_DIR", "/tmp/api-metrics")
+
+
+def on_starting(server):
+    path = os.environ["PROMETHEUS_MULTIPROC_DIR"]
+    shutil.rmtree(path, ignore_errors=True)
+    os.makedirs(path)
+
+
+def child_exit(server, worker):
+    from prometheus_client import multiprocess
+
+    multiprocess.mark_process_dead(worker.pid)
@@ -0,0 +1,223 @@
+"""
+Load generator for the FreeSWITCH XML API.
+
+Replays the form-encoded POSTs mod_xml_curl sends for directory (REGISTER
+auth), dialplan and sofia.conf lookups against /freeswitch and reports throughput
+and latency percentiles. Users come from the tenants file, so every
+request hits a real entry (plus a share of unknown users, like scanners).
+
+Usage:
+    python loadtest.py [--url http://127.0.0.1:5000/freeswitch]
+                       [--concurrency 200] [--requests 20000]
+                       [--tenants ../config/tenants.json]
+                       [--config-ratio 0.001] [--unknown-ratio 0.05]
+                       [--dialplan-ratio 0.0]
+                       [--keepalive]
+
+By default every request opens a new connection, which is what
+mod_xml_curl does.
+"""
+
+import argparse
+import http.client
+import json
+import random
+import threading
+import time
+import uuid
+from urllib.parse import urlencode, urlsplit
+
+
+def directory_form(domain, user):
+    """Fields FreeSWITCH posts for a sip_auth directory lookup"""
+    return {
+        "hostname": "freeswitch",
+        "section": "directory",
+        "tag_name": "domain",
+        "key_name": "name",
+        "key_value": domain,
+        "Event-Name": "REQUEST_PARAMS",
+        "Core-UUID": str(uuid.uuid4()),
+        "FreeSWITCH-Hostname": "freeswitch",
+        "Event-Calling-File": "sofia_reg.c",
+        "Event-Calling-Function": "sofia_reg_parse_auth",
+        "action": "sip_auth",
+        "sip_profile": "internal",
+        "sip_user_agent": "Yealink SIP-T46U 108.86.0.20",
+        "sip_auth_username": user,
+        "sip_auth_realm": domain,
+        "sip_auth_nonce": str(uuid.uuid4()),
+        "sip_auth_uri": f"sip:{domain}",
+        "sip_contact_user": user,
+        "sip_contact_host": "192.168.1.50",
+        "sip_to_user": user,
+        "sip_to_host": domain,
+        "sip_from_user": user,
+        "sip_from_host": domain,
+        "sip_request_host": domain,
+        "sip_auth_qop": "auth",
+        "sip_auth_cnonce": uuid.uuid4().hex[:16],
+        "sip_auth_nc": "00000001",
+        "sip_auth_response": uuid.uuid4().hex,
+        "sip_auth_method": "REGISTER",
+        "key": "id",
+        "user": user,
+        "domain": domain,
+        "ip": "192.168.1.50",
+    }
+
+
+def configuration_form():
+    return {
+        "hostname": "freeswitch",
+        "section": "configuration",
+        "tag_name": "configuration",
+        "key_name": "name",
+        "key_value": "sofia.conf",
+        "Event-Name": "REQUEST_PARAMS",
+    }
+
+
+def dialplan_form(domain, context, destination):
+    """Fields FreeSWITCH posts when a call from a store phone hunts its context"""
+    return {
+        "hostname": "freeswitch",
+        "section": "dialplan",
+        "tag_name": "",
+        "key_name": "",
+        "key_value": "",
+        "Event-Name": "REQUEST_PARAMS",
+        "Core-UUID": str(uuid.uuid4()),
+        "FreeSWITCH-Hostname": "freeswitch",
+        "Caller-Context": context,
+        "Caller-Destination-Number": destination,
+        "Hunt-Context": context,
+        "Hunt-Destination-Number": destination,
+        "variable_domain_name": domain,
+    }
+
+
+def build_requests(tenants, count, config_ratio, unknown_ratio, seed=1, dialplan_ratio=0.0):
+    """Pre-encode request bodies so the generator itself stays cheap"""
+    rng = random.Random(seed)
+    users = [
+        (domain, user)
+        for domain, store in tenants["stores"].items()
+        for user in store.get("users", {})
+    ]
+    if not users:
+        raise SystemExit("tenants file has no users")
+
+    bodies = []
+    for _ in range(count):
+        roll = rng.random()
+        if roll < config_ratio:
+            form = configuration_form()
+        elif roll < config_ratio + unknown_ratio:
+            domain, _ = rng.choice(users)
+            form = directory_form(domain, str(rng.randrange(20000, 99999)))
+        elif roll < config_ratio + unknown_ratio + dialplan_ratio:
+            domain, user = rng.choice(users)
+            form = dialplan_form(domain, tenants["stores"][domain]["context"], user)
+        else:
+            form = directory_form(*rng.choice(users))
+        bodies.append((form["section"], urlencode(form).encode()))
+    return bodies
+
+
+class Worker(threading.Thread):
+    def __init__(self, url, jobs, keepalive, timeout):
+        super().__init__(daemon=True)
+        self.url = url
+        self.jobs = jobs
+        self.keepalive = keepalive
+        self.timeout = timeout
+        # [(section, seconds, status)]
+        self.samples = []
+
+    def _connect(self):
+        return http.client.HTTPConnection(self.url.hostname, self.url.port or 80, timeout=self.timeout)
+
+    def run(self):
+        headers = {"Content-Type": "application/x-www-form-urlencoded"}
+        conn = None
+        while True:
+            try:
+                section, body = self.jobs.pop()
+            except IndexError:
+                break
+            start = time.perf_counter()
+            try:
+                if conn is None:
+                    conn = self._connect()
+                conn.request("POST", self.url.path, body, headers)
+                response = conn.getresponse()
+                response.read()
+                status = response.status
+            except (OSError, http.client.HTTPException):
+                status = 0
+                conn = None
+            self.samples.append((section, time.perf_counter() - start, status))
+            if not self.keepalive and conn is not None:
+                conn.close()
+                conn = None
+
+
+def percentile(sorted_values, pct):
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, int(round(pct / 100 * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+
+def report(samples, elapsed):
+    print(f"{len(samples)} requests in {elapsed:.2f}s = {len(samples) / elapsed:,.0f} req/s")
+    print(f"{'section':<15} {'count':>8} {'errors':>7} {'p50 ms':>8} {'p90 ms':>8} {'p99 ms':>8} {'max ms':>8}")
+    sections = sorted({s for s, _, _ in samples}) + ["all"]
+    for section in sections:
+        rows = [r for r in samples if section in ("all", r[0])]
+        latencies = sorted(t * 1000 for _, t, _ in rows)
+        errors = sum(1 for _, _, status in rows if status != 200)
+        print(
+            f"{section:<15} {len(rows):>8} {errors:>7} "
+            f"{percentile(latencies, 50):>8.2f} {percentile(latencies, 90):>8.2f} "
+            f"{percentile(latencies, 99):>8.2f} {latencies[-1] if latencies else 0:>8.2f}"
+        )
+    over = sum(1 for _, t, _ in samples if t > 5)
+    if over:
+        print(f"WARNING: {over} requests exceeded the 5s mod_xml_curl timeout")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--url", default="http://127.0.0.1:5000/freeswitch")
+    parser.add_argument("--concurrency", type=int, default=200)
+    parser.add_argument("--requests", type=int, default=20000)
+    parser.add_argument("--tenants", default="../config/tenants.json")
+    parser.add_argument("--config-ratio", type=float, default=0.001)
+    parser.add_argument("--unknown-ratio", type=float, default=0.05)
+    parser.add_argument("--dialplan-ratio", type=float, default=0.0)
+    parser.add_argument("--timeout", type=float, default=5.0)
+    parser.add_argument("--keepalive", action="store_true", help="reuse connections")
+    args = parser.parse_args()
+
+    with open(args.tenants) as f:
+        tenants = json.load(f)
+    jobs = build_requests(
+        tenants, args.requests, args.config_ratio, args.unknown_ratio, dialplan_ratio=args.dialplan_ratio
+    )
+
+    url = urlsplit(args.url)
+    workers = [Worker(url, jobs, args.keepalive, args.timeout) for _ in range(args.concurrency)]
+    start = time.perf_counter()
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    elapsed = time.perf_counter() - start
+
+    report([sample for worker in workers for sample in worker.samples], elapsed)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,172 @@
+"""
+Tests for the XML the API hands to mod_xml_curl: directory documents
+and per-store dialplan contexts.
+
+The tenants file is a temporary copy written before app is imported;
+requests go through the Flask test client.
+
+Usage:
+    python -m pytest -q test_app.py
+"""
+
+import json
+import os
+import tempfile
+import xml.etree.ElementTree as ET
+
+TENANTS_DIR = tempfile.mkdtemp(prefix="test-api-")
+os.environ["TENANTS_FILE"] = os.path.join(TENANTS_DIR, "tenants.json")
+os.environ["XML_FLUSH_LOCK"] = os.path.join(TENANTS_DIR, "xml-flush.lock")
+
+ODD = '&<x>"'
+STORE = {
+    "name": "Store 1",
+    "did": "+17577828734",
+    "caller_id": "+17577828734",
+    "context": "store1",
+    "gateway": "telnyx_store1",
+    "ring_group": ["1000"],
+    "park_slots": ["700", "701"],
+    "users": {
+        "1000": {
+            "password": "p&ss<\"word>",
+            "vm_password": "1000",
+            "name": f"Front {ODD} desk",
+            "toll_allow": "domestic&local",
+        },
+        "1001": {
+            "password": "123456",
+            "vm_password": "1001",
+            "name": "Back office",
+            "toll_allow": "domestic",
+        },
+    },
+}
+
+with open(os.environ["TENANTS_FILE"], "w") as f:
+    json.dump({"stores": {"store1.local": STORE}, "gateways": {}}, f)
+
+import app  # noqa: E402
+
+client = app.app.test_client()
+
+
+def directory(**fields):
+    form = {"section": "directory", "domain": "store1.local", "purpose": "", **fields}
+    return client.post("/freeswitch", data=form)
+
+
+def is_not_found(response):
+    return ET.fromstring(response.data).find("section/result").get("status") == "not found"
+
+
+# =============================================================================
+# DIRECTORY
+# =============================================================================
+
+
+def test_user_lookup_returns_the_whole_domain():
+    response = directory(user="1001", sip_auth_realm="store1.local")
+    assert response.status_code == 200
+    domain = ET.fromstring(response.data).find("section/domain")
+    assert domain.get("name") == "store1.local"
+    assert sorted(user.get("id") for user in domain.iter("user")) == ["1000", "1001"]
+
+
+def test_tenant_values_are_escaped():
+    domain = ET.fromstring(directory(user="1000").data).find("section/domain")
+    user = next(user for user in domain.iter("user") if user.get("id") == "1000")
+    params = {p.get("name"): p.get("value") for p in user.iter("param")}
+    variables = {v.get("name"): v.get("value") for v in user.iter("variable")}
+    assert params["password"] == 'p&ss<"word>'
+    assert variables["effective_caller_id_name"] == f"Front {ODD} desk"
+    assert variables["toll_allow"] == "domestic&local"
+
+
+def test_user_less_lookup_is_not_found():
+    # sofia's gateways/network-list lookups must not get anyone's password
+    for purpose in ("", "gateways", "network-list"):
+        response = directory(purpose=purpose)
+        assert is_not_found(response)
+        assert b"password" not in response.data
+
+
+def test_unknown_user_and_domain_are_not_found():
+    assert is_not_found(directory(user="9999"))
+    assert is_not_found(directory(user="1000", domain="nowhere.local"))
+
+
+# =============================================================================
+# DIALPLAN
+# =============================================================================
+
+
+def dialplan(context):
+    return client.post(
+        "/freeswitch",
+        data={"section": "dialplan", "Hunt-Context": context, "Caller-Context": context},
+    )
+
+
+def extensions(response):
+    context = ET.fromstring(response.data).find("section/context")
+    return context, {ext.get("name"): ext for ext in context.iter("extension")}
+
+
+def test_store_context_is_built_from_tenant_data():
+    context, found = extensions(dialplan("store1"))
+    assert context.get("name") == "store1"
+    assert list(found) == ["local_extension", "park_slot", "own_did", "outbound"]
+    assert found["local_extension"].find("condition").get("expression") == "^(1000|1001)$"
+    assert found["park_slot"].find("condition").get("expression") == "^(700|701)$"
+    assert found["own_did"].find("condition").get("expression") == r"^\+?1?7577828734$"
+    actions = [a.get("data") for a in found["outbound"].iter("action")]
+    assert actions == [
+        "effective_caller_id_number=+17577828734",
+        "sofia/gateway/telnyx_store1/+1$1",
+    ]
+
+
+def test_other_contexts_fall_back_to_static_files():
+    for context in ("public", "default", ""):
+        assert is_not_found(dialplan(context))
+
+
+def test_dialplan_values_are_escaped():
+    store = dict(
+        STORE,
+        context=f"ctx{ODD}",
+        caller_id=f"+1{ODD}",
+        gateway=f"gw{ODD}",
+        users={f"10{ODD}": {}},
+        park_slots=[f"7{ODD}"],
+    )
+    root = ET.fromstring(app.generate_dialplan_xml(f"d{ODD}.local", store))
+    context = root.find("section/context")
+    assert context.get("name") == f"ctx{ODD}"
+    data = [a.get("data") for a in context.iter("action")]
+    assert f"sip_invite_domain=d{ODD}.local" in data
+    assert f"effective_caller_id_number=+1{ODD}" in data
+    assert f"sofia/gateway/gw{ODD}/+1$1" in data
+    expressions = [c.get("expression") for c in context.iter("condition")]
+    assert r'^(10\&<x>")$' in expressions
+    assert r'^(7\&<x>")$' in expressions
+
+
+def test_dialplan_is_cached_until_the_store_changes():
+    dialplan("store1")
+    hits = app.dialplan_cache.stats["hits"]
+    dialplan("store1")
+    assert app.dialplan_cache.stats["hits"] == hits + 1
+
+    changed = dict(STORE, park_slots=["700", "701", "702"])
+    with open(os.environ["TENANTS_FILE"], "w") as f:
+        json.dump({"stores": {"store1.local": changed}, "gateways": {}}, f)
+    try:
+        assert app.tenants.reload()
+        _, found = extensions(dialplan("store1"))
+        assert found["park_slot"].find("condition").get("expression") == "^(700|701|702)$"
+    finally:
+        with open(os.environ["TENANTS_FILE"], "w") as f:
+            json.dump({"stores": {"store1.local": STORE}, "gateways": {}}, f)
+        app.tenants.reload()
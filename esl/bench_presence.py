@@ -0,0 +1,119 @@
+"""
+Microbenchmark for presence PUBLISH serialization.
+
+Compares the original f-string implementation (uuid4 per token, str
+concatenation, Content-Length from len(str)) against PublishMessageBuilder.
+Nothing is sent on the network.
+
+Usage:
+    python bench_presence.py [--count 200000] [--entities 500]
+"""
+
+import argparse
+import logging
+import time
+import uuid as uuid_module
+
+from call_router import PublishMessageBuilder
+
+logging.getLogger().setLevel(logging.WARNING)
+
+LOCAL_IP = "10.0.0.10"
+LOCAL_PORT = 5080
+
+
+def legacy_publish(entity, local_user, domain, state, version, remote_info=None):
+    """The serialization PresencePublisher used before PublishMessageBuilder"""
+    dialog_id = str(uuid_module.uuid4())
+
+    body = f"""<?xml version="1.0" encoding="UTF-8"?>
+<dialog-info xmlns="urn:ietf:params:xml:ns:dialog-info" version="{version}" state="full" entity="{entity}">
+  <dialog id="{dialog_id}" direction="recipient">
+    <state>{state}</state>
+    <local>
+      <identity display="{local_user}">{entity}</identity>
+      <target uri="{entity}"/>
+    </local>"""
+
+    if remote_info:
+        body += f"""
+    <remote>
+      <identity display="{remote_info}">sip:{remote_info}@{domain}</identity>
+      <target uri="sip:{remote_info}@{domain}"/>
+    </remote>"""
+
+    body += """
+  </dialog>
+</dialog-info>"""
+
+    call_id = f"presence-{version}-{uuid_module.uuid4().hex[:8]}@{LOCAL_IP}"
+
+    request = f"""PUBLISH {entity} SIP/2.0\r
+Via: SIP/2.0/UDP {LOCAL_IP}:{LOCAL_PORT};rport;branch=z9hG4bK{uuid_module.uuid4().hex[:16]}\r
+Max-Forwards: 70\r
+From: <{entity}>;tag={uuid_module.uuid4().hex[:8]}\r
+To: <{entity}>\r
+Call-ID: {call_id}\r
+CSeq: {version} PUBLISH\r
+Contact: <sip:freeswitch@{LOCAL_IP}:5080>\r
+Event: dialog\r
+Expires: 3600\r
+Content-Type: application/dialog-info+xml\r
+Content-Length: {len(body)}\r
+\r
+{body}"""
+
+    return request.encode()
+
+
+def builder_publish(builder, entity, local_user, domain, state, version, remote_info=None):
+    body = builder.dialog_info(entity, local_user, domain, state, version, remote_info)
+    return builder.publish(entity, local_user, version, body)[0]
+
+
+def workload(count, entities):
+    """Yield (entity, local_user, domain, state, remote_info) tuples"""
+    for i in range(count):
+        slot = str(700 + i % entities)
+        domain = f"store{i % 7}.local"
+        parked = i % 2 == 0
+        yield (
+            f"sip:{slot}@{domain}",
+            slot,
+            domain,
+            "confirmed" if parked else "terminated",
+            f"+1555{i % 10000:07d}" if parked else None,
+        )
+
+
+def run(name, publish, items):
+    start = time.perf_counter()
+    size = 0
+    for version, (entity, local_user, domain, state, remote) in enumerate(items, 1):
+        size += len(publish(entity, local_user, domain, state, version, remote))
+    elapsed = time.perf_counter() - start
+    rate = len(items) / elapsed
+    print(f"{name:<10} {len(items):>9} msgs  {elapsed:8.3f}s  {rate:>12,.0f} msgs/s  {size // len(items)} B/msg")
+    return rate
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--count", type=int, default=200000)
+    parser.add_argument("--entities", type=int, default=500)
+    args = parser.parse_args()
+
+    items = list(workload(args.count, args.entities))
+    builder = PublishMessageBuilder(LOCAL_IP, LOCAL_PORT)
+
+    before = run("before", legacy_publish, items)
+    after = run(
+        "after",
+        lambda *a: builder_publish(builder, *a),
+        items,
+    )
+    print(f"speedup    {after / before:.2f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,725 @@
+"""
+Offline replay benchmark for the router and the XML API.
+
+Everything runs in one process on loopback; no FreeSWITCH, Kamailio or
+Docker needed:
+
+- calls:   a fake FreeSWITCH dials into the outbound ESL server and plays
+           call scripts (answered, no answer, busy, caller gives up,
+           DID-only routing, unknown store) against InboundCallHandler
+- events:  a fake FreeSWITCH inbound ESL server replays an event stream
+           at a fixed rate into run_inbound_esl; a UDP SIP responder
+           stands in for Kamailio and answers every PUBLISH, and hangups
+           become call records in an in-memory CDR database
+- async:   a fake FreeSWITCH parks calls and answers bgapi for
+           ROUTER_CALL_MODE=async (CallController over a few inbound
+           connections instead of one connection per call)
+- xmlcurl: mod_xml_curl directory / sofia.conf requests through the
+           Flask app's freeswitch_handler (test client, no sockets)
+
+The event stream is either synthetic or recorded: one JSON object of
+event headers per line, e.g. the bodies of `event json ...` captured
+from a real box. "all" runs calls, events and xmlcurl; async replaces the
+router's inbound connection the same way events does, so it runs alone.
+
+Usage:
+    python bench_replay.py [calls|events|async|xmlcurl|all]
+                           [--calls 2000] [--concurrency 100] [--ring-time 0.05]
+                           [--events 50000] [--rate 10000] [--events-file FILE]
+                           [--publish-rate 5000] [--sip-delay 0] [--sip-loss 0]
+                           [--requests 20000]
+"""
+
+import os
+import sys
+import tempfile
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+API_DIR = os.path.join(HERE, "..", "api")
+os.environ.setdefault("TENANTS_FILE", os.path.join(HERE, "..", "config", "tenants.json"))
+os.environ.setdefault("PARK_STATE_DB", ":memory:")
+os.environ.setdefault("ROUTER_CDR_DB", ":memory:")
+os.environ.setdefault("ROUTER_CDR_SPOOL", os.path.join(tempfile.gettempdir(), "bench-cdr-spool"))
+os.environ.setdefault("LOG_LEVEL", "ERROR")
+# Not shipped; create it to turn subsystem logs back on while benchmarking
+os.environ.setdefault("LOG_LEVELS_FILE", os.path.join(HERE, "bench_log_levels.json"))
+
+import argparse
+import itertools
+import json
+import random
+import socket
+import time
+from urllib.parse import quote
+
+import gevent
+import gevent.event
+import gevent.lock
+import gevent.pool
+import gevent.server
+import greenswitch
+
+import call_router
+
+
+def percentile(sorted_values, pct):
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, int(round(pct / 100 * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+
+def report(name, unit, count, elapsed, latencies=None, extra=""):
+    print(f"{name:<9} {count:>8} {unit:<8} {elapsed:8.2f}s {count / elapsed:>10,.0f} {unit}/s  {extra}")
+    if latencies:
+        values = sorted(v * 1000 for v in latencies)
+        print(
+            f"{'':<9} latency ms  p50 {percentile(values, 50):.3f}  p90 {percentile(values, 90):.3f}  "
+            f"p99 {percentile(values, 99):.3f}  max {values[-1]:.3f}"
+        )
+
+
+def esl_frame(headers, content_type="text/event-plain"):
+    body = "".join(f"{key}: {quote(str(value))}\n" for key, value in headers.items()) + "\n"
+    body = body.encode()
+    return b"Content-Length: %d\nContent-Type: %s\n\n" % (len(body), content_type.encode()) + body
+
+
+def free_port():
+    """greenswitch treats bind_port=0 as "no port", so pick one up front"""
+    probe = socket.socket()
+    probe.bind(("127.0.0.1", 0))
+    port = probe.getsockname()[1]
+    probe.close()
+    return port
+
+
+def read_command(sock_file):
+    """One ESL command (up to the blank line), or None at EOF"""
+    lines = []
+    while True:
+        line = sock_file.readline()
+        if not line:
+            return None
+        if line == b"\n":
+            return b"".join(lines).decode()
+        lines.append(line)
+
+
+# =============================================================================
+# KAMAILIO STAND-IN (UDP SIP responder)
+# =============================================================================
+
+
+class SipResponder:
+    """Answers every PUBLISH with 200 OK and an entity tag"""
+
+    def __init__(self, delay=0.0, loss=0.0):
+        self.delay = delay
+        self.loss = loss
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 1 << 20)
+        self.sock.bind(("127.0.0.1", 0))
+        self.port = self.sock.getsockname()[1]
+        self.received = 0
+        self.lost = 0
+        self._etags = itertools.count(1)
+        self._rng = random.Random(7)
+
+    def start(self):
+        gevent.spawn(self._loop)
+
+    def _loop(self):
+        while True:
+            data, addr = self.sock.recvfrom(65535)
+            self.received += 1
+            if self.loss and self._rng.random() < self.loss:
+                self.lost += 1
+                continue
+            if self.delay:
+                gevent.spawn_later(self.delay, self._reply, data, addr)
+            else:
+                self._reply(data, addr)
+
+    def _reply(self, data, addr):
+        head = data.split(b"\r\n\r\n", 1)[0].split(b"\r\n")
+        copied = [
+            line
+            for line in head[1:]
+            if line.split(b":", 1)[0].lower() in (b"via", b"from", b"to", b"call-id", b"cseq")
+        ]
+        response = b"\r\n".join(
+            [b"SIP/2.0 200 OK"]
+            + copied
+            + [b"SIP-ETag: e%d" % next(self._etags), b"Expires: 3600", b"Content-Length: 0", b"", b""]
+        )
+        self.sock.sendto(response, addr)
+
+
+# =============================================================================
+# CALLS (fake FreeSWITCH dialling into the outbound ESL server)
+# =============================================================================
+
+# (weight, name, store header?, originate disposition, seconds before bridge ends)
+CALL_SCRIPTS = (
+    (60, "answered", True, "SUCCESS", 1.0),
+    (15, "no_answer", True, "NO_ANSWER", 1.0),
+    (8, "busy", True, "USER_BUSY", 0.2),
+    (10, "caller_gone", True, "ORIGINATOR_CANCEL", 0.5),
+    (5, "did_only", False, "SUCCESS", 1.0),
+    (2, "unknown_store", None, None, 0),
+)
+
+
+def channel_data(script, stores, rng, index):
+    _, name, with_domain, _, _ = script
+    domain = rng.choice(list(stores))
+    headers = {
+        "Content-Type": "command/reply",
+        "Reply-Text": "+OK",
+        "Unique-ID": f"bench-{index:08d}",
+        "Caller-Caller-ID-Number": f"+1555{rng.randrange(10**7):07d}",
+        "Caller-Destination-Number": stores[domain]["did"],
+    }
+    if with_domain:
+        headers["variable_sip_h_X-Store-Domain"] = domain
+    elif with_domain is None:
+        headers["variable_sip_h_X-Store-Domain"] = "nowhere.invalid"
+    return headers, domain
+
+
+def play_call(port, script, stores, rng, index, ring_time, results):
+    sock = socket.create_connection(("127.0.0.1", port))
+    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    sock_file = sock.makefile("rb")
+    _, name, _, disposition, _ = script
+    try:
+        if read_command(sock_file) is None:
+            return
+        started = time.perf_counter()
+        headers, domain = channel_data(script, stores, rng, index)
+        body = "".join(f"{k}: {quote(str(v))}\n" for k, v in headers.items()) + "\n"
+        sock.sendall(body.encode())
+
+        setup = None
+        while True:
+            command = read_command(sock_file)
+            if command is None:
+                break
+            sock.sendall(b"Content-Type: command/reply\nReply-Text: +OK\n\n")
+            if "execute-app-name: bridge" in command:
+                setup = time.perf_counter() - started
+                gevent.sleep(ring_time * script[4])
+                sock.sendall(
+                    esl_frame(
+                        {
+                            "Event-Name": "CHANNEL_EXECUTE_COMPLETE",
+                            "Unique-ID": headers["Unique-ID"],
+                            "variable_current_application": "bridge",
+                            "variable_originate_disposition": disposition,
+                            "variable_bridge_channel": f"sofia/internal/1000@{call_router.KAMAILIO_HOST}",
+                        }
+                    )
+                )
+            elif command.startswith("exit") or "execute-app-name: hangup" in command:
+                if command.startswith("exit"):
+                    sock.sendall(b"Content-Type: text/disconnect-notice\nContent-Length: 0\n\n")
+                    break
+        results.append((name, setup, time.perf_counter() - started))
+    finally:
+        sock.close()
+
+
+def bench_calls(args):
+    stores = call_router.tenants.current.stores
+    call_router.admission = call_router.AdmissionController(args.concurrency * 2)
+    port = free_port()
+    server = greenswitch.OutboundESLServer(
+        bind_address="127.0.0.1",
+        bind_port=port,
+        application=call_router.InboundCallHandler,
+        max_connections=args.concurrency * 4,
+    )
+    gevent.spawn(server.listen)
+    while not server._running:
+        gevent.sleep(0.01)
+
+    rng = random.Random(11)
+    weights = [script[0] for script in CALL_SCRIPTS]
+    scripts = rng.choices(CALL_SCRIPTS, weights, k=args.calls)
+    results = []
+    pool = gevent.pool.Pool(args.concurrency)
+    start = time.perf_counter()
+    for index, script in enumerate(scripts):
+        pool.spawn(play_call, port, script, stores, rng, index, args.ring_time, results)
+    pool.join()
+    elapsed = time.perf_counter() - start
+    server.stop()
+
+    setups = [setup for _, setup, _ in results if setup is not None]
+    by_script = {}
+    for name, _, _ in results:
+        by_script[name] = by_script.get(name, 0) + 1
+    report(
+        "calls",
+        "calls",
+        len(results),
+        elapsed,
+        setups,
+        " ".join(f"{k}={v}" for k, v in sorted(by_script.items())),
+    )
+    print(f"{'':<9} (latency = channel data sent until the bridge command arrives)")
+
+
+# =============================================================================
+# EVENTS (fake FreeSWITCH inbound ESL server)
+# =============================================================================
+
+
+def synthetic_events(stores, count, seed=3):
+    """Call, park, registration and heartbeat traffic in realistic proportions"""
+    rng = random.Random(seed)
+    domains = list(stores)
+    produced = 0
+    serial = itertools.count()
+    while produced < count:
+        domain = rng.choice(domains)
+        store = stores[domain]
+        ext = rng.choice(store["extensions"])
+        uuid = f"leg-{next(serial)}"
+        roll = rng.random()
+        if roll < 0.6:
+            common = {
+                "Unique-ID": uuid,
+                "Call-Direction": "outbound",
+                "Channel-Name": f"sofia/internal/{ext}@{call_router.KAMAILIO_HOST}",
+                "variable_sip_invite_domain": domain,
+                "Caller-Caller-ID-Number": f"+1555{rng.randrange(10**7):07d}",
+            }
+            batch = [dict(common, **{"Event-Name": "CHANNEL_PROGRESS"})]
+            if rng.random() < 0.7:
+                batch.append(dict(common, **{"Event-Name": "CHANNEL_ANSWER"}))
+            batch.append(
+                dict(common, **{"Event-Name": "CHANNEL_HANGUP_COMPLETE", "Hangup-Cause": "NORMAL_CLEARING"})
+            )
+        elif roll < 0.9:
+            slot = rng.choice(store["park_slots"])
+            park = {
+                "Event-Name": "CUSTOM",
+                "Event-Subclass": "valet_parking::info",
+                "Unique-ID": uuid,
+                "Valet-Lot-Name": domain,
+                "Valet-Extension": slot,
+                "Caller-Caller-ID-Number": f"+1555{rng.randrange(10**7):07d}",
+            }
+            batch = [dict(park, Action="hold"), dict(park, Action=rng.choice(("bridge", "exit")))]
+        elif roll < 0.99:
+            batch = [
+                {
+                    "Event-Name": "CUSTOM",
+                    "Event-Subclass": "sofia::register",
+                    "from-user": ext,
+                    "from-host": domain,
+                }
+            ]
+        else:
+            batch = [{"Event-Name": "HEARTBEAT", "Session-Count": "0"}]
+        for event in batch:
+            yield event
+            produced += 1
+
+
+def recorded_events(path, count):
+    with open(path) as f:
+        events = [json.loads(line) for line in f if line.strip()]
+    if not events:
+        raise SystemExit(f"{path} has no events")
+    return itertools.islice(itertools.cycle(events), count)
+
+
+class EventReplayServer:
+    """Inbound ESL server: accepts auth/commands, then replays at `rate` events/s"""
+
+    TICK = 0.005
+
+    def __init__(self, events, rate):
+        self.frames = events
+        self.rate = rate
+        self.sent = 0
+        self.done = gevent.event.Event()
+        self.server = gevent.server.StreamServer(("127.0.0.1", 0), self._handle)
+
+    def start(self):
+        self.server.start()
+        return self.server.server_port
+
+    def _handle(self, sock, address):
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        sock_file = sock.makefile("rb")
+        sock.sendall(b"Content-Type: auth/request\n\n")
+        subscribed = gevent.event.Event()
+        gevent.spawn(self._commands, sock, sock_file, subscribed)
+        subscribed.wait()
+        gevent.sleep(0.2)
+
+        per_tick = max(1, int(self.rate * self.TICK))
+        start = time.perf_counter()
+        events = iter(self.frames)
+        for batch_index in itertools.count():
+            batch = list(itertools.islice(events, per_tick))
+            if not batch:
+                break
+            now_us = int(time.time() * 1_000_000)
+            sock.sendall(b"".join(esl_frame(dict(event, **{"Event-Date-Timestamp": now_us})) for event in batch))
+            self.sent += len(batch)
+            delay = start + (batch_index + 1) * self.TICK - time.perf_counter()
+            gevent.sleep(max(0, delay))
+        self.done.set()
+        gevent.sleep(3600)
+
+    def _commands(self, sock, sock_file, subscribed):
+        api = {
+            "valet_info": "<lots>\n</lots>\n",
+            "show channels as json": '{"row_count":0}',
+            "show registrations as json": '{"row_count":0}',
+        }
+        while True:
+            command = read_command(sock_file)
+            if command is None:
+                return
+            command = command.strip()
+            if command.startswith("api "):
+                body = api.get(command[4:], "-ERR no such command\n").encode()
+                sock.sendall(b"Content-Type: api/response\nContent-Length: %d\n\n" % len(body) + body)
+                if command[4:] == "show channels as json":
+                    subscribed.set()
+            else:
+                sock.sendall(b"Content-Type: command/reply\nReply-Text: +OK accepted\n\n")
+
+
+def bench_events(args):
+    stores = call_router.tenants.current.stores
+    responder = SipResponder(args.sip_delay, args.sip_loss)
+    responder.start()
+    call_router.KAMAILIO_HOST = "127.0.0.1"
+    call_router.KAMAILIO_PORT = responder.port
+
+    if args.events_file:
+        events = recorded_events(args.events_file, args.events)
+    else:
+        events = synthetic_events(stores, args.events)
+    replay = EventReplayServer(events, args.rate)
+    call_router.FREESWITCH_HOST = "127.0.0.1"
+    call_router.FREESWITCH_ESL_PORT = replay.start()
+
+    # End-to-end latency: replay server send time -> handler finished
+    call_router.EVENT_HEADERS.add("Event-Date-Timestamp")
+    latencies = []
+    handle = call_router.handle_esl_event
+
+    def timed_handle(event):
+        handle(event)
+        sent = event.headers.get("Event-Date-Timestamp")
+        if sent:
+            latencies.append(time.time() - int(sent) / 1_000_000)
+
+    call_router.handle_esl_event = timed_handle
+
+    # PUBLISH round-trips
+    publish_rtts = []
+    send_request = call_router.SipTransport.send_request
+
+    def timed_send(transport, data, branch, call_id):
+        started = time.perf_counter()
+        result = send_request(transport, data, branch, call_id)
+        result.rawlink(
+            lambda r: r.successful() and publish_rtts.append(time.perf_counter() - started)
+        )
+        return result
+
+    call_router.SipTransport.send_request = timed_send
+
+    gevent.spawn(call_router.run_inbound_esl)
+    while call_router.presence_dispatcher is None:
+        gevent.sleep(0.01)
+    call_router.presence_dispatcher.bucket = call_router.TokenBucket(
+        args.publish_rate, max(1, int(args.publish_rate))
+    )
+
+    replay.done.wait()
+    start_wait = time.perf_counter()
+    dispatcher = call_router.event_dispatcher
+    while dispatcher.stats["processed"] + dispatcher.stats["dropped"] < replay.sent:
+        if time.perf_counter() - start_wait > 30:
+            break
+        gevent.sleep(0.01)
+    # Let the presence dispatcher drain what the events produced
+    gevent.sleep(0.5)
+    while call_router.presence_dispatcher.pending:
+        gevent.sleep(0.05)
+    gevent.sleep(0.2)
+
+    elapsed = replay.sent / args.rate
+    report(
+        "events",
+        "events",
+        dispatcher.stats["processed"],
+        elapsed,
+        latencies,
+        f"offered {args.rate}/s dropped={dispatcher.stats['dropped']} errors={dispatcher.stats['errors']}",
+    )
+    presence = call_router.presence_dispatcher.stats
+    report(
+        "publish",
+        "msgs",
+        responder.received,
+        elapsed,
+        publish_rtts,
+        f"coalesced={presence['coalesced']} unchanged={presence['unchanged']} "
+        f"deferred={presence['deferred']} lost={responder.lost}",
+    )
+    cdr = call_router.cdr_writer
+    if cdr:
+        cdr.flush()
+        report(
+            "cdr",
+            "records",
+            cdr.stats["written"],
+            elapsed,
+            extra=f"batches={cdr.stats['batches']} spool_reads={cdr.stats['spool_reads']} "
+            f"pending={len(cdr.pending)}",
+        )
+
+
+# =============================================================================
+# ASYNC CALLS (fake FreeSWITCH parking calls for CallController)
+# =============================================================================
+
+
+class AsyncSwitch:
+    """
+    Inbound ESL server for ROUTER_CALL_MODE=async: parks calls on the
+    subscribed connection, answers bgapi on the control connections and
+    plays the BACKGROUND_JOB results and hangups back
+    """
+
+    def __init__(self, stores, ring_time):
+        self.stores = stores
+        self.ring_time = ring_time
+        self.events_sock = None
+        self.events_lock = gevent.lock.Semaphore()
+        self.server = gevent.server.StreamServer(("127.0.0.1", 0), self._handle)
+        self.connections = 0
+        # {channel uuid: (park sent at, AsyncResult set on hangup)}
+        self.calls = {}
+        self.bridge_latencies = []
+        self.commands = {"uuid_transfer": 0, "uuid_kill": 0}
+
+    def start(self):
+        self.server.start()
+        return self.server.server_port
+
+    def send_event(self, headers, body=""):
+        if body:
+            headers = dict(headers, **{"Content-Length": len(body)})
+        frame = "".join(f"{key}: {quote(str(value))}\n" for key, value in headers.items())
+        if body:
+            frame += "\n" + body
+        data = frame.encode()
+        with self.events_lock:
+            self.events_sock.sendall(
+                b"Content-Length: %d\nContent-Type: text/event-plain\n\n" % len(data) + data
+            )
+
+    def park(self, call_uuid, domain, caller_id):
+        done = gevent.event.AsyncResult()
+        self.calls[call_uuid] = (time.perf_counter(), done)
+        self.send_event(
+            {
+                "Event-Name": "CHANNEL_PARK",
+                "Unique-ID": call_uuid,
+                "Caller-Caller-ID-Number": caller_id,
+                "Caller-Destination-Number": self.stores[domain]["did"],
+                "variable_sip_h_X-Store-Domain": domain,
+                "variable_router_control": "async",
+            }
+        )
+        return done
+
+    def hangup(self, call_uuid, disposition, bridged):
+        headers = {
+            "Event-Name": "CHANNEL_HANGUP_COMPLETE",
+            "Unique-ID": call_uuid,
+            "Call-Direction": "inbound",
+            "Hangup-Cause": "NORMAL_CLEARING",
+        }
+        if bridged:
+            headers["variable_originate_disposition"] = disposition
+            headers["variable_bridge_channel"] = f"sofia/internal/1000@{call_router.KAMAILIO_HOST}"
+        self.send_event(headers)
+        _, done = self.calls.pop(call_uuid, (None, None))
+        if done is not None:
+            done.set(disposition)
+
+    def _handle(self, sock, address):
+        self.connections += 1
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        sock_file = sock.makefile("rb")
+        sock.sendall(b"Content-Type: auth/request\n\n")
+        api = {
+            "valet_info": "<lots>\n</lots>\n",
+            "show channels as json": '{"row_count":0}',
+            "show registrations as json": '{"row_count":0}',
+        }
+        lock = gevent.lock.Semaphore()
+        while True:
+            command = read_command(sock_file)
+            if command is None:
+                return
+            line, _, job = command.strip().partition("\nJob-UUID: ")
+            if line.startswith("bgapi "):
+                with lock:
+                    sock.sendall(b"Content-Type: command/reply\nReply-Text: +OK Job-UUID: %s\n\n" % job.encode())
+                gevent.spawn(self._job, line[6:], job)
+            elif line.startswith("api "):
+                body = api.get(line[4:], "-ERR no such command\n").encode()
+                with lock:
+                    sock.sendall(b"Content-Type: api/response\nContent-Length: %d\n\n" % len(body) + body)
+            else:
+                if line.startswith("event "):
+                    self.events_sock = sock
+                with lock:
+                    sock.sendall(b"Content-Type: command/reply\nReply-Text: +OK accepted\n\n")
+
+    def _job(self, command, job_uuid):
+        name, call_uuid = command.split(" ", 2)[:2]
+        self.send_event(
+            {"Event-Name": "BACKGROUND_JOB", "Job-UUID": job_uuid, "Job-Command": name},
+            "+OK\n",
+        )
+        self.commands[name] = self.commands.get(name, 0) + 1
+        if name == "uuid_transfer":
+            parked_at, _ = self.calls.get(call_uuid, (None, None))
+            if parked_at is not None:
+                self.bridge_latencies.append(time.perf_counter() - parked_at)
+            gevent.sleep(self.ring_time)
+            self.hangup(call_uuid, "SUCCESS", True)
+        elif name == "uuid_kill":
+            self.hangup(call_uuid, "CALL_REJECTED", False)
+
+
+def bench_async(args):
+    stores = call_router.tenants.current.stores
+    responder = SipResponder()
+    responder.start()
+    call_router.KAMAILIO_HOST = "127.0.0.1"
+    call_router.KAMAILIO_PORT = responder.port
+
+    switch = AsyncSwitch(stores, args.ring_time)
+    call_router.FREESWITCH_HOST = "127.0.0.1"
+    call_router.FREESWITCH_ESL_PORT = switch.start()
+    call_router.admission = call_router.AdmissionController(args.concurrency * 2)
+    call_router.call_control = call_router.CallController()
+    call_router.call_control.start()
+    gevent.spawn(call_router.run_inbound_esl)
+    while (
+        not call_router.cluster.is_ready()
+        or call_router.call_control.connected() < call_router.ROUTER_CONTROL_CONNECTIONS
+    ):
+        gevent.sleep(0.01)
+
+    domains = list(stores)
+    serial = itertools.count()
+    peak = [0]
+
+    def caller():
+        while True:
+            index = next(serial)
+            if index >= args.calls:
+                return
+            domain = domains[index % len(domains)]
+            done = switch.park(f"async-{index:08d}", domain, f"+1555{index % 10**7:07d}")
+            peak[0] = max(peak[0], len(call_router.call_control.calls))
+            done.get(timeout=30)
+
+    start = time.perf_counter()
+    gevent.joinall([gevent.spawn(caller) for _ in range(args.concurrency)])
+    elapsed = time.perf_counter() - start
+    # Let the last hangups reach the controller
+    while call_router.call_control.calls:
+        gevent.sleep(0.01)
+
+    stats = call_router.call_control.stats
+    report(
+        "async",
+        "calls",
+        stats["ended"],
+        elapsed,
+        switch.bridge_latencies,
+        f"peak active={peak[0]} esl connections={switch.connections} "
+        f"job errors={stats['job_errors']} timeouts={stats['job_timeouts']}",
+    )
+    print(f"{'':<9} (latency = CHANNEL_PARK sent until uuid_transfer arrives)")
+
+
+# =============================================================================
+# XML CURL (API handler through the Flask test client)
+# =============================================================================
+
+
+def bench_xmlcurl(args):
+    sys.path.insert(0, API_DIR)
+    import app as api_app
+    from loadtest import build_requests
+
+    with open(os.environ["TENANTS_FILE"]) as f:
+        tenants = json.load(f)
+    jobs = build_requests(tenants, args.requests, 0.001, 0.05)
+    client = api_app.app.test_client()
+    headers = {"Content-Type": "application/x-www-form-urlencoded"}
+
+    by_section = {}
+    start = time.perf_counter()
+    for section, body in jobs:
+        t = time.perf_counter()
+        response = client.post("/freeswitch", data=body, headers=headers)
+        response.get_data()
+        by_section.setdefault(section, []).append(time.perf_counter() - t)
+    elapsed = time.perf_counter() - start
+
+    report("xmlcurl", "reqs", len(jobs), elapsed, [v for vs in by_section.values() for v in vs])
+    for section, values in sorted(by_section.items()):
+        values.sort()
+        print(
+            f"{'':<9} {section:<13} n={len(values):<7} p50 {percentile(values, 50) * 1000:.3f}  "
+            f"p99 {percentile(values, 99) * 1000:.3f} ms"
+        )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("scenario", nargs="?", default="all", choices=("calls", "events", "async", "xmlcurl", "all"))
+    parser.add_argument("--calls", type=int, default=2000)
+    parser.add_argument("--concurrency", type=int, default=100)
+    parser.add_argument("--ring-time", type=float, default=0.05, help="seconds a bridge rings before it ends")
+    parser.add_argument("--events", type=int, default=50000)
+    parser.add_argument("--rate", type=int, default=10000, help="events per second offered")
+    parser.add_argument("--events-file", help="JSON lines of recorded event headers")
+    parser.add_argument("--publish-rate", type=float, default=5000, help="PUBLISH token bucket rate")
+    parser.add_argument("--sip-delay", type=float, default=0.0, help="seconds before the responder answers")
+    parser.add_argument("--sip-loss", type=float, default=0.0, help="fraction of PUBLISHes left unanswered")
+    parser.add_argument("--requests", type=int, default=20000)
+    args = parser.parse_args()
+
+    if args.scenario in ("calls", "all"):
+        bench_calls(args)
+    if args.scenario in ("events", "all"):
+        bench_events(args)
+    if args.scenario == "async":
+        bench_async(args)
+    if args.scenario in ("xmlcurl", "all"):
+        bench_xmlcurl(args)
+
+
+if __name__ == "__main__":
+    main()
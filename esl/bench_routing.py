@@ -0,0 +1,118 @@
+"""
+Routing benchmark: resolve synthetic inbound calls against many stores.
+
+Half the calls carry X-Store-Domain, half only a DID (in assorted
+formats). "before" is the original linear DID scan plus per-call target
+list and dial-string building; "after" is the prebuilt RoutingIndex.
+
+Usage:
+    python bench_routing.py [--calls 100000] [--stores 5000]
+"""
+
+import argparse
+import logging
+import random
+import time
+
+from call_router import KAMAILIO_HOST, KAMAILIO_PORT, RoutingIndex
+
+logging.getLogger().setLevel(logging.WARNING)
+
+
+def synthetic_stores(count):
+    stores = {}
+    for i in range(count):
+        stores[f"store{i}.local"] = {
+            "did": f"{5550000000 + i}",
+            "caller_id": f"+1{5550000000 + i}",
+            "context": f"store{i}",
+            "extensions": ["1000", "1001", "1002"],
+            "ring_group": ["1000", "1001", "1002"],
+            "park_slots": ["700", "701", "702"],
+        }
+    return stores
+
+
+def synthetic_calls(stores, count):
+    domains = list(stores)
+    formats = ["+1{}", "1{}", "{}", "+1 {}", "{}"]
+    rng = random.Random(42)
+    calls = []
+    for i in range(count):
+        domain = rng.choice(domains)
+        caller_id = f"+1555{rng.randrange(10**7):07d}"
+        if i % 2:
+            calls.append((domain, "", caller_id))
+        else:
+            did = rng.choice(formats).format(stores[domain]["did"])
+            calls.append(("", did, caller_id))
+    return calls
+
+
+def legacy_route(stores, store_domain, did, caller_id):
+    """The lookup path InboundCallHandler used before RoutingIndex"""
+    if not store_domain:
+        normalized = (
+            did.replace("+1", "").replace("-", "").replace(" ", "").replace("+", "")
+        )
+        if normalized.startswith("1") and len(normalized) == 11:
+            normalized = normalized[1:]
+        for domain, config in stores.items():
+            if normalized == config["did"]:
+                store_domain = domain
+                break
+    if store_domain not in stores:
+        return None
+
+    config = stores[store_domain]
+    targets = [
+        f"sofia/internal/{ext}@{KAMAILIO_HOST}:{KAMAILIO_PORT}"
+        for ext in config["ring_group"]
+    ]
+    targets = ",".join(targets)
+    return f"{{leg_timeout=30,origination_caller_id_number={caller_id},sip_invite_domain={store_domain},sip_h_X-Store-Domain={store_domain}}}{targets}"
+
+
+def indexed_route(index, store_domain, did, caller_id):
+    route = index.for_domain(store_domain) if store_domain else index.for_did(did)
+    if route is None:
+        return None
+    return route.bridge_string(caller_id)
+
+
+def run(name, route, calls):
+    start = time.perf_counter()
+    misses = 0
+    for store_domain, did, caller_id in calls:
+        if route(store_domain, did, caller_id) is None:
+            misses += 1
+    elapsed = time.perf_counter() - start
+    rate = len(calls) / elapsed
+    print(f"{name:<7} {len(calls):>8} calls  {elapsed:8.3f}s  {rate:>12,.0f} calls/s  misses={misses}")
+    return rate
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--calls", type=int, default=100000)
+    parser.add_argument("--stores", type=int, default=5000)
+    parser.add_argument(
+        "--skip-legacy", action="store_true", help="only run the indexed path"
+    )
+    args = parser.parse_args()
+
+    stores = synthetic_stores(args.stores)
+    calls = synthetic_calls(stores, args.calls)
+
+    start = time.perf_counter()
+    index = RoutingIndex(stores)
+    print(f"index build: {args.stores} stores in {(time.perf_counter() - start) * 1000:.1f} ms")
+
+    after = run("after", lambda *c: indexed_route(index, *c), calls)
+    if not args.skip_legacy:
+        before = run("before", lambda *c: legacy_route(stores, *c), calls)
+        print(f"speedup {after / before:.1f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -4,13 +4,211 @@ from gevent import monkey
 monkey.patch_all()
 
 import gevent
+import gevent.event
+import gevent.lock
+import gevent.pywsgi
+import gevent.queue
 import greenswitch
+import bisect
+import collections
+import hashlib
+import heapq
+import itertools
+import json
+import os
+import random
+import resource
 import socket
+import sqlite3
+import sys
+import time
 import uuid as uuid_module
 import logging
+import xml.etree.ElementTree as ElementTree
+from types import MappingProxyType
+from urllib.parse import unquote
+from xml.sax.saxutils import escape as xml_escape
+from prometheus_client import CONTENT_TYPE_LATEST, REGISTRY, Counter, Histogram, generate_latest
+from prometheus_client.core import CounterMetricFamily, GaugeMetricFamily
 
-logging.basicConfig(level=logging.DEBUG)
-logger = logging.getLogger(__name__)
+
+# =============================================================================
+# LOGGING (JSON lines, written off the event loop, sampled, runtime levels)
+# =============================================================================
+
+# Records waiting for the writer thread; beyond this they are dropped (and counted)
+LOG_QUEUE_SIZE = int(os.environ.get("LOG_QUEUE_SIZE", "10000"))
+# Per message template: this many records per second get through, then 1 in EVERY
+LOG_SAMPLE_BURST = int(os.environ.get("LOG_SAMPLE_BURST", "20"))
+LOG_SAMPLE_EVERY = int(os.environ.get("LOG_SAMPLE_EVERY", "100"))
+# {"logger name": "LEVEL"}, e.g. {"router.presence": "DEBUG"}; re-read on change
+LOG_LEVELS_FILE = os.environ.get("LOG_LEVELS_FILE", "/etc/fs-ec2/log_levels.json")
+LOG_LEVELS_POLL_INTERVAL = 2
+
+# Real (unpatched) primitives, so the writer is an OS thread that may block
+_NativeQueue = monkey.get_original("queue", "SimpleQueue")
+_start_native_thread = monkey.get_original("_thread", "start_new_thread")
+
+# LogRecord attributes that are not user-supplied `extra` fields
+_RECORD_FIELDS = frozenset(vars(logging.LogRecord("", 0, "", 0, "", (), None))) | {
+    "message",
+    "asctime",
+    "sampled",
+}
+
+
+class JsonLogHandler(logging.Handler):
+    """
+    Hands raw records to a native writer thread.
+
+    The calling greenlet only appends to a queue; message formatting,
+    JSON encoding and the write itself happen on the writer thread, so a
+    slow log pipe never stalls the gevent hub. When the queue is full
+    records are dropped and the count is reported on the next line.
+    """
+
+    def __init__(self, stream=None, maxsize=LOG_QUEUE_SIZE):
+        super().__init__()
+        self.stream = stream or sys.stderr
+        self.maxsize = maxsize
+        self.records = _NativeQueue()
+        self.dropped = 0
+        _start_native_thread(self._write_loop, ())
+
+    def emit(self, record):
+        if self.records.qsize() >= self.maxsize:
+            self.dropped += 1
+            return
+        self.records.put(record)
+
+    def to_json(self, record):
+        entry = {
+            "ts": round(record.created, 6),
+            "level": record.levelname,
+            "logger": record.name,
+            "msg": record.getMessage(),
+        }
+        sampled = getattr(record, "sampled", 0)
+        if sampled:
+            entry["sampled_out"] = sampled
+        for key, value in vars(record).items():
+            if key not in _RECORD_FIELDS:
+                entry[key] = value
+        if record.exc_info:
+            entry["exc"] = logging.Formatter().formatException(record.exc_info)
+        return json.dumps(entry, default=str, ensure_ascii=False)
+
+    def _write_loop(self):
+        while True:
+            record = self.records.get()
+            try:
+                if self.dropped:
+                    dropped, self.dropped = self.dropped, 0
+                    self.stream.write(
+                        json.dumps(
+                            {
+                                "ts": round(record.created, 6),
+                                "level": "WARNING",
+                                "logger": "logging",
+                                "msg": f"log queue full, dropped {dropped} records",
+                            }
+                        )
+                        + "\n"
+                    )
+                self.stream.write(self.to_json(record) + "\n")
+                if self.records.empty():
+                    self.stream.flush()
+            except Exception:
+                # Bad format arguments or a broken stream: report it the
+                # standard way (traceback on stderr) and keep the thread alive
+                self.handleError(record)
+
+
+class LogSampler(logging.Filter):
+    """
+    Rate-limits records per message template (the unformatted msg).
+
+    The first `burst` records of a template in each second pass, then one
+    in `every`; a passing record carries how many were skipped before it.
+    ERROR and above always pass. Use %-style arguments so one call site
+    is one template.
+    """
+
+    MAX_TEMPLATES = 5000
+
+    def __init__(self, burst=LOG_SAMPLE_BURST, every=LOG_SAMPLE_EVERY):
+        super().__init__()
+        self.burst = burst
+        self.every = every
+        # {template: [second, count in that second, skipped since last pass]}
+        self.windows = {}
+
+    def filter(self, record):
+        if record.levelno >= logging.ERROR:
+            return True
+        second = int(record.created)
+        window = self.windows.get(record.msg)
+        if window is None:
+            if len(self.windows) >= self.MAX_TEMPLATES:
+                self.windows.clear()
+            window = self.windows[record.msg] = [second, 0, 0]
+        elif window[0] != second:
+            window[0] = second
+            window[1] = 0
+        window[1] += 1
+        if window[1] <= self.burst or window[1] % self.every == 0:
+            if window[2]:
+                record.sampled = window[2]
+                window[2] = 0
+            return True
+        window[2] += 1
+        return False
+
+
+def apply_log_levels(levels):
+    """Set levels from {"logger name": "LEVEL"}; "" or "root" is the root logger"""
+    for name, level in levels.items():
+        target = logging.getLogger(None if name in ("", "root") else name)
+        target.setLevel(str(level).upper())
+
+
+def watch_log_levels(path=LOG_LEVELS_FILE):
+    """Re-apply LOG_LEVELS_FILE whenever it changes (runs as a greenlet)"""
+    seen = None
+    while True:
+        try:
+            st = os.stat(path)
+            stamp = (st.st_mtime_ns, st.st_size, st.st_ino)
+        except OSError:
+            stamp = None
+        if stamp != seen and stamp is not None:
+            try:
+                with open(path) as f:
+                    apply_log_levels(json.load(f))
+                logger.info("Log levels applied from %s", path)
+            except (OSError, ValueError) as e:
+                logger.error("Bad log levels file %s: %s", path, e)
+        seen = stamp
+        gevent.sleep(LOG_LEVELS_POLL_INTERVAL)
+
+
+def configure_logging(level=os.environ.get("LOG_LEVEL", "INFO")):
+    handler = JsonLogHandler()
+    handler.addFilter(LogSampler())
+    root = logging.getLogger()
+    root.handlers[:] = [handler]
+    root.setLevel(level.upper())
+    return handler
+
+
+configure_logging()
+# One logger per subsystem so levels can be changed independently
+logger = logging.getLogger("router")
+sip_logger = logging.getLogger("router.sip")
+presence_logger = logging.getLogger("router.presence")
+esl_logger = logging.getLogger("router.esl")
+call_logger = logging.getLogger("router.calls")
+cdr_logger = logging.getLogger("router.cdr")
 
 # =============================================================================
 # ARCHITECTURE OVERVIEW
@@ -38,6 +236,7 @@ logger = logging.getLogger(__name__)
 # CONFIGURATION
 # =============================================================================
 
+# Built-in tenants, used only when TENANTS_FILE does not exist
 STORES = {
     "store1.local": {
         "did": "7577828734",
@@ -61,11 +260,550 @@ STORES = {
 # Must use actual IP since services bind to local_ip_v4, not 127.0.0.1
 KAMAILIO_HOST = "10.0.0.135"
 KAMAILIO_PORT = 5060
+# Kamailio jsonrpcs datagram socket; store -> node affinity is pushed here
+KAMAILIO_RPC_ADDRESS = os.environ.get("KAMAILIO_RPC_ADDRESS", "127.0.0.1:9033")
 
-# FreeSWITCH ESL configuration (for Inbound ESL)
+# FreeSWITCH ESL configuration (for Inbound ESL). This is the only node
+# unless the tenant file lists "freeswitch_nodes".
 FREESWITCH_HOST = "127.0.0.1"
 FREESWITCH_ESL_PORT = 8021
 FREESWITCH_ESL_PASSWORD = "ClueCon"
+# Port of the internal SIP profile Kamailio sends calls to
+FREESWITCH_SIP_PORT = 5070
+
+# Shared tenant configuration (same file as the API, see config/tenants.json)
+TENANTS_FILE = os.environ.get("TENANTS_FILE", "/etc/fs-ec2/tenants.json")
+TENANTS_POLL_INTERVAL = 0.5
+
+# Park-slot state survives restarts here (SQLite, WAL mode); "memory"
+# keeps it in-process instead
+PARK_STATE_BACKEND = os.environ.get("PARK_STATE_BACKEND", "sqlite")
+PARK_STATE_DB = os.environ.get("PARK_STATE_DB", "/var/lib/fs-ec2/park_state.db")
+
+
+# =============================================================================
+# METRICS (Prometheus, served on /metrics)
+# =============================================================================
+
+# Seconds. ESL handlers run in microseconds; call setup and SIP
+# transactions take milliseconds up to Timer F (32s)
+FAST_BUCKETS = (0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.05, 0.25)
+SLOW_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 32)
+
+ESL_EVENT_SECONDS = Histogram(
+    "router_esl_event_seconds",
+    "Time spent handling one inbound ESL event",
+    ["event"],
+    buckets=FAST_BUCKETS,
+)
+CALL_SETUP_SECONDS = Histogram(
+    "router_call_setup_seconds",
+    "Outbound ESL connect until the bridge command is accepted",
+    buckets=SLOW_BUCKETS,
+)
+BRIDGE_OUTCOMES = Counter(
+    "router_bridge_outcomes",
+    "Finished bridges by originate disposition",
+    ["cause"],
+)
+SIP_TRANSACTION_SECONDS = Histogram(
+    "router_sip_transaction_seconds",
+    "PUBLISH sent until its final response",
+    buckets=SLOW_BUCKETS,
+)
+SIP_TRANSACTION_TIMEOUTS = Counter(
+    "router_sip_transaction_timeouts",
+    "PUBLISH transactions that reached Timer F",
+)
+
+# Labelled children are resolved once; .labels() costs more than observe()
+_esl_event_timers = {}
+
+
+def esl_event_timer(name):
+    timer = _esl_event_timers.get(name)
+    if timer is None:
+        timer = _esl_event_timers[name] = ESL_EVENT_SECONDS.labels(name)
+    return timer
+
+
+# =============================================================================
+# TENANT CONFIGURATION (hot-reloaded, copy-on-write snapshots)
+# =============================================================================
+
+
+def _freeze(value):
+    """Recursively turn dicts into read-only mappings and lists into tuples"""
+    if isinstance(value, dict):
+        return MappingProxyType({k: _freeze(v) for k, v in value.items()})
+    if isinstance(value, list):
+        return tuple(_freeze(v) for v in value)
+    return value
+
+
+def _normalize_store(config):
+    """Fill in router fields the shared file may leave implicit"""
+    config = dict(config)
+    for key in ("did", "caller_id", "context"):
+        if not config.get(key):
+            raise ValueError(f"missing '{key}'")
+    config.setdefault("extensions", sorted(config.get("users", {})))
+    config.setdefault("ring_group", list(config["extensions"]))
+    config.setdefault("park_slots", [])
+    return config
+
+
+def _normalize_node(config):
+    """FreeSWITCH node entry: {"host": ..., "esl_port": 8021, "sip_port": 5070, ...}"""
+    config = dict(config)
+    if not config.get("host"):
+        raise ValueError("missing 'host'")
+    config["esl_port"] = int(config.get("esl_port", 8021))
+    config["sip_port"] = int(config.get("sip_port", FREESWITCH_SIP_PORT))
+    # Address FreeSWITCH sends and receives SIP on, if not the ESL host
+    config.setdefault("sip_host", config["host"])
+    config.setdefault("password", FREESWITCH_ESL_PASSWORD)
+    return config
+
+
+class TenantSnapshot:
+    """
+    Immutable tenant configuration plus the indexes derived from it.
+
+    A call grabs the current snapshot once and uses it to the end, so a
+    reload never changes data underneath a call in progress.
+    """
+
+    def __init__(self, stores, gateways=None, version=0, nodes=None):
+        stores = {domain: _normalize_store(config) for domain, config in stores.items()}
+        self.stores = _freeze(stores)
+        self.gateways = _freeze(gateways or {})
+        # {node name: node config}; empty = the single FREESWITCH_HOST node
+        self.nodes = _freeze(
+            {name: _normalize_node(config) for name, config in (nodes or {}).items()}
+        )
+        self.version = version
+        self.routing = RoutingIndex(self.stores)
+
+
+class TenantConfig:
+    """
+    Watches TENANTS_FILE and swaps in a new TenantSnapshot when it changes.
+
+    Readers just take `current`; there is no lock on the lookup path. A
+    file that fails to parse is logged and ignored, keeping the previous
+    snapshot.
+    """
+
+    def __init__(self, path, default_stores, poll_interval=TENANTS_POLL_INTERVAL):
+        self.path = path
+        self.poll_interval = poll_interval
+        self._stat = None
+        self._listeners = []
+        self._greenlet = None
+        self.current = self._load() or TenantSnapshot(default_stores)
+
+    def on_change(self, callback):
+        """Call `callback(snapshot)` after every successful reload"""
+        self._listeners.append(callback)
+
+    def start(self):
+        if self._greenlet is None:
+            self._greenlet = gevent.spawn(self._watch)
+
+    def _file_stat(self):
+        try:
+            st = os.stat(self.path)
+        except FileNotFoundError:
+            return None
+        return (st.st_ino, st.st_size, st.st_mtime_ns)
+
+    def _load(self):
+        stat = self._file_stat()
+        if stat is None:
+            return None
+        self._stat = stat
+        try:
+            with open(self.path) as f:
+                data = json.load(f)
+            snapshot = TenantSnapshot(
+                data.get("stores", {}),
+                data.get("gateways", {}),
+                version=stat[2],
+                nodes=data.get("freeswitch_nodes", {}),
+            )
+        except (OSError, ValueError, TypeError, AttributeError) as e:
+            logger.error("Ignoring invalid tenant file %s: %s", self.path, e)
+            return None
+        logger.info("Loaded %d stores from %s", len(snapshot.stores), self.path)
+        return snapshot
+
+    def reload(self):
+        """Reload the file now; returns True if a new snapshot was installed"""
+        snapshot = self._load()
+        if snapshot is None:
+            return False
+        self.current = snapshot
+        for callback in self._listeners:
+            try:
+                callback(snapshot)
+            except Exception:
+                logger.exception("Tenant change listener failed")
+        return True
+
+    def _watch(self):
+        while True:
+            gevent.sleep(self.poll_interval)
+            stat = self._file_stat()
+            if stat is not None and stat != self._stat:
+                self.reload()
+
+
+# =============================================================================
+# SIP TRANSPORT (shared UDP socket for presence PUBLISH)
+# =============================================================================
+
+# RFC 3261 timer values (section 17.1.2.2, non-INVITE client transactions)
+SIP_T1 = 0.5
+SIP_T2 = 4.0
+SIP_TIMER_F = 64 * SIP_T1
+
+# Local port for the presence transport (0 = pick an ephemeral port once)
+PRESENCE_BIND_PORT = 0
+
+# Requested publication lifetime and how early to refresh it (RFC 3903)
+PUBLISH_EXPIRES = 3600
+PUBLISH_REFRESH_MARGIN = 300
+
+
+class SipTransactionTimeout(Exception):
+    """Raised on a transaction future when Timer F fires without a final response"""
+
+
+class SipResponse:
+    """Minimal parsed SIP response (status line + headers)"""
+
+    __slots__ = ("status", "reason", "headers", "raw")
+
+    # Compact header forms (RFC 3261 section 7.3.3) mapped to full names
+    COMPACT = {"v": "via", "i": "call-id", "f": "from", "t": "to", "l": "content-length"}
+
+    def __init__(self, status, reason, headers, raw):
+        self.status = status
+        self.reason = reason
+        self.headers = headers
+        self.raw = raw
+
+    @classmethod
+    def parse(cls, data):
+        """Parse a datagram, returning None if it is not a SIP response"""
+        head = data.split(b"\r\n\r\n", 1)[0].decode("utf-8", "replace")
+        lines = head.split("\r\n")
+        parts = lines[0].split(" ", 2)
+        if len(parts) < 2 or parts[0] != "SIP/2.0" or not parts[1].isdigit():
+            return None
+
+        headers = {}
+        for line in lines[1:]:
+            name, sep, value = line.partition(":")
+            if not sep:
+                continue
+            name = name.strip().lower()
+            name = cls.COMPACT.get(name, name)
+            # Only the topmost Via matters for matching
+            if name not in headers:
+                headers[name] = value.strip()
+
+        reason = parts[2] if len(parts) > 2 else ""
+        return cls(int(parts[1]), reason, headers, data)
+
+    @property
+    def branch(self):
+        via = self.headers.get("via", "")
+        for param in via.split(";")[1:]:
+            key, _, value = param.partition("=")
+            if key.strip().lower() == "branch":
+                return value.strip()
+        return None
+
+    @property
+    def call_id(self):
+        return self.headers.get("call-id")
+
+
+class _SipTransaction:
+    """State for one outstanding non-INVITE client transaction"""
+
+    __slots__ = (
+        "branch",
+        "call_id",
+        "data",
+        "started",
+        "interval",
+        "next_send",
+        "deadline",
+        "result",
+    )
+
+    def __init__(self, branch, call_id, data, now):
+        self.branch = branch
+        self.call_id = call_id
+        self.data = data
+        self.started = now
+        self.interval = SIP_T1
+        self.next_send = now + SIP_T1
+        self.deadline = now + SIP_TIMER_F
+        self.result = gevent.event.AsyncResult()
+
+
+class SipTransport:
+    """
+    Long-lived UDP transport for outgoing SIP requests.
+
+    One socket is bound for the life of the process. A receive greenlet
+    matches responses to pending transactions by Via branch (falling back
+    to Call-ID), and a timer greenlet drives Timer E retransmissions and
+    Timer F expiry. Callers get an AsyncResult per request and never block
+    on the network themselves.
+    """
+
+    TICK = 0.05
+
+    def __init__(self, remote_host, remote_port, bind_host="0.0.0.0", bind_port=PRESENCE_BIND_PORT):
+        self.remote = (remote_host, remote_port)
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        # Room for a burst of responses while the hub is busy sending
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 1 << 20)
+        self.sock.bind((bind_host, bind_port))
+        self.local_port = self.sock.getsockname()[1]
+        # {branch: _SipTransaction}
+        self.pending = {}
+        self._by_call_id = {}
+        self._timers = []
+        self._greenlets = []
+        self.stats = {"sent": 0, "retransmits": 0, "responses": 0, "timeouts": 0, "unmatched": 0}
+
+    def start(self):
+        if not self._greenlets:
+            self._greenlets = [gevent.spawn(self._receive_loop), gevent.spawn(self._timer_loop)]
+
+    def stop(self):
+        gevent.killall(self._greenlets)
+        self._greenlets = []
+        self.sock.close()
+        for tx in list(self.pending.values()):
+            self._finish(tx, exception=SipTransactionTimeout("transport stopped"))
+
+    def send_request(self, data, branch, call_id):
+        """Send an encoded request and return an AsyncResult for its final response"""
+        tx = _SipTransaction(branch, call_id, data, time.monotonic())
+        self.pending[branch] = tx
+        self._by_call_id[call_id] = tx
+        heapq.heappush(self._timers, (tx.next_send, branch))
+        self._sendto(data)
+        self.stats["sent"] += 1
+        return tx.result
+
+    def _sendto(self, data):
+        try:
+            self.sock.sendto(data, self.remote)
+        except OSError as e:
+            sip_logger.error("Failed to send SIP request: %s", e)
+
+    def _finish(self, tx, response=None, exception=None):
+        self.pending.pop(tx.branch, None)
+        self._by_call_id.pop(tx.call_id, None)
+        if exception is not None:
+            tx.result.set_exception(exception)
+        else:
+            SIP_TRANSACTION_SECONDS.observe(time.monotonic() - tx.started)
+            tx.result.set(response)
+
+    def _receive_loop(self):
+        while True:
+            try:
+                data, addr = self.sock.recvfrom(65535)
+            except OSError as e:
+                sip_logger.error("SIP transport receive error: %s", e)
+                gevent.sleep(SIP_T1)
+                continue
+
+            response = SipResponse.parse(data)
+            if response is None:
+                continue
+            self.stats["responses"] += 1
+
+            tx = self.pending.get(response.branch) or self._by_call_id.get(response.call_id)
+            if tx is None:
+                # Late retransmitted response for a finished transaction
+                self.stats["unmatched"] += 1
+                continue
+
+            if response.status < 200:
+                # Proceeding: keep Timer F but retransmit at T2 only
+                tx.interval = SIP_T2
+            else:
+                self._finish(tx, response=response)
+
+    def _timer_loop(self):
+        timers = self._timers
+        while True:
+            gevent.sleep(self.TICK)
+            now = time.monotonic()
+            while timers and timers[0][0] <= now:
+                _, branch = heapq.heappop(timers)
+                tx = self.pending.get(branch)
+                if tx is None:
+                    continue
+                if now >= tx.deadline:
+                    self.stats["timeouts"] += 1
+                    SIP_TRANSACTION_TIMEOUTS.inc()
+                    self._finish(tx, exception=SipTransactionTimeout(branch))
+                    continue
+                # Timer E: double the interval up to T2
+                self._sendto(tx.data)
+                self.stats["retransmits"] += 1
+                tx.interval = min(tx.interval * 2, SIP_T2)
+                tx.next_send = min(now + tx.interval, tx.deadline)
+                heapq.heappush(timers, (tx.next_send, branch))
+
+
+# =============================================================================
+# PUBLISH MESSAGE BUILDER (pre-encoded dialog-info templates)
+# =============================================================================
+
+
+def _xml_escape(value):
+    """Escape text for use in XML element content or a double-quoted attribute"""
+    return xml_escape(str(value), {'"': "&quot;"})
+
+
+class SipIdGenerator:
+    """Cheap unique tokens for branch, tag and Call-ID values"""
+
+    def __init__(self):
+        # A random per-process prefix keeps tokens unique across restarts
+        self.prefix = uuid_module.uuid4().hex[:8]
+        self._counter = itertools.count(1)
+
+    def next(self):
+        return f"{self.prefix}{next(self._counter):x}"
+
+
+class PublishMessageBuilder:
+    """
+    Builds dialog-info PUBLISH requests from cached byte fragments.
+
+    Everything that only depends on the entity (request line, From/To,
+    the <local> block) is encoded once and reused; each message only
+    encodes the version, state, remote identity and the fresh tokens.
+    Content-Length is taken from the encoded body.
+    """
+
+    XML_HEAD = (
+        b'<?xml version="1.0" encoding="UTF-8"?>\n'
+        b'<dialog-info xmlns="urn:ietf:params:xml:ns:dialog-info" version="'
+    )
+    XML_TAIL = b"\n  </dialog>\n</dialog-info>"
+    CONTENT_TYPE = b"Content-Type: application/dialog-info+xml\r\nContent-Length: "
+    NO_CONTENT = b"Content-Length: 0\r\n\r\n"
+
+    def __init__(self, local_ip, local_port, contact_port=5080):
+        self.local_ip = local_ip
+        self.ids = SipIdGenerator()
+        self._via = (
+            f"Via: SIP/2.0/UDP {local_ip}:{local_port};rport;branch=".encode()
+        )
+        self._call_id_host = f"@{local_ip}".encode()
+        self._trailer = (
+            f" PUBLISH\r\nContact: <sip:freeswitch@{local_ip}:{contact_port}>\r\n"
+            f"Event: dialog\r\nExpires: {PUBLISH_EXPIRES}\r\n"
+        ).encode()
+        # {entity: tuple of pre-encoded fragments}
+        self._entities = {}
+
+    def _fragments(self, entity, local_user):
+        parts = self._entities.get(entity)
+        if parts is None:
+            uri = _xml_escape(entity)
+            parts = (
+                f"PUBLISH {entity} SIP/2.0\r\n".encode(),
+                f"\r\nMax-Forwards: 70\r\nFrom: <{entity}>;tag=".encode(),
+                f"\r\nTo: <{entity}>\r\nCall-ID: presence-".encode(),
+                f'" state="full" entity="{uri}">\n  <dialog id="'.encode(),
+                (
+                    f"</state>\n    <local>\n"
+                    f'      <identity display="{_xml_escape(local_user)}">{uri}</identity>\n'
+                    f'      <target uri="{uri}"/>\n    </local>'
+                ).encode(),
+            )
+            self._entities[entity] = parts
+        return parts
+
+    def dialog_info(
+        self,
+        entity,
+        local_user,
+        domain,
+        state,
+        version,
+        remote_info=None,
+        direction="recipient",
+    ):
+        """Encode a dialog-info+xml document for one entity"""
+        parts = self._fragments(entity, local_user)
+        chunks = [
+            self.XML_HEAD,
+            str(version).encode(),
+            parts[3],
+            self.ids.next().encode(),
+            b'" direction="',
+            direction.encode(),
+            b'">\n    <state>',
+            state.encode(),
+            parts[4],
+        ]
+        if remote_info:
+            display = _xml_escape(remote_info)
+            uri = _xml_escape(f"sip:{remote_info}@{domain}")
+            chunks.append(
+                (
+                    f"\n    <remote>\n"
+                    f'      <identity display="{display}">{uri}</identity>\n'
+                    f'      <target uri="{uri}"/>\n    </remote>'
+                ).encode()
+            )
+        chunks.append(self.XML_TAIL)
+        return b"".join(chunks)
+
+    def publish(self, entity, local_user, cseq, body=None, etag=None):
+        """Encode a PUBLISH request; returns (data, branch, call_id)"""
+        parts = self._fragments(entity, local_user)
+        token = self.ids.next().encode()
+        branch = b"z9hG4bK" + token
+        call_id = b"presence-" + token + self._call_id_host
+
+        chunks = [
+            parts[0],
+            self._via,
+            branch,
+            parts[1],
+            token,
+            parts[2],
+            token,
+            self._call_id_host,
+            b"\r\nCSeq: ",
+            str(cseq).encode(),
+            self._trailer,
+        ]
+        if etag:
+            chunks.append(b"SIP-If-Match: " + etag.encode() + b"\r\n")
+        if body is None:
+            chunks.append(self.NO_CONTENT)
+        else:
+            chunks += [self.CONTENT_TYPE, str(len(body)).encode(), b"\r\n\r\n", body]
+
+        return b"".join(chunks), branch.decode(), call_id.decode()
 
 
 # =============================================================================
@@ -80,11 +818,30 @@ class PresencePublisher:
         self.kamailio_host = kamailio_host
         self.kamailio_port = kamailio_port
         self.local_ip = self._get_local_ip()
+        self.transport = SipTransport(kamailio_host, kamailio_port)
+        self.transport.start()
+        self.builder = PublishMessageBuilder(self.local_ip, self.transport.local_port)
         self.cseq_counter = 1
+        # RFC 3903 entity tags from 2xx responses: {entity: (etag, domain, expires_at)}
+        self.etags = {}
+        # Last dialog state sent per entity, to rebuild a full PUBLISH when
+        # a refresh finds the publication gone:
+        # {entity: (local_user, domain, state, remote_info, direction)}
+        self.dialogs = {}
+        # Called as on_result(entity, status) when a PUBLISH transaction
+        # ends; status is None on timeout. Not called for a 412 that is
+        # recovered by republishing.
+        self.on_result = None
         # Track parked calls: {domain: {slot: caller_info}}
         self.parked_calls = {}
-        for domain, config in STORES.items():
-            self.parked_calls[domain] = {slot: None for slot in config["park_slots"]}
+        self.add_stores(tenants.current.stores)
+
+    def add_stores(self, stores):
+        """Start tracking park slots for stores (existing slot state is kept)"""
+        for domain, config in stores.items():
+            slots = self.parked_calls.setdefault(domain, {})
+            for slot in config["park_slots"]:
+                slots.setdefault(slot, None)
 
     def _get_local_ip(self):
         """Get local IP address"""
@@ -101,79 +858,116 @@ class PresencePublisher:
         """Publish parking slot status to Kamailio"""
         entity = f"sip:{slot}@{domain}"
         state = "confirmed" if is_parked else "terminated"
-
-        dialog_info = self._generate_dialog_info(
-            entity, slot, domain, state, caller_info
-        )
-        self._send_publish(entity, domain, dialog_info)
+        result = self._publish_dialog(entity, slot, domain, state, caller_info)
 
         # Update local tracking
         if domain in self.parked_calls:
             self.parked_calls[domain][slot] = caller_info if is_parked else None
 
-    def _generate_dialog_info(
-        self, entity, local_user, domain, state, remote_info=None
+        return result
+
+    def publish_extension_status(
+        self, extension, domain, state, remote_info=None, direction="recipient"
     ):
-        """Generate dialog-info+xml body"""
-        dialog_id = str(uuid_module.uuid4())
-        self.cseq_counter += 1
+        """Publish an extension's dialog state (early/confirmed/terminated)"""
+        entity = f"sip:{extension}@{domain}"
+        return self._publish_dialog(entity, extension, domain, state, remote_info, direction)
 
-        body = f"""<?xml version="1.0" encoding="UTF-8"?>
-<dialog-info xmlns="urn:ietf:params:xml:ns:dialog-info" version="{self.cseq_counter}" state="full" entity="{entity}">
-  <dialog id="{dialog_id}" direction="recipient">
-    <state>{state}</state>
-    <local>
-      <identity display="{local_user}">{entity}</identity>
-      <target uri="{entity}"/>
-    </local>"""
+    def forget(self, entity):
+        """Stop refreshing a publication (its extension or slot is gone)"""
+        self.etags.pop(entity, None)
+        self.dialogs.pop(entity, None)
 
-        if remote_info:
-            body += f"""
-    <remote>
-      <identity display="{remote_info}">sip:{remote_info}@{domain}</identity>
-      <target uri="sip:{remote_info}@{domain}"/>
-    </remote>"""
+    def refresh(self, entity, domain):
+        """Extend an existing publication with a body-less SIP-If-Match PUBLISH"""
+        if entity not in self.etags:
+            return None
+        return self._send_publish(entity, domain, None)
 
-        body += """
-  </dialog>
-</dialog-info>"""
+    def expiring_entities(self, margin=PUBLISH_REFRESH_MARGIN):
+        """Entities whose publication expires within `margin` seconds"""
+        cutoff = time.monotonic() + margin
+        return [
+            (entity, domain)
+            for entity, (etag, domain, expires_at) in self.etags.items()
+            if expires_at <= cutoff
+        ]
 
-        return body
+    def _generate_dialog_info(
+        self, entity, local_user, domain, state, remote_info=None, direction="recipient"
+    ):
+        """Generate dialog-info+xml body (encoded bytes)"""
+        self.cseq_counter += 1
+        return self.builder.dialog_info(
+            entity, local_user, domain, state, self.cseq_counter, remote_info, direction
+        )
+
+    def _publish_dialog(self, entity, local_user, domain, state, remote_info=None, direction="recipient"):
+        """Publish a full dialog-info body and remember it for rebuilds"""
+        self.dialogs[entity] = (local_user, domain, state, remote_info, direction)
+        body = self._generate_dialog_info(entity, local_user, domain, state, remote_info, direction)
+        return self._send_publish(entity, domain, body)
 
     def _send_publish(self, entity, domain, body):
-        """Send a SIP PUBLISH request via UDP to Kamailio"""
-        call_id = f"presence-{self.cseq_counter}-{uuid_module.uuid4().hex[:8]}@{self.local_ip}"
-
-        request = f"""PUBLISH {entity} SIP/2.0\r
-Via: SIP/2.0/UDP {self.local_ip}:5080;rport;branch=z9hG4bK{uuid_module.uuid4().hex[:16]}\r
-Max-Forwards: 70\r
-From: <{entity}>;tag={uuid_module.uuid4().hex[:8]}\r
-To: <{entity}>\r
-Call-ID: {call_id}\r
-CSeq: {self.cseq_counter} PUBLISH\r
-Contact: <sip:freeswitch@{self.local_ip}:5080>\r
-Event: dialog\r
-Expires: 3600\r
-Content-Type: application/dialog-info+xml\r
-Content-Length: {len(body)}\r
-\r
-{body}"""
+        """
+        Queue a SIP PUBLISH on the shared transport and return its AsyncResult.
 
-        try:
-            sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-            sock.sendto(request.encode(), (self.kamailio_host, self.kamailio_port))
-            sock.settimeout(2)
+        If Kamailio already gave us an entity tag the request carries
+        SIP-If-Match, so it modifies (body) or refreshes (no body) the
+        existing publication instead of creating a new one.
+        """
+        known = self.etags.get(entity)
+        local_user = entity[4:].split("@", 1)[0]
+        request, branch, call_id = self.builder.publish(
+            entity,
+            local_user,
+            self.cseq_counter,
+            body,
+            known[0] if known else None,
+        )
 
-            try:
-                response, addr = sock.recvfrom(4096)
-                logger.debug(f"PUBLISH response: {response.decode()[:100]}")
-            except socket.timeout:
-                logger.warning("No response to PUBLISH (timeout)")
+        result = self.transport.send_request(request, branch, call_id)
+        result.rawlink(lambda r: self._on_publish_result(entity, domain, body, r))
+        return result
 
-            sock.close()
-            logger.info(f"📡 Published presence for {entity}")
-        except Exception as e:
-            logger.error(f"Failed to send PUBLISH: {e}")
+    def _on_publish_result(self, entity, domain, body, result):
+        """Record the entity tag from a PUBLISH transaction and log the outcome"""
+        if not result.successful():
+            presence_logger.warning("No response to PUBLISH for %s (timeout)", entity)
+            self._result(entity, None)
+            return
+
+        response = result.value
+        if response.status < 300:
+            etag = response.headers.get("sip-etag")
+            if etag:
+                expires = response.headers.get("expires", "")
+                ttl = int(expires) if expires.isdigit() else PUBLISH_EXPIRES
+                self.etags[entity] = (etag, domain, time.monotonic() + ttl)
+            presence_logger.debug("📡 Published presence for %s", entity)
+            self._result(entity, response.status)
+        elif response.status == 412 and entity in self.etags:
+            # Conditional Request Failed: Kamailio lost our publication.
+            # A modify is resent as is; a refresh has no body, so build a
+            # fresh initial PUBLISH from the last state we sent
+            del self.etags[entity]
+            if body is not None:
+                presence_logger.info("Stale ETag for %s, republishing", entity)
+                self._send_publish(entity, domain, body)
+            elif entity in self.dialogs:
+                presence_logger.info("Publication for %s expired, republishing", entity)
+                self._publish_dialog(entity, *self.dialogs[entity])
+            else:
+                self._result(entity, response.status)
+        else:
+            presence_logger.warning(
+                "PUBLISH for %s rejected: %s %s", entity, response.status, response.reason
+            )
+            self._result(entity, response.status)
+
+    def _result(self, entity, status):
+        if self.on_result is not None:
+            self.on_result(entity, status)
 
 
 # Global presence publisher instance
@@ -181,291 +975,3144 @@ presence_publisher = None
 
 
 # =============================================================================
-# INBOUND ESL EVENT HANDLER (for system-wide events)
+# PRESENCE DISPATCHER (coalesces BLF updates before they reach Kamailio)
 # =============================================================================
 
+# Updates for the same entity within this window collapse into one PUBLISH
+PRESENCE_COALESCE_WINDOW = 0.1
+# Flush early once this many entities are waiting
+PRESENCE_FLUSH_THRESHOLD = 500
+# How often to look for publications that need a refresh
+PRESENCE_REFRESH_INTERVAL = 30
+# Sustained PUBLISH rate toward Kamailio (per second) and burst allowance
+PRESENCE_PUBLISH_RATE = float(os.environ.get("PRESENCE_PUBLISH_RATE", "200"))
+PRESENCE_PUBLISH_BURST = int(os.environ.get("PRESENCE_PUBLISH_BURST", "400"))
+# PUBLISHes that time out or get a 5xx/412 are retried with exponential
+# backoff (seconds), at most this many times; other failures are final
+PRESENCE_RETRY_BASE = 1.0
+PRESENCE_RETRY_MAX_DELAY = 60.0
+PRESENCE_MAX_RETRIES = 5
 
-def handle_esl_event(event):
-    """Handle events from FreeSWITCH Inbound ESL"""
-    global presence_publisher
 
-    # ESLEvent uses .headers dict to access header fields
-    headers = event.headers if hasattr(event, "headers") else {}
+class TokenBucket:
+    """Classic token bucket; take() never blocks"""
 
-    event_name = headers.get("Event-Name")
-    event_subclass = headers.get("Event-Subclass")
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
 
-    logger.debug(f"ESL Event: {event_name} / {event_subclass}")
+    def _fill(self):
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
 
-    # Handle valet parking events
-    if event_subclass and "valet_parking" in event_subclass:
-        handle_park_event(event)
+    def take(self):
+        self._fill()
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return True
+        return False
 
-    # Handle channel events for extension BLF (optional)
-    elif event_name in ["CHANNEL_ANSWER", "CHANNEL_HANGUP_COMPLETE"]:
-        handle_channel_event(event)
+    def delay(self):
+        """Seconds until the next token is available"""
+        self._fill()
+        return max(0.0, (1 - self.tokens) / self.rate)
 
 
-def handle_park_event(event):
-    """Handle valet parking events for BLF"""
-    global presence_publisher
+class PresenceDispatcher:
+    """
+    Keeps only the latest dialog state per entity and publishes it in
+    batches, at most PRESENCE_PUBLISH_RATE PUBLISHes per second.
 
-    if not presence_publisher:
-        return
+    Entities are park slots (submit) and extensions (submit_extension).
+    A slot that flips hold -> bridge -> hold inside one window turns into
+    a single PUBLISH (or none, if it ends where it started). When the
+    token bucket runs dry the rest of a batch stays pending, so a
+    backlog never holds more than one entry per entity and newer states
+    overwrite older ones while they wait. Publications that are about to
+    expire are refreshed with SIP-If-Match instead of being sent again
+    in full.
+    """
 
-    # ESLEvent uses .headers dict to access header fields
-    headers = event.headers if hasattr(event, "headers") else {}
+    def __init__(
+        self,
+        publisher,
+        window=PRESENCE_COALESCE_WINDOW,
+        threshold=PRESENCE_FLUSH_THRESHOLD,
+        rate=PRESENCE_PUBLISH_RATE,
+        burst=PRESENCE_PUBLISH_BURST,
+    ):
+        self.publisher = publisher
+        self.window = window
+        self.threshold = threshold
+        self.bucket = TokenBucket(rate, burst)
+        # {(domain, user): ("park", is_parked, caller_info)
+        #                | ("extension", state, remote_info, direction)}
+        self.pending = {}
+        self.published = {}
+        self.stats = {
+            "events": 0,
+            "coalesced": 0,
+            "unchanged": 0,
+            "publishes": 0,
+            "deferred": 0,
+            "refreshes": 0,
+            "retries": 0,
+            "abandoned": 0,
+            "flushes": 0,
+        }
+        self._has_pending = gevent.event.Event()
+        self._full = gevent.event.Event()
+        self._next_refresh = 0.0
+        self._greenlet = None
+        # {(domain, user): (consecutive failed PUBLISHes, state to retry)}
+        self.failures = {}
+        publisher.on_result = self._publish_result
 
-    action = headers.get("Action")
-    valet_lot = headers.get("Valet-Lot-Name") or headers.get("variable_valet_lot")
-    valet_extension = headers.get("Valet-Extension") or headers.get(
-        "variable_valet_extension"
-    )
-    caller_id = headers.get("Caller-Caller-ID-Number", "Unknown")
+    def start(self):
+        if self._greenlet is None:
+            self._greenlet = gevent.spawn(self._run)
 
-    if not valet_lot or not valet_extension:
-        logger.debug(f"Ignoring park event without lot/extension info")
-        return
+    @staticmethod
+    def _retryable(status):
+        """Timeouts, server errors and a 412 that could not be recovered"""
+        return status is None or status >= 500 or status == 412
 
-    # Determine domain from lot name
-    domain = valet_lot if valet_lot in STORES else None
-    if not domain:
-        logger.warning(f"Unknown valet lot: {valet_lot}")
-        return
+    def _publish_result(self, entity, status):
+        """
+        Outcome of a PUBLISH for `entity`. On failure Kamailio does not
+        have our state, so it is forgotten as published; transient
+        failures are retried after a backoff, permanent ones (most 4xx)
+        are dropped until the entity changes again. Runs from the
+        transaction callback, so it never blocks.
+        """
+        user, _, domain = entity[4:].partition("@")
+        key = (domain, user)
+        if status is not None and status < 300:
+            self.failures.pop(key, None)
+            return
 
-    if action == "hold":
-        logger.info(
-            f"📦 Call PARKED in {domain} slot {valet_extension} (caller: {caller_id})"
-        )
-        presence_publisher.publish_park_status(valet_extension, domain, True, caller_id)
-    elif action == "bridge":
-        logger.info(f"📤 Call RETRIEVED from {domain} slot {valet_extension}")
-        presence_publisher.publish_park_status(valet_extension, domain, False)
+        state = self.published.pop(key, None)
+        failures = self.failures.get(key, (0, None))[0] + 1
+        if not self._retryable(status) or failures > PRESENCE_MAX_RETRIES:
+            self.failures.pop(key, None)
+            self.stats["abandoned"] += 1
+            presence_logger.warning(
+                "Giving up on presence for %s after %d failed PUBLISH(es) (last: %s)",
+                entity,
+                failures,
+                status or "timeout",
+            )
+            return
 
+        entry = self.failures[key] = (failures, state)
+        if state is not None:
+            delay = min(PRESENCE_RETRY_MAX_DELAY, PRESENCE_RETRY_BASE * 2 ** (failures - 1))
+            gevent.spawn_later(delay, self._retry, key, entry)
 
-def handle_channel_event(event):
-    """Handle channel events for extension presence (optional)"""
-    # This can be extended to publish extension status to Kamailio
-    pass
+    def _retry(self, key, entry):
+        # Only the latest failure's retry counts, and anything submitted
+        # since then is newer and wins
+        if self.failures.get(key) is entry and key not in self.pending:
+            self.stats["retries"] += 1
+            self.pending[key] = entry[1]
+            self._has_pending.set()
 
+    def _submit(self, key, state):
+        self.stats["events"] += 1
+        # A new state starts with a clean retry budget
+        self.failures.pop(key, None)
+        if key in self.pending:
+            self.stats["coalesced"] += 1
+        self.pending[key] = state
+        self._has_pending.set()
+        if len(self.pending) >= self.threshold:
+            self._full.set()
 
-def run_inbound_esl():
-    """Run Inbound ESL client to listen for system events"""
-    global presence_publisher
+    def submit(self, domain, slot, is_parked, caller_info=None):
+        """Record the latest state for a slot; it is published on the next flush"""
+        self._submit((domain, slot), ("park", is_parked, caller_info if is_parked else None))
 
-    presence_publisher = PresencePublisher(KAMAILIO_HOST, KAMAILIO_PORT)
-    logger.info(
-        f"📡 Presence publisher initialized (Kamailio: {KAMAILIO_HOST}:{KAMAILIO_PORT})"
-    )
+    def submit_extension(
+        self, domain, extension, state, remote_info=None, direction="recipient"
+    ):
+        """Record the latest dialog state (early/confirmed/terminated) for an extension"""
+        if state == "terminated":
+            remote_info = None
+            direction = "recipient"
+        self._submit((domain, extension), ("extension", state, remote_info, direction))
 
-    while True:
-        try:
-            logger.info(
-                f"🔌 Connecting to FreeSWITCH ESL ({FREESWITCH_HOST}:{FREESWITCH_ESL_PORT})..."
-            )
+    def flush(self):
+        """Publish pending entities whose state differs from what Kamailio has"""
+        pending, self.pending = self.pending, {}
+        self._has_pending.clear()
+        self._full.clear()
+        if not pending:
+            return
 
-            # Create Inbound ESL connection
-            inbound = greenswitch.InboundESL(
-                host=FREESWITCH_HOST,
-                port=FREESWITCH_ESL_PORT,
-                password=FREESWITCH_ESL_PASSWORD,
-            )
+        self.stats["flushes"] += 1
+        items = iter(pending.items())
+        for key, state in items:
+            if self.published.get(key) == state:
+                self.stats["unchanged"] += 1
+                continue
+            if not self.bucket.take():
+                # Out of budget: keep the rest for the next flush, letting
+                # anything submitted meanwhile win
+                deferred = dict(itertools.chain(((key, state),), items))
+                self.stats["deferred"] += len(deferred)
+                deferred.update(self.pending)
+                self.pending = deferred
+                self._has_pending.set()
+                return
+            # Counted as published while in flight so repeats are deduped;
+            # _publish_result takes it back if Kamailio never accepts it
+            self.published[key] = state
+            domain, user = key
+            if state[0] == "park":
+                self.publisher.publish_park_status(user, domain, *state[1:])
+            else:
+                self.publisher.publish_extension_status(user, domain, *state[1:])
+            self.stats["publishes"] += 1
 
-            # Register event handler before connecting
-            def on_event(event):
-                gevent.spawn(handle_esl_event, event)
+    def refresh_expiring(self):
+        """Send SIP-If-Match refreshes for publications close to expiry"""
+        for entity, domain in self.publisher.expiring_entities():
+            if not self.bucket.take():
+                # Refresh margin is minutes; the rest go out next round
+                break
+            self.publisher.refresh(entity, domain)
+            self.stats["refreshes"] += 1
 
-            inbound.register_handle("*", on_event)
-            inbound.connect()
-            logger.info("✅ Connected to FreeSWITCH ESL")
+    def prune(self, stores):
+        """Forget entities whose store, extension or slot was removed"""
+        for key in [k for k in self.published if not self._known(stores, k)]:
+            del self.published[key]
+            self.publisher.forget(f"sip:{key[1]}@{key[0]}")
+        for key in [k for k in self.pending if not self._known(stores, k)]:
+            del self.pending[key]
+        for key in [k for k in self.failures if not self._known(stores, k)]:
+            del self.failures[key]
 
-            # Subscribe to events
-            inbound.send("event plain CUSTOM valet_parking::info")
-            inbound.send("event plain CHANNEL_ANSWER CHANNEL_HANGUP_COMPLETE")
-            logger.info("📋 Subscribed to parking and channel events")
+    @staticmethod
+    def _known(stores, key):
+        store = stores.get(key[0])
+        return store is not None and (
+            key[1] in store["extensions"] or key[1] in store["park_slots"]
+        )
 
-            # Keep the connection alive - greenswitch handles events via callbacks
-            while inbound.connected:
-                gevent.sleep(1)
+    def _run(self):
+        while True:
+            try:
+                if self._has_pending.wait(timeout=PRESENCE_REFRESH_INTERVAL):
+                    # Give the window a chance to absorb more transitions
+                    self._full.wait(timeout=self.window)
+                    self.flush()
+                    if self.pending:
+                        # Rate limited: wait for tokens, still coalescing
+                        gevent.sleep(max(self.window, self.bucket.delay()))
+                if time.monotonic() >= self._next_refresh:
+                    self._next_refresh = time.monotonic() + PRESENCE_REFRESH_INTERVAL
+                    self.refresh_expiring()
+            except Exception:
+                presence_logger.exception("Presence dispatcher flush failed")
 
-            logger.warning("ESL connection lost")
 
-        except Exception as e:
-            logger.error(f"ESL connection error: {e}")
-            logger.info("Reconnecting in 5 seconds...")
-            gevent.sleep(5)
+# Global presence dispatcher instance
+presence_dispatcher = None
 
 
 # =============================================================================
-# ROUTING LOGIC
+# PARK STATE STORE (survives ESL reconnects and process restarts)
 # =============================================================================
 
 
-def get_route_for_inbound_call(store_domain, caller_id):
+class ParkStateBackend:
     """
-    Get routing decision for an inbound call from SIP trunk (via Kamailio).
+    Which park slots hold a call, per FreeSWITCH node.
 
-    In the new architecture:
-    - Calls come from Kamailio with X-Store-Domain header
-    - We route to the ring group for that store
-    - Calls go back to Kamailio for delivery to phones
+    Valet lots live inside one FreeSWITCH, so rows are kept per node and
+    merged for BLF: a slot is lit if any node holds a call in it (the
+    most recent one wins). Hold/bridge events are single-row writes. On
+    every (re)connect a node's rows are reconciled against its
+    `valet_info` in one pass (see recover_park_state); slots touched by
+    live events while a reconcile is in flight are left as the events
+    set them.
+
+    Subclasses store the rows: ParkStateStore in SQLite (survives
+    restarts, can be shared by processes on one host),
+    MemoryParkStateStore in-process. A networked store only needs the
+    same six methods.
     """
-    if store_domain not in STORES:
-        logger.warning(f"Unknown store domain: {store_domain}")
-        return {"action": "reject", "reason": f"Unknown store: {store_domain}"}
 
-    config = STORES[store_domain]
+    def __init__(self):
+        # {node: keys changed by events during its reconcile}
+        self._touched = {}
 
-    # Build bridge targets - route through Kamailio
-    # Kamailio will do location lookup and deliver to phones
-    targets = [
-        f"sofia/internal/{ext}@{KAMAILIO_HOST}:{KAMAILIO_PORT}"
-        for ext in config["ring_group"]
-    ]
+    def _touch(self, node, domain, slot):
+        touched = self._touched.get(node)
+        if touched is not None:
+            touched.add((domain, slot))
 
-    logger.info(f"Routing inbound call for {store_domain}: {targets}")
+    def begin_reconcile(self, node):
+        self._touched[node] = set()
 
-    return {
-        "action": "bridge",
-        "targets": targets,
-        "context": config["context"],
-        "domain": store_domain,
-        "sip_invite_domain": store_domain,
-    }
+    def finish_reconcile(self, node, occupied):
+        """
+        Replace `node`'s rows with `occupied` ({(domain, slot): (uuid,
+        caller_info)}) except for slots events changed since
+        begin_reconcile(). Returns the node's resulting state.
+        """
+        touched = self._touched.pop(node, None) or set()
+        current = self.load(node)
+        state = {key: value for key, value in occupied.items() if key not in touched}
+        state.update((key, current[key]) for key in touched if key in current)
+        self._replace(node, state)
+        return state
 
 
-# =============================================================================
-# OUTBOUND ESL CALL HANDLER
-# =============================================================================
+class MemoryParkStateStore(ParkStateBackend):
+    """Park state in process memory (tests, or when nothing may touch disk)"""
 
+    path = ":memory:"
 
-class InboundCallHandler(object):
-    """
-    Handle inbound calls from FreeSWITCH via Outbound ESL.
+    def __init__(self):
+        super().__init__()
+        # {node: {(domain, slot): (uuid, caller_info, parked_at)}}
+        self.rows = {}
 
-    In the new architecture, this handles calls that come from Kamailio
-    (from SIP trunk) and routes them to the appropriate ring group,
-    sending the call back through Kamailio to reach registered phones.
-    """
+    def load(self, node=None):
+        """{(domain, slot): (uuid, caller_info)} for one node, or merged over all"""
+        nodes = [self.rows.get(node, {})] if node is not None else self.rows.values()
+        rows = sorted(
+            (row[2], key, row[:2]) for slots in nodes for key, row in slots.items()
+        )
+        return {key: value for _, key, value in rows}
 
-    def __init__(self, session):
-        self.session = session
-        logger.info("🔌 New FreeSWITCH connection received!")
+    def slot(self, domain, slot):
+        """(uuid, caller_info) of the most recent call parked in a slot, or None"""
+        held = [
+            slots[(domain, slot)] for slots in self.rows.values() if (domain, slot) in slots
+        ]
+        return max(held, key=lambda row: row[2])[:2] if held else None
 
-    def run(self):
-        """Main function called when FreeSWITCH connects for a call"""
-        try:
-            self.handle_call()
-        except:
-            logger.exception("Exception raised when handling call")
-            self.session.stop()
+    def nodes(self):
+        return set(self.rows)
 
-    def handle_call(self):
-        """Process the inbound call"""
-        # CRITICAL: Subscribe to events for this call
-        self.session.myevents()
-        logger.debug("myevents sent")
+    def park(self, node, domain, slot, uuid, caller_info):
+        self.rows.setdefault(node, {})[(domain, slot)] = (uuid, caller_info, time.time())
+        self._touch(node, domain, slot)
 
-        # Keep receiving events even after hangup
-        self.session.linger()
-        logger.debug("linger sent")
+    def unpark(self, node, domain, slot):
+        self.rows.get(node, {}).pop((domain, slot), None)
+        self._touch(node, domain, slot)
 
-        # Get call variables from session_data (populated by connect())
-        called_number = self.session.session_data.get("Caller-Destination-Number")
-        caller_id = self.session.session_data.get("Caller-Caller-ID-Number")
-        uuid = self.session.session_data.get("Unique-ID")
+    def drop_node(self, node):
+        """Forget a node that left the cluster; returns the keys it held"""
+        return set(self.rows.pop(node, {}))
 
-        # Get Kamailio headers (new architecture)
-        store_domain = self.session.session_data.get(
-            "variable_sip_h_X-Store-Domain", ""
+    def _replace(self, node, state):
+        now = time.time()
+        self.rows[node] = {key: (u, c, now) for key, (u, c) in state.items()}
+
+
+class ParkStateStore(ParkStateBackend):
+    """Park state in a WAL-mode SQLite file, one row per occupied slot per node"""
+
+    def __init__(self, path=PARK_STATE_DB):
+        super().__init__()
+        self.path = path
+        try:
+            if path != ":memory:":
+                os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+            self.db = sqlite3.connect(path, isolation_level=None, check_same_thread=False)
+        except (OSError, sqlite3.Error) as e:
+            presence_logger.warning("Park state not durable (%s: %s), keeping it in memory", path, e)
+            self.path = ":memory:"
+            self.db = sqlite3.connect(":memory:", isolation_level=None, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        columns = [row[1] for row in self.db.execute("PRAGMA table_info(park_slots)")]
+        if columns and "node" not in columns:
+            # Single-node layout; the rows are rebuilt from valet_info anyway
+            self.db.execute("DROP TABLE park_slots")
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS park_slots ("
+            " node TEXT NOT NULL, domain TEXT NOT NULL, slot TEXT NOT NULL,"
+            " uuid TEXT, caller_info TEXT, parked_at REAL NOT NULL,"
+            " PRIMARY KEY (node, domain, slot)) WITHOUT ROWID"
         )
-        is_inbound_trunk = self.session.session_data.get(
-            "variable_sip_h_X-Inbound-Trunk", ""
+        # BLF asks per slot across nodes
+        self.db.execute(
+            "CREATE INDEX IF NOT EXISTS park_slots_by_slot ON park_slots (domain, slot)"
         )
-        original_did = self.session.session_data.get(
-            "variable_sip_h_X-Original-DID", ""
+
+    def load(self, node=None):
+        """{(domain, slot): (uuid, caller_info)} for one node, or merged over all"""
+        if node is None:
+            rows = self.db.execute(
+                "SELECT domain, slot, uuid, caller_info FROM park_slots ORDER BY parked_at"
+            )
+        else:
+            rows = self.db.execute(
+                "SELECT domain, slot, uuid, caller_info FROM park_slots WHERE node = ?",
+                (node,),
+            )
+        return {(domain, slot): (uuid, caller) for domain, slot, uuid, caller in rows}
+
+    def slot(self, domain, slot):
+        """(uuid, caller_info) of the most recent call parked in a slot, or None"""
+        return self.db.execute(
+            "SELECT uuid, caller_info FROM park_slots WHERE domain = ? AND slot = ?"
+            " ORDER BY parked_at DESC LIMIT 1",
+            (domain, slot),
+        ).fetchone()
+
+    def nodes(self):
+        return {row[0] for row in self.db.execute("SELECT DISTINCT node FROM park_slots")}
+
+    def park(self, node, domain, slot, uuid, caller_info):
+        self.db.execute(
+            "INSERT OR REPLACE INTO park_slots VALUES (?, ?, ?, ?, ?, ?)",
+            (node, domain, slot, uuid, caller_info, time.time()),
+        )
+        self._touch(node, domain, slot)
+
+    def unpark(self, node, domain, slot):
+        self.db.execute(
+            "DELETE FROM park_slots WHERE node = ? AND domain = ? AND slot = ?",
+            (node, domain, slot),
+        )
+        self._touch(node, domain, slot)
+
+    def drop_node(self, node):
+        """Forget a node that left the cluster; returns the keys it held"""
+        keys = set(self.load(node))
+        self.db.execute("DELETE FROM park_slots WHERE node = ?", (node,))
+        return keys
+
+    def _replace(self, node, state):
+        now = time.time()
+        self.db.execute("BEGIN IMMEDIATE")
+        try:
+            self.db.execute("DELETE FROM park_slots WHERE node = ?", (node,))
+            self.db.executemany(
+                "INSERT INTO park_slots VALUES (?, ?, ?, ?, ?, ?)",
+                [(node, d, s, u, c, now) for (d, s), (u, c) in state.items()],
+            )
+            self.db.execute("COMMIT")
+        except sqlite3.Error:
+            self.db.execute("ROLLBACK")
+            raise
+
+
+def open_park_store(backend=PARK_STATE_BACKEND, path=PARK_STATE_DB):
+    if backend == "memory":
+        return MemoryParkStateStore()
+    if backend != "sqlite":
+        raise ValueError(f"unknown park state backend '{backend}'")
+    return ParkStateStore(path)
+
+
+def publish_park_slots(keys):
+    """Queue the merged (cluster-wide) state of park slots for BLF"""
+    for domain, slot in keys:
+        parked = park_store.slot(domain, slot)
+        presence_dispatcher.submit(
+            domain, slot, parked is not None, parked[1] if parked else None
+        )
+
+
+def parse_valet_info(body):
+    """{(lot, slot): uuid} from the XML `valet_info` prints"""
+    occupied = {}
+    for lot in ElementTree.fromstring(body).iter("lot"):
+        for extension in lot.iter("extension"):
+            occupied[(lot.get("name"), (extension.text or "").strip())] = extension.get("uuid")
+    return occupied
+
+
+def recover_park_state(node, inbound, channels):
+    """
+    Bring park lamps back in one pass after a node (re)connects.
+
+    Reads every lot on the node with a single `valet_info`, keeps caller
+    info from the store for calls it already knew about, takes the rest
+    from `channels` ({uuid: row} from `show channels`), persists the
+    result and republishes every configured slot (merged across nodes)
+    in one batch.
+    """
+    start = time.monotonic()
+    stores = tenants.current.stores
+    park_store.begin_reconcile(node)
+    try:
+        live = parse_valet_info(inbound.send("api valet_info").data)
+    except (ValueError, AttributeError, ElementTree.ParseError) as e:
+        park_store.finish_reconcile(node, park_store.load(node))
+        presence_logger.warning("Park state recovery skipped on %s, bad valet_info: %s", node, e)
+        return
+
+    known = park_store.load(node)
+    live = {key: uuid for key, uuid in live.items() if key[0] in stores}
+    occupied = {}
+    for key, uuid in live.items():
+        previous = known.get(key)
+        if previous is not None and previous[0] == uuid:
+            occupied[key] = previous
+        else:
+            caller = channels.get(uuid, {}).get("cid_num")
+            occupied[key] = (uuid, caller or "Unknown")
+    state = park_store.finish_reconcile(node, occupied)
+
+    publish_park_slots(
+        (domain, slot) for domain, config in stores.items() for slot in config["park_slots"]
+    )
+    presence_dispatcher.flush()
+    presence_logger.info(
+        "🅿️  Park state recovered on %s in %.1f ms: %d occupied, %d previously stored",
+        node,
+        (time.monotonic() - start) * 1000,
+        len(state),
+        len(known),
+    )
+
+
+# Global park state store (created by run_inbound_esl)
+park_store = None
+
+
+# =============================================================================
+# EVENT DISPATCHER (bounded, ordered per entity)
+# =============================================================================
+
+# Number of worker greenlets (one queue each)
+ESL_EVENT_WORKERS = 16
+# Events buffered per shard before backpressure kicks in
+ESL_SHARD_QUEUE_SIZE = 2000
+# How long the ESL reader may block on a full shard before the event is dropped
+ESL_ENQUEUE_TIMEOUT = 0.05
+
+
+def event_shard_key(headers):
+    """
+    Ordering key for an event.
+
+    Valet events are keyed by lot/extension so transitions of one slot stay
+    in order; everything else is keyed by channel Unique-ID (BACKGROUND_JOB,
+    which has none, by Job-UUID).
+    """
+    valet_extension = headers.get("Valet-Extension") or headers.get(
+        "variable_valet_extension"
+    )
+    if valet_extension:
+        valet_lot = headers.get("Valet-Lot-Name") or headers.get("variable_valet_lot")
+        return f"{valet_lot}/{valet_extension}"
+    return (
+        headers.get("Unique-ID")
+        or headers.get("Job-UUID")
+        or headers.get("Event-Name", "")
+    )
+
+
+class ShardedEventDispatcher:
+    """
+    Fixed pool of workers fed by bounded per-shard queues.
+
+    Every event for one entity hashes to the same shard and is handled by
+    that shard's single worker, so per-entity order is preserved while
+    different entities run concurrently. A full shard blocks the ESL
+    reader for at most ESL_ENQUEUE_TIMEOUT, then the event is dropped and
+    counted.
+    """
+
+    def __init__(
+        self,
+        handler,
+        workers=ESL_EVENT_WORKERS,
+        queue_size=ESL_SHARD_QUEUE_SIZE,
+        enqueue_timeout=ESL_ENQUEUE_TIMEOUT,
+    ):
+        self.handler = handler
+        self.enqueue_timeout = enqueue_timeout
+        self.queues = [gevent.queue.Queue(maxsize=queue_size) for _ in range(workers)]
+        self.high_water = [0] * workers
+        self.stats = {"received": 0, "processed": 0, "dropped": 0, "errors": 0}
+        # {event name: dropped count}
+        self.dropped_by_event = {}
+        self._greenlets = []
+
+    def start(self):
+        if not self._greenlets:
+            self._greenlets = [
+                gevent.spawn(self._worker, queue) for queue in self.queues
+            ]
+
+    def dispatch(self, event):
+        """Enqueue an event on its shard (called from the ESL reader)"""
+        self.stats["received"] += 1
+        headers = event.headers if hasattr(event, "headers") else {}
+        shard = hash(event_shard_key(headers)) % len(self.queues)
+        queue = self.queues[shard]
+
+        try:
+            queue.put(event, timeout=self.enqueue_timeout)
+        except gevent.queue.Full:
+            self.stats["dropped"] += 1
+            name = headers.get("Event-Subclass") or headers.get("Event-Name", "")
+            self.dropped_by_event[name] = self.dropped_by_event.get(name, 0) + 1
+            esl_logger.warning("Event queue %s full, dropped %s", shard, name)
+            return
+
+        depth = queue.qsize()
+        if depth > self.high_water[shard]:
+            self.high_water[shard] = depth
+
+    def queue_depths(self):
+        return [queue.qsize() for queue in self.queues]
+
+    def snapshot(self):
+        """Counters and queue depths for monitoring"""
+        depths = self.queue_depths()
+        return dict(
+            self.stats,
+            queued=sum(depths),
+            max_depth=max(depths),
+            high_water=max(self.high_water),
+            dropped_by_event=dict(self.dropped_by_event),
         )
 
-        # Also check channel variables set by dialplan
-        if not store_domain:
-            store_domain = self.session.session_data.get("variable_domain_name", "")
-        if not store_domain:
-            store_domain = self.session.session_data.get(
-                "variable_sip_invite_domain", ""
-            )
+    def _worker(self, queue):
+        while True:
+            event = queue.get()
+            start = time.perf_counter()
+            try:
+                self.handler(event)
+            except Exception:
+                self.stats["errors"] += 1
+                esl_logger.exception("ESL event handler failed")
+            self.stats["processed"] += 1
+            headers = event.headers
+            name = headers.get("Event-Name")
+            if name == "CUSTOM":
+                name = headers.get("Event-Subclass")
+            esl_event_timer(name).observe(time.perf_counter() - start)
+
+
+# Global event dispatcher instance
+event_dispatcher = None
+
+
+# =============================================================================
+# EVENT SUBSCRIPTIONS (server-side filtering + header projection)
+# =============================================================================
+
+# Headers needed to dispatch an event regardless of which handler gets it
+DISPATCH_HEADERS = ("Event-Name", "Event-Subclass", "Unique-ID")
+
+# {event name, or subclass for CUSTOM events: [handler, ...]}
+EVENT_HANDLERS = {}
+# Every header some handler reads; everything else is skipped while parsing
+EVENT_HEADERS = set(DISPATCH_HEADERS)
+
+
+def subscribe(*events, headers=()):
+    """
+    Register an inbound ESL handler for the given events.
+
+    Names containing "::" are CUSTOM subclasses. `headers` lists the event
+    headers the handler reads; only those are parsed out of the event.
+    """
+
+    def decorator(handler):
+        for name in events:
+            EVENT_HANDLERS.setdefault(name, []).append(handler)
+        EVENT_HEADERS.update(headers)
+        return handler
+
+    return decorator
+
+
+def subscription_commands():
+    """ESL commands that make FreeSWITCH send only events we have handlers for"""
+    names = sorted(name for name in EVENT_HANDLERS if "::" not in name)
+    subclasses = sorted(name for name in EVENT_HANDLERS if "::" in name)
+
+    commands = []
+    if subclasses:
+        commands.append("event plain CUSTOM " + " ".join(subclasses))
+    if names:
+        commands.append("event plain " + " ".join(names))
+
+    # Filters are OR'ed by FreeSWITCH; once one is set, anything that
+    # matches none of them is dropped before it is written to the socket
+    commands += [f"filter Event-Name {name}" for name in names]
+    commands += [f"filter Event-Subclass {name}" for name in subclasses]
+    return commands
+
+
+def parse_event_headers(data, wanted):
+    """Parse only the `wanted` headers out of a text/event-plain body"""
+    headers = {}
+    for line in data.split("\n"):
+        name, sep, value = line.partition(": ")
+        if sep and name in wanted:
+            headers[name] = unquote(value.strip())
+    return headers
+
+
+class ProjectedInboundESL(greenswitch.InboundESL):
+    """
+    InboundESL that skips headers no handler asked for.
+
+    greenswitch URL-decodes and splits every header of every event; here
+    plain events are scanned once and only EVENT_HEADERS are decoded and
+    stored. Command replies and other content types are left to the
+    base class.
+    """
+
+    def __init__(self, *args, headers=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.wanted_headers = frozenset(EVENT_HEADERS if headers is None else headers)
+
+    def handle_event(self, event):
+        if event.headers.get("Content-Type") != "text/event-plain":
+            return super().handle_event(event)
+
+        length = int(event.headers["Content-Length"])
+        data = self._read_socket(self.sock_file, length)
+        # Some events (BACKGROUND_JOB) carry a body after the headers
+        head, _, body = data.partition("\n\n")
+        event.headers.update(parse_event_headers(head, self.wanted_headers))
+        event.data = body
+        self._esl_event_queue.put(event)
+
+
+# =============================================================================
+# INBOUND ESL EVENT HANDLER (for system-wide events)
+# =============================================================================
+
+
+def handle_esl_event(event):
+    """Handle events from FreeSWITCH Inbound ESL"""
+    # ESLEvent uses .headers dict to access header fields
+    headers = event.headers if hasattr(event, "headers") else {}
+
+    event_name = headers.get("Event-Name")
+    if event_name == "CUSTOM":
+        event_name = headers.get("Event-Subclass")
+
+    # Handlers are registered with @subscribe below
+    for handler in EVENT_HANDLERS.get(event_name, ()):
+        handler(event)
+
+
+@subscribe(
+    "valet_parking::info",
+    headers=(
+        "Action",
+        "Valet-Lot-Name",
+        "variable_valet_lot",
+        "Valet-Extension",
+        "variable_valet_extension",
+        "Caller-Caller-ID-Number",
+    ),
+)
+def handle_park_event(event):
+    """Handle valet parking events for BLF"""
+    if not presence_dispatcher:
+        return
+
+    # ESLEvent uses .headers dict to access header fields
+    headers = event.headers if hasattr(event, "headers") else {}
+
+    action = headers.get("Action")
+    valet_lot = headers.get("Valet-Lot-Name") or headers.get("variable_valet_lot")
+    valet_extension = headers.get("Valet-Extension") or headers.get(
+        "variable_valet_extension"
+    )
+    caller_id = headers.get("Caller-Caller-ID-Number", "Unknown")
+
+    if not valet_lot or not valet_extension:
+        esl_logger.debug("Ignoring park event without lot/extension info")
+        return
+
+    # Determine domain from lot name
+    domain = valet_lot if valet_lot in tenants.current.stores else None
+    if not domain:
+        esl_logger.warning("Unknown valet lot: %s", valet_lot)
+        return
+
+    if action == "hold":
+        esl_logger.info(
+            "📦 Call PARKED in %s slot %s on %s (caller: %s)",
+            domain,
+            valet_extension,
+            event.node,
+            caller_id,
+        )
+        park_store.park(
+            event.node, domain, valet_extension, headers.get("Unique-ID"), caller_id
+        )
+        presence_dispatcher.submit(domain, valet_extension, True, caller_id)
+    elif action in ("bridge", "exit"):
+        # exit: the parked caller hung up before anyone picked up
+        verb = "RETRIEVED" if action == "bridge" else "ABANDONED"
+        esl_logger.info(
+            "📤 Call %s from %s slot %s on %s", verb, domain, valet_extension, event.node
+        )
+        park_store.unpark(event.node, domain, valet_extension)
+        # Another node may still hold a call in the same slot
+        publish_park_slots([(domain, valet_extension)])
+
+
+CHANNEL_STATE_HEADERS = (
+    "Call-Direction",
+    "Channel-Name",
+    "Caller-Caller-ID-Number",
+    "Caller-Destination-Number",
+    "Hangup-Cause",
+    "variable_sip_invite_domain",
+    "variable_sip_from_user",
+    "variable_sip_from_host",
+)
+
+
+def channel_extension(headers):
+    """(domain, extension) of the store phone on a call leg, or None"""
+    if headers.get("Call-Direction") == "outbound":
+        # Leg we dialled: sofia/internal/<extension>@kamailio
+        domain = headers.get("variable_sip_invite_domain")
+        extension = headers.get("Channel-Name", "").rsplit("/", 1)[-1].split("@", 1)[0]
+    else:
+        # Call placed by a phone
+        domain = headers.get("variable_sip_from_host")
+        extension = headers.get("variable_sip_from_user")
+    store = tenants.current.stores.get(domain)
+    if store is None or extension not in store["extensions"]:
+        return None
+    return domain, extension
+
+
+@subscribe(
+    "CHANNEL_PROGRESS",
+    "CHANNEL_PROGRESS_MEDIA",
+    "CHANNEL_ANSWER",
+    "CHANNEL_HANGUP_COMPLETE",
+    headers=CHANNEL_STATE_HEADERS,
+)
+def handle_channel_event(event):
+    """Track ringing / in-call / idle per extension and publish it as BLF"""
+    headers = event.headers
+    party = channel_extension(headers)
+    if party is None:
+        return
+
+    name = headers.get("Event-Name")
+    uuid = headers.get("Unique-ID")
+    dialled = headers.get("Call-Direction") == "outbound"
+
+    if name == "CHANNEL_HANGUP_COMPLETE":
+        extension_states.leg_ended(
+            uuid, *party, cause=headers.get("Hangup-Cause"), dialled=dialled
+        )
+    elif name == "CHANNEL_ANSWER" or not dialled:
+        # A phone placing a call is busy from its first progress event
+        extension_states.leg_answered(uuid, *party, node=event.node)
+    else:
+        extension_states.leg_ringing(uuid, *party, node=event.node)
+
+    if presence_dispatcher:
+        publish_extension_state(headers, party, dialled)
+
+
+# ExtensionStateTable state -> dialog-info state shown on BLF keys
+DIALOG_STATES = {
+    "in_call": "confirmed",
+    "ringing": "early",
+    "idle": "terminated",
+    "unregistered": "terminated",
+}
+
+
+def publish_extension_state(headers, party, dialled):
+    """Queue a BLF update for an extension after one of its legs changed"""
+    state = DIALOG_STATES[extension_states.state(*party)]
+    if dialled:
+        remote_info = headers.get("Caller-Caller-ID-Number")
+        direction = "recipient"
+    else:
+        remote_info = headers.get("Caller-Destination-Number")
+        direction = "initiator"
+    presence_dispatcher.submit_extension(*party, state, remote_info, direction)
+
+
+@subscribe(
+    "sofia::register",
+    "sofia::unregister",
+    "sofia::expire",
+    headers=("from-user", "from-host", "user", "host"),
+)
+def handle_registration_event(event):
+    """Registrations held by FreeSWITCH itself"""
+    headers = event.headers
+    # register/unregister carry from-user/from-host, expire user/host
+    extension = headers.get("from-user") or headers.get("user")
+    domain = headers.get("from-host") or headers.get("host")
+    store = tenants.current.stores.get(domain)
+    if store is None or extension not in store["extensions"]:
+        return
+
+    registered = headers.get("Event-Subclass") == "sofia::register"
+    extension_states.set_registered(domain, extension, registered, f"sofia:{event.node}")
+    esl_logger.debug(
+        "%s@%s %s on %s",
+        extension,
+        domain,
+        "registered" if registered else "unregistered",
+        event.node,
+    )
+
+
+def parse_registrations(body):
+    """{(domain, extension)} from `show registrations as json`"""
+    rows = json.loads(body).get("rows", ())
+    return {(row.get("realm"), row.get("reg_user")) for row in rows}
+
+
+def reconcile_registrations(inbound, node):
+    """Correct missed register/expire events while the connection lasts"""
+    while inbound.connected:
+        try:
+            reply = inbound.send("api show registrations as json")
+            changed = extension_states.reconcile(
+                parse_registrations(reply.data), f"sofia:{node}"
+            )
+            if changed:
+                esl_logger.info(
+                    "🔄 Registration reconcile on %s: %d extension(s) corrected", node, changed
+                )
+        except greenswitch.esl.NotConnectedError:
+            return
+        except (ValueError, AttributeError) as e:
+            esl_logger.warning("Could not parse show registrations: %s", e)
+        gevent.sleep(REGISTRATION_RECONCILE_INTERVAL)
+
+
+def fetch_channels(inbound):
+    """{uuid: row} for every channel FreeSWITCH has up right now"""
+    rows = json.loads(inbound.send("api show channels as json").data).get("rows", ())
+    return {row.get("uuid"): row for row in rows}
+
+
+def resync_channels(channels, node):
+    """Settle extensions whose legs on `node` ended while we were not listening"""
+    keys = extension_states.drop_legs(channels, node)
+    for key in keys:
+        state = DIALOG_STATES[extension_states.state(*key)]
+        presence_dispatcher.submit_extension(*key, state)
+    if keys:
+        esl_logger.info("🔄 Resynced %d extension(s) after ESL gap on %s", len(keys), node)
+
+
+# =============================================================================
+# INBOUND ESL CONNECTION (liveness, backoff, resync)
+# =============================================================================
+
+# Reconnect delay: random in [0, min(CAP, BASE * 2**attempt)] ("full jitter"),
+# so router replicas do not reconnect in lockstep after a FreeSWITCH restart
+ESL_RECONNECT_BASE = float(os.environ.get("ESL_RECONNECT_BASE", "0.5"))
+ESL_RECONNECT_CAP = float(os.environ.get("ESL_RECONNECT_CAP", "30"))
+# FreeSWITCH sends HEARTBEAT every 20s by default (event-heartbeat-interval
+# in switch.conf); silence for this long means the socket is half-open
+ESL_HEARTBEAT_TIMEOUT = float(os.environ.get("ESL_HEARTBEAT_TIMEOUT", "45"))
+
+
+def reconnect_delay(attempt, base=ESL_RECONNECT_BASE, cap=ESL_RECONNECT_CAP):
+    """Full-jitter backoff; the exponent is clamped so long outages cannot overflow"""
+    return random.uniform(0, min(cap, base * 2 ** min(attempt, 16)))
+
+
+class EslLink:
+    """State of the inbound ESL connection, as reported by /ready"""
+
+    def __init__(self):
+        self.connected = False
+        # Connected, subscribed and resynced
+        self.ready = False
+        self.last_event = 0.0
+        self.connected_at = 0.0
+        self.connects = 0
+        self.last_error = None
+        # Selected HEARTBEAT headers from FreeSWITCH
+        self.freeswitch = {}
+
+    def touch(self):
+        self.last_event = time.monotonic()
+
+    def up(self):
+        self.connected = True
+        self.connects += 1
+        self.connected_at = time.monotonic()
+        self.touch()
+
+    def down(self, error=None):
+        self.connected = False
+        self.ready = False
+        if error is not None:
+            self.last_error = error
+
+    def silent_for(self):
+        return time.monotonic() - self.last_event
+
+    def is_ready(self):
+        return self.ready and self.silent_for() < ESL_HEARTBEAT_TIMEOUT
+
+    def snapshot(self):
+        now = time.monotonic()
+        return {
+            "connected": self.connected,
+            "ready": self.is_ready(),
+            "uptime": round(now - self.connected_at, 1) if self.connected else 0,
+            "last_event_age": round(self.silent_for(), 1) if self.last_event else None,
+            "connects": self.connects,
+            "last_error": self.last_error,
+            "freeswitch": self.freeswitch,
+        }
+
+
+@subscribe("HEARTBEAT", headers=("Up-Time", "Session-Count", "Idle-CPU"))
+def handle_heartbeat(event):
+    """Liveness comes from receiving it at all; keep the numbers for /ready"""
+    node = cluster.nodes.get(event.node)
+    if node is None:
+        return
+    node.link.freeswitch = {
+        "uptime": event.headers.get("Up-Time"),
+        "sessions": event.headers.get("Session-Count"),
+        "idle_cpu": event.headers.get("Idle-CPU"),
+    }
+
+
+def watch_heartbeat(link):
+    """Return once nothing has arrived on `link` for ESL_HEARTBEAT_TIMEOUT seconds"""
+    while True:
+        remaining = ESL_HEARTBEAT_TIMEOUT - link.silent_for()
+        if remaining <= 0:
+            return
+        gevent.sleep(remaining)
+
+
+def close_inbound(inbound):
+    """Tear down a dead connection and fail anything still waiting on it"""
+    inbound._run = False
+    inbound.connected = False
+    sock = getattr(inbound, "sock", None)
+    if sock is not None:
+        try:
+            # shutdown wakes the reader even though makefile() holds the fd
+            sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        sock.close()
+    pending, inbound._commands_sent = inbound._commands_sent, []
+    for result in pending:
+        result.set_exception(greenswitch.esl.NotConnectedError())
+
+
+def run_inbound_esl():
+    """Set up shared event handling, then connect to every FreeSWITCH node"""
+    global presence_publisher, presence_dispatcher, event_dispatcher, park_store, cdr_writer
+
+    park_store = open_park_store()
+    if CDR_DB:
+        try:
+            cdr_writer = CdrWriter(CDR_DB)
+            cdr_writer.start()
+            cdr_logger.info("🧾 Writing CDRs to %s (spool %s)", CDR_DB, CDR_SPOOL_DIR)
+        except (OSError, sqlite3.Error) as e:
+            cdr_writer = None
+            cdr_logger.error("CDRs disabled, cannot open %s: %s", CDR_DB, e)
+    presence_publisher = PresencePublisher(KAMAILIO_HOST, KAMAILIO_PORT)
+    tenants.on_change(lambda snapshot: presence_publisher.add_stores(snapshot.stores))
+    presence_dispatcher = PresenceDispatcher(presence_publisher)
+    tenants.on_change(lambda snapshot: presence_dispatcher.prune(snapshot.stores))
+    presence_dispatcher.start()
+    event_dispatcher = ShardedEventDispatcher(handle_esl_event)
+    event_dispatcher.start()
+    esl_logger.info(
+        "📡 Presence publisher initialized (Kamailio: %s:%s)", KAMAILIO_HOST, KAMAILIO_PORT
+    )
+
+    # One connection loop per node; nodes come and go with the tenant file
+    cluster.configure(node_specs(tenants.current))
+    tenants.on_change(lambda snapshot: cluster.configure(node_specs(snapshot)))
+
+
+def run_node_esl(node):
+    """Keep the inbound ESL connection to one FreeSWITCH node"""
+    link = node.link
+
+    def on_event(event):
+        event.node = node.name
+        link.touch()
+        event_dispatcher.dispatch(event)
+
+    attempt = 0
+    while True:
+        inbound = None
+        try:
+            esl_logger.info(
+                "🔌 Connecting to FreeSWITCH ESL on %s (%s:%s)...", node.name, node.host, node.esl_port
+            )
+
+            # Create Inbound ESL connection
+            inbound = ProjectedInboundESL(
+                host=node.host,
+                port=node.esl_port,
+                password=node.password,
+            )
+
+            # Register event handler before connecting; events are queued
+            # per entity and handled by a fixed pool of workers
+            inbound.register_handle("*", on_event)
+            inbound.connect()
+            link.up()
+            esl_logger.info("✅ Connected to FreeSWITCH ESL on %s", node.name)
+
+            # Subscribe only to events that have a registered handler
+            for command in subscription_commands():
+                inbound.send(command)
+            esl_logger.info("📋 Subscribed to %s", ", ".join(sorted(EVENT_HANDLERS)))
+
+            # ESL cannot replay what was missed while disconnected, so
+            # rebuild state from FreeSWITCH instead
+            gevent.spawn(reconcile_registrations, inbound, node.name)
+            fetched_at = time.perf_counter()
+            channels = fetch_channels(inbound)
+            recover_park_state(node.name, inbound, channels)
+            resync_channels(channels, node.name)
+            if call_control:
+                call_control.resync(channels, fetched_at, inbound, node.name)
+            link.ready = True
+            # Stores whose home is this node move back to it
+            cluster.rebalance()
+
+            # Wake on socket EOF (reader greenlet exits) or heartbeat silence
+            watchdog = gevent.spawn(watch_heartbeat, link)
+            gevent.wait([inbound._receive_events_greenlet, watchdog], count=1)
+            watchdog.kill()
+
+            # Only a connection that stayed up resets the backoff, so a
+            # flapping FreeSWITCH still gets exponentially fewer attempts
+            if time.monotonic() - link.connected_at >= ESL_RECONNECT_CAP:
+                attempt = 0
+
+            if inbound.connected:
+                esl_logger.warning(
+                    "No ESL traffic from %s for %.0fs, dropping connection",
+                    node.name,
+                    ESL_HEARTBEAT_TIMEOUT,
+                )
+                link.down("heartbeat timeout")
+            else:
+                esl_logger.warning("ESL connection to %s lost", node.name)
+                link.down("connection lost")
+
+        except Exception as e:
+            esl_logger.error("ESL connection error on %s: %s", node.name, e)
+            link.down(f"{type(e).__name__}: {e}")
+
+        finally:
+            if inbound is not None:
+                close_inbound(inbound)
+
+        # Fail this node's stores over while it is away
+        cluster.rebalance()
+        delay = reconnect_delay(attempt)
+        attempt += 1
+        esl_logger.info(
+            "Reconnecting to %s in %.1f seconds (attempt %d)...", node.name, delay, attempt
+        )
+        gevent.sleep(delay)
+
+
+# =============================================================================
+# FREESWITCH NODES (consistent-hash store affinity, failover)
+# =============================================================================
+
+# Virtual points per node on the hash ring. More points spread stores more
+# evenly; adding or removing a node moves only ~1/N of them either way.
+NODE_RING_POINTS = 160
+# Seconds between full pushes of the affinity tables to Kamailio; the
+# htables expire entries after a few missed pushes (kamailio.cfg)
+KAMAILIO_AFFINITY_INTERVAL = 30
+
+
+def node_specs(snapshot):
+    """{name: config} of the FreeSWITCH nodes; FREESWITCH_HOST when none are listed"""
+    if snapshot.nodes:
+        return snapshot.nodes
+    return {
+        "freeswitch": _normalize_node(
+            {"host": FREESWITCH_HOST, "esl_port": FREESWITCH_ESL_PORT}
+        )
+    }
+
+
+class FreeSwitchNode:
+    """One media node: where to reach it and the state of its ESL connection"""
+
+    def __init__(self, name, config):
+        self.name = name
+        self.config = config
+        self.host = config["host"]
+        self.esl_port = config["esl_port"]
+        self.password = config["password"]
+        # Where Kamailio sends calls for stores homed here
+        self.sip_uri = f"sip:{config['sip_host']}:{config['sip_port']}"
+        self.sip_source = f"{config['sip_host']}:{config['sip_port']}"
+        self.link = EslLink()
+        self.greenlet = None
+
+
+class HashRing:
+    """
+    Consistent hashing of store domains onto node names.
+
+    Points come from blake2b rather than hash(), which is salted per
+    process, so every router replica computes the same placement.
+    """
+
+    def __init__(self, points=NODE_RING_POINTS):
+        self.points = points
+        self.names = set()
+        self._hashes = []
+        self._owners = []
+
+    @staticmethod
+    def _hash(key):
+        return int.from_bytes(hashlib.blake2b(key.encode(), digest_size=8).digest(), "big")
+
+    def _rebuild(self):
+        ring = sorted(
+            (self._hash(f"{name}#{i}"), name)
+            for name in self.names
+            for i in range(self.points)
+        )
+        self._hashes = [point for point, _ in ring]
+        self._owners = [name for _, name in ring]
+
+    def add(self, name):
+        self.names.add(name)
+        self._rebuild()
+
+    def remove(self, name):
+        self.names.discard(name)
+        self._rebuild()
+
+    def owner(self, key, usable=None):
+        """
+        First node clockwise from `key` that is in `usable` (any node if
+        None), so a failed node's stores spread over its ring neighbours.
+        """
+        if not self._owners:
+            return None
+        start = bisect.bisect(self._hashes, self._hash(key))
+        for i in range(len(self._owners)):
+            name = self._owners[(start + i) % len(self._owners)]
+            if usable is None or name in usable:
+                return name
+        return None
+
+
+class Cluster:
+    """
+    The FreeSWITCH nodes this router drives and which stores each one owns.
+
+    A store's home is its owner on the hash ring. While a node's inbound
+    ESL connection is not ready its stores go to the next healthy node on
+    the ring, and come back once it is ready again. Listeners registered
+    with on_rebalance get {domain: node name} for every store that moved.
+    """
+
+    def __init__(self):
+        # {name: FreeSwitchNode}
+        self.nodes = {}
+        self.ring = HashRing()
+        # {store domain: node name}
+        self.assignment = {}
+        self.stats = {"rebalances": 0, "moves": 0}
+        self._listeners = []
+
+    def on_rebalance(self, callback):
+        self._listeners.append(callback)
+
+    def configure(self, specs):
+        """Add, replace and remove nodes to match `specs` ({name: config})"""
+        for name, node in list(self.nodes.items()):
+            if specs.get(name) != node.config:
+                self._remove(name)
+        for name, config in specs.items():
+            if name not in self.nodes:
+                self._add(name, config)
+        if park_store is not None:
+            # Rows of nodes that left, including while we were not running
+            for name in park_store.nodes() - set(self.nodes):
+                publish_park_slots(park_store.drop_node(name))
+        self.rebalance()
+
+    def _add(self, name, config):
+        node = FreeSwitchNode(name, config)
+        self.nodes[name] = node
+        self.ring.add(name)
+        node.greenlet = gevent.spawn(run_node_esl, node)
+        if call_control:
+            call_control.add_node(node)
+        esl_logger.info("➕ FreeSWITCH node %s (%s:%s)", name, node.host, node.esl_port)
+
+    def _remove(self, name):
+        node = self.nodes.pop(name)
+        self.ring.remove(name)
+        node.greenlet.kill()
+        node.link.down("removed")
+        if call_control:
+            call_control.remove_node(name)
+        # Its calls are gone from our view; settle their extensions
+        if presence_dispatcher:
+            resync_channels({}, name)
+        esl_logger.info("➖ FreeSWITCH node %s removed", name)
+
+    def healthy(self):
+        return {name for name, node in self.nodes.items() if node.link.is_ready()}
+
+    def rebalance(self):
+        """Recompute every store's node; a cluster with no healthy node keeps the last one"""
+        usable = self.healthy()
+        if not usable:
+            return {}
+        assignment = {
+            domain: self.ring.owner(domain, usable) for domain in tenants.current.stores
+        }
+        moved = {
+            domain: name
+            for domain, name in assignment.items()
+            if self.assignment.get(domain) != name
+        }
+        self.assignment = assignment
+        if moved:
+            self.stats["rebalances"] += 1
+            self.stats["moves"] += len(moved)
+            esl_logger.info(
+                "⚖️ Rebalanced %d store(s) over %d healthy node(s)", len(moved), len(usable)
+            )
+            for callback in self._listeners:
+                try:
+                    callback(moved)
+                except Exception:
+                    esl_logger.exception("Rebalance listener failed")
+        return moved
+
+    def home(self, domain):
+        """Name of the node calls for `domain` should go to, or None"""
+        return self.assignment.get(domain)
+
+    def is_ready(self):
+        """Ready while at least one node can take calls"""
+        return any(node.link.is_ready() for node in self.nodes.values())
+
+    def snapshot(self):
+        stores = collections.Counter(self.assignment.values())
+        return {
+            name: dict(node.link.snapshot(), host=node.host, stores=stores.get(name, 0))
+            for name, node in self.nodes.items()
+        }
+
+
+class KamailioAffinity:
+    """
+    Pushes store -> node affinity to Kamailio, which does the actual
+    steering (route[FREESWITCH_DST] in kamailio.cfg).
+
+    Uses JSON-RPC notifications (no id, so Kamailio sends no reply) on
+    its jsonrpcs datagram socket: `store_node` maps a domain to its
+    node's SIP URI, `fs_nodes` lists node addresses Kamailio should
+    treat as FreeSWITCH. Moves are pushed as they happen and the whole
+    table again every KAMAILIO_AFFINITY_INTERVAL, which also refills it
+    after a Kamailio restart.
+    """
+
+    def __init__(self, address=KAMAILIO_RPC_ADDRESS, interval=KAMAILIO_AFFINITY_INTERVAL):
+        host, port = address.rsplit(":", 1)
+        self.address = (host, int(port))
+        self.interval = interval
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.stats = {"sent": 0, "failed": 0}
+
+    def start(self):
+        cluster.on_rebalance(self.push)
+        gevent.spawn(self._refresh)
+
+    def _call(self, method, *params):
+        payload = json.dumps({"jsonrpc": "2.0", "method": method, "params": params})
+        try:
+            self.sock.sendto(payload.encode(), self.address)
+            self.stats["sent"] += 1
+        except OSError as e:
+            self.stats["failed"] += 1
+            esl_logger.warning("Kamailio affinity push failed: %s", e)
+
+    def push(self, assignment):
+        # The single default node is already Kamailio's FREESWITCH_URI
+        if not tenants.current.nodes:
+            return
+        for domain, name in assignment.items():
+            node = cluster.nodes.get(name)
+            if node is not None:
+                self._call("htable.sets", "store_node", domain, node.sip_uri)
+
+    def push_nodes(self):
+        if not tenants.current.nodes:
+            return
+        for node in cluster.nodes.values():
+            self._call("htable.sets", "fs_nodes", node.sip_source, node.name)
+
+    def _refresh(self):
+        while True:
+            self.push_nodes()
+            self.push(cluster.assignment)
+            gevent.sleep(self.interval)
+
+
+# Global node set (configured by run_inbound_esl)
+cluster = Cluster()
+# Global affinity pusher (created in __main__)
+affinity = None
+
+
+# =============================================================================
+# EXTENSION STATE (registration, call state and answer history)
+# =============================================================================
+
+
+# Hangup causes for a leg that never rang because nobody was there to
+# ring (Kamailio answers a failed location lookup with 404)
+UNREACHABLE_CAUSES = frozenset(
+    (
+        "USER_NOT_REGISTERED",
+        "UNALLOCATED_NUMBER",
+        "NO_ROUTE_DESTINATION",
+        "SUBSCRIBER_ABSENT",
+    )
+)
+# Seconds an extension is skipped after such a failure. Phones register
+# with Kamailio, so a failed leg is usually all FreeSWITCH gets to see;
+# the mark lapses on its own and the phone is tried again.
+UNREACHABLE_TTL = float(os.environ.get("ROUTER_UNREACHABLE_TTL", "120"))
+# Seconds between reconciliations against `show registrations`
+REGISTRATION_RECONCILE_INTERVAL = float(
+    os.environ.get("ROUTER_RECONCILE_INTERVAL", "300")
+)
+
+
+class ExtensionState:
+    """
+    One (domain, extension) entry.
+
+    offline_until is 0 while the extension is registered or unknown,
+    inf once FreeSWITCH reported it unregistered, and a monotonic
+    deadline after a failed leg. source is "sofia:<node>" when that
+    FreeSWITCH node holds the registration (and its `show registrations`
+    is authoritative for it), "call" when the state was learned from
+    call legs.
+    """
+
+    __slots__ = ("offline_until", "source", "ringing", "active", "answered_at")
+
+    def __init__(self):
+        self.offline_until = 0.0
+        self.source = None
+        self.ringing = 0
+        self.active = 0
+        self.answered_at = 0.0
+
+
+def _from_sofia(entry):
+    """The registration state came from a FreeSWITCH node"""
+    return entry.source is not None and entry.source.startswith("sofia")
+
+
+class ExtensionStateTable:
+    """
+    In-memory state per (domain, extension): registered, ringing,
+    in-call or idle.
+
+    Fed from sofia::register/unregister/expire and CHANNEL_* events on
+    the inbound connection, and reconciled periodically against
+    `show registrations`. Reads are single dict lookups so ring
+    strategies can consult it on every call.
+
+    Extensions we have never heard about count as registered, so an
+    empty table never stops a call from ringing.
+    """
+
+    def __init__(self):
+        # {(domain, extension): ExtensionState}
+        self.entries = {}
+        # {channel uuid: (key, "ringing" | "in_call", node)} for live legs
+        self.legs = {}
+
+    def _entry(self, domain, extension):
+        key = (domain, extension)
+        entry = self.entries.get(key)
+        if entry is None:
+            entry = self.entries[key] = ExtensionState()
+        return entry
+
+    def is_registered(self, domain, extension):
+        entry = self.entries.get((domain, extension))
+        return entry is None or entry.offline_until <= time.monotonic()
+
+    def is_busy(self, domain, extension):
+        entry = self.entries.get((domain, extension))
+        return entry is not None and entry.active > 0
+
+    def state(self, domain, extension):
+        """One of unregistered, in_call, ringing or idle"""
+        entry = self.entries.get((domain, extension))
+        if entry is None:
+            return "idle"
+        if entry.offline_until > time.monotonic():
+            return "unregistered"
+        if entry.active:
+            return "in_call"
+        if entry.ringing:
+            return "ringing"
+        return "idle"
+
+    def set_registered(self, domain, extension, registered, source="sofia:freeswitch"):
+        entry = self._entry(domain, extension)
+        entry.offline_until = 0.0 if registered else float("inf")
+        entry.source = source
+
+    def mark_unreachable(self, domain, extension, ttl=UNREACHABLE_TTL):
+        entry = self._entry(domain, extension)
+        # Never shorten what FreeSWITCH itself told us
+        if not _from_sofia(entry):
+            entry.offline_until = time.monotonic() + ttl
+            entry.source = "call"
+
+    def mark_answered(self, domain, extension, at=None):
+        entry = self._entry(domain, extension)
+        entry.answered_at = time.monotonic() if at is None else at
+
+    def last_answered(self, domain, extension):
+        entry = self.entries.get((domain, extension))
+        return entry.answered_at if entry is not None else 0.0
+
+    # -- call legs --------------------------------------------------------
+
+    def _seen(self, entry):
+        """A leg reached the phone, so it is registered somewhere"""
+        if not _from_sofia(entry):
+            entry.offline_until = 0.0
+            entry.source = "call"
+
+    def leg_ringing(self, uuid, domain, extension, node=None):
+        if uuid in self.legs:
+            return
+        entry = self._entry(domain, extension)
+        self._seen(entry)
+        entry.ringing += 1
+        self.legs[uuid] = ((domain, extension), "ringing", node)
+
+    def leg_answered(self, uuid, domain, extension, node=None):
+        key = (domain, extension)
+        entry = self._entry(domain, extension)
+        previous = self.legs.get(uuid)
+        if previous is not None:
+            if previous[1] == "in_call":
+                return
+            entry.ringing -= 1
+        self._seen(entry)
+        entry.active += 1
+        self.legs[uuid] = (key, "in_call", node)
+
+    def _release(self, leg):
+        entry = self.entries[leg[0]]
+        if leg[1] == "in_call":
+            entry.active -= 1
+        else:
+            entry.ringing -= 1
+
+    def leg_ended(self, uuid, domain, extension, cause=None, dialled=False):
+        leg = self.legs.pop(uuid, None)
+        if leg is not None:
+            self._release(leg)
+        elif dialled and cause in UNREACHABLE_CAUSES:
+            self.mark_unreachable(domain, extension)
+
+    def drop_legs(self, live, node=None):
+        """
+        Forget legs on `node` (every node if None) whose uuid is not in
+        `live` (hangups missed while its inbound connection was down).
+        Returns the affected keys.
+        """
+        keys = set()
+        gone = [
+            uuid
+            for uuid, leg in self.legs.items()
+            if uuid not in live and (node is None or leg[2] == node)
+        ]
+        for uuid in gone:
+            leg = self.legs.pop(uuid)
+            self._release(leg)
+            keys.add(leg[0])
+        return keys
+
+    # -- reconciliation ---------------------------------------------------
+
+    def reconcile(self, registrations, source="sofia:freeswitch"):
+        """
+        Apply one node's full `show registrations` listing
+        ({(domain, extension)}); `source` names the node.
+
+        Listed extensions are registered. Extensions that node previously
+        reported as registered but no longer lists are not. Extensions
+        known only from call legs are left alone, since their
+        registrations live on Kamailio. Returns the number of changes.
+        """
+        changed = 0
+        for key in registrations:
+            entry = self.entries.get(key)
+            if entry is None or entry.source != source or entry.offline_until:
+                changed += 1
+                self.set_registered(*key, True, source)
+        for key, entry in self.entries.items():
+            if (
+                entry.source == source
+                and not entry.offline_until
+                and key not in registrations
+            ):
+                changed += 1
+                entry.offline_until = float("inf")
+        return changed
+
+    def snapshot(self):
+        now = time.monotonic()
+        return {
+            "extensions": len(self.entries),
+            "unregistered": sum(
+                1 for e in self.entries.values() if e.offline_until > now
+            ),
+            "ringing": sum(1 for e in self.entries.values() if e.ringing),
+            "in_call": sum(1 for e in self.entries.values() if e.active),
+            "legs": len(self.legs),
+        }
+
+
+# Global extension state table
+extension_states = ExtensionStateTable()
+
+
+# =============================================================================
+# ROUTING LOGIC
+# =============================================================================
+
+
+# Characters stripped from DIDs before lookup
+_DID_PUNCTUATION = str.maketrans("", "", "+-() .")
+
+
+def normalize_did(did):
+    """Reduce a DID to its 10-digit national number"""
+    normalized = did.translate(_DID_PUNCTUATION)
+    if len(normalized) == 11 and normalized.startswith("1"):
+        normalized = normalized[1:]
+    return normalized
+
+
+def execute_command(app_name, app_args=None):
+    """Outbound ESL sendmsg frame that runs a dialplan application"""
+    command = f"sendmsg\ncall-command: execute\nexecute-app-name: {app_name}"
+    if app_args:
+        command += f"\nexecute-app-arg: {app_args}"
+    return command
+
+
+# Ring leg timeout in seconds (counted from the start of each leg)
+RING_LEG_TIMEOUT = 30
+
+
+class RingStrategy:
+    """
+    How a store's ring group is dialled, from the store's "ring_strategy":
+
+        {"type": "simultaneous" | "staggered" | "least_recent",
+         "wave_size": 5, "wave_delay": 10, "skip_unregistered": true,
+         "skip_busy": false}
+
+    - simultaneous: every member at once
+    - staggered: waves of `wave_size` in ring-group order, each starting
+      `wave_delay` seconds after the previous one (earlier waves keep ringing)
+    - least_recent: like staggered, ordered by who answered least recently
+
+    skip_unregistered / skip_busy prune members the ExtensionStateTable
+    reports as offline / already on a call, unless that would leave
+    nobody to ring.
+
+    plan() is a pure function of the ring group and an ExtensionStateTable,
+    so it can be exercised without FreeSWITCH.
+    """
+
+    KINDS = ("simultaneous", "staggered", "least_recent")
+
+    __slots__ = ("kind", "wave_size", "wave_delay", "skip_unregistered", "skip_busy")
+
+    def __init__(self, config=None):
+        config = config or {}
+        self.kind = config.get("type", "simultaneous")
+        if self.kind not in self.KINDS:
+            raise ValueError(f"unknown ring strategy '{self.kind}'")
+        default_wave = 1 if self.kind == "least_recent" else 5
+        self.wave_size = max(1, int(config.get("wave_size", default_wave)))
+        self.wave_delay = max(0, int(config.get("wave_delay", 10)))
+        self.skip_unregistered = bool(config.get("skip_unregistered", True))
+        self.skip_busy = bool(config.get("skip_busy", False))
+
+    @property
+    def is_static(self):
+        """True when the plan never depends on extension state"""
+        return (
+            self.kind == "simultaneous"
+            and not self.skip_unregistered
+            and not self.skip_busy
+        )
+
+    def plan(self, domain, ring_group, states):
+        """Return [(extension, delay_seconds)] for one call"""
+        members = list(ring_group)
+        if self.skip_unregistered and states is not None:
+            reachable = [ext for ext in members if states.is_registered(domain, ext)]
+            # Nobody known to be online: ring everyone rather than nobody
+            if reachable:
+                members = reachable
+        if self.skip_busy and states is not None:
+            free = [ext for ext in members if not states.is_busy(domain, ext)]
+            if free:
+                members = free
+
+        if self.kind == "simultaneous":
+            return [(ext, 0) for ext in members]
+
+        if self.kind == "least_recent" and states is not None:
+            members.sort(key=lambda ext: states.last_answered(domain, ext))
+
+        return [
+            (ext, (index // self.wave_size) * self.wave_delay)
+            for index, ext in enumerate(members)
+        ]
+
+
+def bridge_target(extension):
+    """Dial target for an extension; Kamailio does the location lookup"""
+    return f"sofia/internal/{extension}@{KAMAILIO_HOST}:{KAMAILIO_PORT}"
+
+
+def render_targets(plan):
+    """Comma-separated simultaneous dial-string with per-leg start delays"""
+    targets = []
+    for extension, delay in plan:
+        if delay:
+            # leg_timeout is measured from the start of the whole bridge,
+            # so delayed legs get their delay added on top
+            targets.append(
+                f"[leg_delay_start={delay},leg_timeout={delay + RING_LEG_TIMEOUT}]"
+                + bridge_target(extension)
+            )
+        else:
+            targets.append(bridge_target(extension))
+    return ",".join(targets)
+
+
+class Route:
+    """Prebuilt routing decision for one store"""
+
+    __slots__ = (
+        "action",
+        "domain",
+        "context",
+        "ring_group",
+        "strategy",
+        "targets",
+        "sip_invite_domain",
+        "reason",
+        "setup_command",
+        "inline_setup",
+        "_dial_head",
+        "_dial_vars",
+        "_dial_tail",
+    )
+
+    def __init__(
+        self, action, domain, context=None, ring_group=(), strategy=None, reason=None
+    ):
+        self.action = action
+        self.domain = domain
+        self.context = context
+        self.ring_group = tuple(ring_group)
+        self.strategy = strategy or RingStrategy()
+        self.targets = tuple(bridge_target(ext) for ext in self.ring_group)
+        self.sip_invite_domain = domain
+        self.reason = reason
+        # A-leg variables for the bridge, set with a single multiset
+        # (leg_timeout in the dial-string replaces the old call_timeout)
+        variables = (
+            f"^^|domain_name={domain}|sip_invite_domain={domain}"
+            "|ringback=${us-ring}|hangup_after_bridge=true|continue_on_fail=true"
+        )
+        self.setup_command = execute_command("multiset", variables)
+        # The same setup as an inline dialplan for async call control; the
+        # dial-string is appended. "~" separates applications because the
+        # dial-string is full of commas.
+        self.inline_setup = f"m:~:multiset:{variables}~answer~bridge:"
+        # Everything in the dial-string except the caller id (and, for
+        # dynamic strategies, the targets) is static
+        self._dial_head = (
+            f"{{leg_timeout={RING_LEG_TIMEOUT},origination_caller_id_number="
+        )
+        # Include X-Store-Domain header so Kamailio knows which domain for location lookup
+        self._dial_vars = f",sip_invite_domain={domain},sip_h_X-Store-Domain={domain}}}"
+        self._dial_tail = self._dial_vars + ",".join(self.targets)
+
+    def plan(self, states=None):
+        """Ring plan [(extension, delay)] for one call"""
+        return self.strategy.plan(self.domain, self.ring_group, states)
+
+    def bridge_string(self, caller_id, states=None):
+        """Finished bridge dial-string for a caller"""
+        if states is None or self.strategy.is_static:
+            return self._dial_head + str(caller_id) + self._dial_tail
+        return (
+            self._dial_head
+            + str(caller_id)
+            + self._dial_vars
+            + render_targets(self.plan(states))
+        )
+
+
+class RoutingIndex:
+    """
+    Immutable lookup tables built from one tenant snapshot.
+
+    Domains and normalised DIDs map straight to prebuilt Route objects.
+    Each TenantSnapshot owns its own index, so a reload swaps the index
+    together with the data it was built from.
+    """
+
+    def __init__(self, stores):
+        self.by_domain = {}
+        self.by_did = {}
+        for domain, config in stores.items():
+            route = Route(
+                "bridge",
+                domain,
+                config["context"],
+                config["ring_group"],
+                RingStrategy(config.get("ring_strategy")),
+            )
+            self.by_domain[domain] = route
+            if config.get("did"):
+                self.by_did[normalize_did(config["did"])] = route
+
+    def for_domain(self, domain):
+        return self.by_domain.get(domain)
+
+    def for_did(self, did):
+        return self.by_did.get(normalize_did(did))
+
+
+# Global tenant configuration (snapshot swapped in on file change)
+tenants = TenantConfig(TENANTS_FILE, STORES)
+
+
+def get_route_for_inbound_call(store_domain, caller_id, snapshot=None):
+    """
+    Get routing decision for an inbound call from SIP trunk (via Kamailio).
+
+    In the new architecture:
+    - Calls come from Kamailio with X-Store-Domain header
+    - We route to the ring group for that store
+    - Calls go back to Kamailio for delivery to phones
+    """
+    snapshot = snapshot or tenants.current
+    route = snapshot.routing.for_domain(store_domain)
+    if route is None:
+        call_logger.warning("Unknown store domain: %s", store_domain)
+        return Route("reject", store_domain, reason=f"Unknown store: {store_domain}")
+
+    call_logger.info("Routing inbound call for %s: %s", store_domain, route.targets)
+    return route
+
+
+def call_store_domain(data, snapshot):
+    """
+    Store a new call belongs to: Kamailio's X-Store-Domain header, then the
+    variables the dialplan set, then the dialled DID
+    """
+    store_domain = (
+        data.get("variable_sip_h_X-Store-Domain")
+        or data.get("variable_domain_name")
+        or data.get("variable_sip_invite_domain")
+    )
+    if store_domain:
+        return store_domain
+    called_number = data.get("Caller-Destination-Number")
+    route = snapshot.routing.for_did(called_number) if called_number else None
+    if route is None:
+        return None
+    call_logger.info("   Determined store from DID: %s", route.domain)
+    return route.domain
+
+
+def record_answer(route, headers):
+    """Remember which ring-group member took the call (least_recent order)"""
+    channel = headers.get("variable_bridge_channel", "")
+    # sofia/internal/<extension>@kamailio
+    extension = channel.rsplit("/", 1)[-1].split("@", 1)[0]
+    if extension in route.ring_group:
+        extension_states.mark_answered(route.domain, extension)
+
+
+def bridge_outcome(headers):
+    """BRIDGE_OUTCOMES label for a finished bridge"""
+    return (
+        headers.get("variable_originate_disposition")
+        or headers.get("variable_bridge_hangup_cause")
+        or "UNKNOWN"
+    )
 
-        logger.info(f"📞 Inbound call: {caller_id} -> {called_number} (UUID: {uuid})")
-        logger.info(
-            f"   Store Domain: {store_domain}, Inbound Trunk: {is_inbound_trunk}"
+
+# =============================================================================
+# ADMISSION CONTROL (platform capacity + per-store fairness)
+# =============================================================================
+
+# Hard override for platform capacity (0 = measure from resources)
+ROUTER_MAX_CALLS = int(os.environ.get("ROUTER_MAX_CALLS", "0"))
+# Default share of capacity one store may hold (tenant "max_calls" overrides)
+ROUTER_TENANT_SHARE = float(os.environ.get("ROUTER_TENANT_SHARE", "0.5"))
+# Calls over capacity wait this long for a slot before overflowing
+ROUTER_QUEUE_TIMEOUT = float(os.environ.get("ROUTER_QUEUE_TIMEOUT", "3"))
+ROUTER_MAX_QUEUE = int(os.environ.get("ROUTER_MAX_QUEUE", "200"))
+# Overflow target extension in the store's context ("" = hang up with 503)
+ROUTER_OVERFLOW_EXTENSION = os.environ.get("ROUTER_OVERFLOW_EXTENSION", "")
+
+# Resource cost of one outbound ESL call (socket + greenlet + session state)
+FDS_PER_CALL = 2
+FD_RESERVE = 64
+MEMORY_PER_CALL = 512 * 1024
+MEMORY_SHARE = 0.5
+# An async-controlled call is a small object in a dict: no socket, no greenlet
+ASYNC_FDS_PER_CALL = 0
+ASYNC_MEMORY_PER_CALL = 16 * 1024
+
+
+def measure_call_capacity(fds_per_call=FDS_PER_CALL, memory_per_call=MEMORY_PER_CALL):
+    """Concurrent calls this process can hold, from the fd limit and free memory"""
+    if ROUTER_MAX_CALLS:
+        return ROUTER_MAX_CALLS
+
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if hard != resource.RLIM_INFINITY and soft < hard:
+        try:
+            resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+            soft = hard
+        except (ValueError, OSError):
+            pass
+    by_fds = (soft - FD_RESERVE) // fds_per_call if fds_per_call else sys.maxsize
+
+    by_memory = by_fds
+    try:
+        with open("/proc/meminfo") as f:
+            for line in f:
+                if line.startswith("MemAvailable:"):
+                    available = int(line.split()[1]) * 1024
+                    by_memory = int(available * MEMORY_SHARE) // memory_per_call
+                    break
+    except OSError:
+        pass
+
+    return max(1, min(by_fds, by_memory))
+
+
+class _Waiter:
+    __slots__ = ("tenant", "limit", "event", "granted")
+
+    def __init__(self, tenant, limit):
+        self.tenant = tenant
+        self.limit = limit
+        self.event = gevent.event.Event()
+        self.granted = False
+
+
+class AdmissionController:
+    """
+    Decides whether a call may proceed.
+
+    A call needs a platform slot and a slot under its store's limit.
+    When either is exhausted it waits FIFO for up to the queue deadline;
+    a released slot goes to the oldest waiter whose store is under its
+    limit, so one busy store cannot starve the rest.
+    """
+
+    def __init__(
+        self,
+        capacity,
+        tenant_share=ROUTER_TENANT_SHARE,
+        queue_timeout=ROUTER_QUEUE_TIMEOUT,
+        max_queue=ROUTER_MAX_QUEUE,
+    ):
+        self.capacity = capacity
+        self.tenant_share = tenant_share
+        self.queue_timeout = queue_timeout
+        self.max_queue = max_queue
+        self.active = 0
+        # {tenant: active calls}
+        self.active_by_tenant = {}
+        self.waiters = collections.deque()
+        self.stats = {"admitted": 0, "queued": 0, "rejected": 0, "timed_out": 0}
+
+    def tenant_limit(self, store_config):
+        """Concurrent calls allowed for one store"""
+        configured = store_config.get("max_calls") if store_config else None
+        if configured:
+            return int(configured)
+        return max(1, int(self.capacity * self.tenant_share))
+
+    def _can_admit(self, tenant, limit):
+        return self.active < self.capacity and self.active_by_tenant.get(tenant, 0) < limit
+
+    def try_acquire(self, tenant, limit):
+        """Take a slot only if one is free right now (never waits)"""
+        if not self.waiters and self._can_admit(tenant, limit):
+            self._take(tenant)
+            return True
+        return False
+
+    def _take(self, tenant):
+        self.active += 1
+        self.active_by_tenant[tenant] = self.active_by_tenant.get(tenant, 0) + 1
+        self.stats["admitted"] += 1
+
+    def acquire(self, tenant, limit, timeout=None):
+        """Take a slot for `tenant`, waiting up to `timeout`; False if none came free"""
+        if self.try_acquire(tenant, limit):
+            return True
+
+        if len(self.waiters) >= self.max_queue:
+            self.stats["rejected"] += 1
+            return False
+
+        waiter = _Waiter(tenant, limit)
+        self.waiters.append(waiter)
+        self.stats["queued"] += 1
+        # Another waiter may be blocked only by its own store's limit
+        self._grant_waiters()
+        waiter.event.wait(self.queue_timeout if timeout is None else timeout)
+        if waiter.granted:
+            return True
+
+        self.waiters.remove(waiter)
+        self.stats["timed_out"] += 1
+        return False
+
+    def release(self, tenant):
+        self.active -= 1
+        remaining = self.active_by_tenant.get(tenant, 1) - 1
+        if remaining:
+            self.active_by_tenant[tenant] = remaining
+        else:
+            self.active_by_tenant.pop(tenant, None)
+        self._grant_waiters()
+
+    def _grant_waiters(self):
+        for waiter in list(self.waiters):
+            if self.active >= self.capacity:
+                break
+            if self._can_admit(waiter.tenant, waiter.limit):
+                self.waiters.remove(waiter)
+                self._take(waiter.tenant)
+                waiter.granted = True
+                waiter.event.set()
+
+    def snapshot(self):
+        """Session counts for monitoring"""
+        return dict(
+            self.stats,
+            capacity=self.capacity,
+            active=self.active,
+            waiting=len(self.waiters),
+            active_by_tenant=dict(self.active_by_tenant),
         )
-        logger.info(f"   Original DID: {original_did}")
 
-        # If no store domain from headers, try to determine from DID
-        if not store_domain and called_number:
-            store_domain = self._get_store_from_did(called_number)
-            logger.info(f"   Determined store from DID: {store_domain}")
+
+# Global admission controller (created at startup)
+admission = None
+
+
+# =============================================================================
+# OUTBOUND ESL CALL HANDLER
+# =============================================================================
+
+
+class CallSetupTimer:
+    """Named checkpoints for one call's setup, relative to the connection"""
+
+    __slots__ = ("start", "marks")
+
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.marks = []
+
+    def mark(self, name):
+        self.marks.append((name, time.perf_counter()))
+
+    def total(self):
+        return (self.marks[-1][1] if self.marks else self.start) - self.start
+
+    def summary(self):
+        parts = []
+        previous = self.start
+        for name, at in self.marks:
+            parts.append(f"{name} {(at - previous) * 1000:.1f}ms")
+            previous = at
+        parts.append(f"total {self.total() * 1000:.1f}ms")
+        return ", ".join(parts)
+
+
+class InboundCallHandler(object):
+    """
+    Handle inbound calls from FreeSWITCH via Outbound ESL.
+
+    In the new architecture, this handles calls that come from Kamailio
+    (from SIP trunk) and routes them to the appropriate ring group,
+    sending the call back through Kamailio to reach registered phones.
+    """
+
+    def __init__(self, session):
+        self.session = session
+        # Tenant data is pinned for the life of the call
+        self.snapshot = tenants.current
+        # Store holding an admission slot for this call, if any
+        self.admitted = None
+        self.timer = CallSetupTimer()
+        call_logger.debug("🔌 New FreeSWITCH connection received")
+
+    def run(self):
+        """Main function called when FreeSWITCH connects for a call"""
+        try:
+            self.handle_call()
+        except:
+            call_logger.exception("Exception raised when handling call")
+            self.session.stop()
+        finally:
+            if self.admitted is not None:
+                admission.release(self.admitted)
+                self.admitted = None
+
+    def handle_call(self):
+        """Process the inbound call"""
+        timer = self.timer
+
+        # Get call variables from session_data (populated by connect())
+        data = self.session.session_data
+        caller_id = data.get("Caller-Caller-ID-Number")
+        uuid = data.get("Unique-ID")
+        store_domain = call_store_domain(data, self.snapshot)
+
+        call_logger.info(
+            "📞 Inbound call: %s -> %s (UUID: %s, store domain: %s, inbound trunk: %s, original DID: %s)",
+            caller_id,
+            data.get("Caller-Destination-Number"),
+            uuid,
+            store_domain,
+            data.get("variable_sip_h_X-Inbound-Trunk", ""),
+            data.get("variable_sip_h_X-Original-DID", ""),
+        )
 
         if not store_domain:
-            logger.error("Cannot determine store domain, rejecting call")
+            call_logger.error("Cannot determine store domain, rejecting call")
             self.session.hangup("CALL_REJECTED")
             self.session.stop()
             return
 
         # Get routing decision
-        route = get_route_for_inbound_call(store_domain, caller_id)
-        logger.info(f"Routing decision: {route['action']}")
+        route = get_route_for_inbound_call(store_domain, caller_id, self.snapshot)
+        call_logger.debug("Routing decision: %s", route.action)
+        timer.mark("route")
 
-        if route["action"] == "bridge":
-            # Set channel variables
-            self.session.call_command("set", f"domain_name={route['domain']}")
-            self.session.call_command(
-                "set",
-                f"sip_invite_domain={route.get('sip_invite_domain', route['domain'])}",
+        if route.action == "bridge":
+            if not self._admit(route):
+                self.session.stop()
+                return
+            timer.mark("admission")
+
+            bridge_string = route.bridge_string(caller_id, extension_states)
+            call_logger.info(
+                "Bridging (%s) for %s: %s", route.strategy.kind, route.domain, bridge_string
             )
-            self.session.call_command("set", "ringback=${us-ring}")
-            self.session.call_command("set", "call_timeout=30")
-            self.session.call_command("set", "hangup_after_bridge=true")
-            self.session.call_command("set", "continue_on_fail=true")
 
-            # Answer the call first (required for some SIP trunks)
-            logger.info("Answering call...")
-            self.session.answer()
-            logger.info("Call answered, starting bridge...")
+            # Register for the bridge result before anything is sent
+            bridge_done = gevent.event.AsyncResult()
+            self.session.register_expected_event(
+                "CHANNEL_EXECUTE_COMPLETE", "current_application", "bridge", bridge_done
+            )
 
-            targets = ",".join(route["targets"])
-            # Include X-Store-Domain header so Kamailio knows which domain for location lookup
-            bridge_string = f"{{leg_timeout=30,origination_caller_id_number={caller_id},sip_invite_domain={route['domain']},sip_h_X-Store-Domain={route['domain']}}}{targets}"
-            logger.info(f"Bridging to: {targets} with domain {route['domain']}")
+            # The whole setup goes out in one write: subscribe to our events,
+            # keep receiving them after hangup (linger), set the A-leg
+            # variables, answer (required for some SIP trunks) and bridge.
+            # FreeSWITCH runs queued applications in order.
+            replies = self._pipeline(
+                [
+                    "myevents",
+                    "linger",
+                    route.setup_command,
+                    execute_command("answer"),
+                    execute_command("bridge", bridge_string),
+                ]
+            )
+            timer.mark("setup")
+            CALL_SETUP_SECONDS.observe(timer.total())
+            for reply in replies:
+                if not reply.data.startswith("+OK"):
+                    call_logger.warning("Call setup command failed: %s", reply.data)
+            call_logger.info("⏱ Call setup %s: %s", uuid, timer.summary())
 
             try:
-                # block=True keeps ESL session alive until bridge completes
-                self.session.bridge(bridge_string, block=True)
-                logger.info("✓ Bridge completed (call ended)")
+                # Keeps the ESL session alive until the bridge completes
+                event = bridge_done.get()
+                record_answer(route, event.headers)
+                BRIDGE_OUTCOMES.labels(bridge_outcome(event.headers)).inc()
+                call_logger.info("✓ Bridge completed (call ended)")
             except Exception as e:
-                logger.warning(f"Bridge ended with exception: {type(e).__name__}: {e}")
+                BRIDGE_OUTCOMES.labels("ERROR").inc()
+                call_logger.warning(
+                    "Bridge ended with exception: %s: %s", type(e).__name__, e
+                )
 
-        elif route["action"] == "reject":
-            logger.info(f"✗ Rejecting: {route.get('reason')}")
-            self.session.hangup(route.get("reason", "CALL_REJECTED"))
+        elif route.action == "reject":
+            call_logger.info("✗ Rejecting: %s", route.reason)
+            self.session.hangup(route.reason or "CALL_REJECTED")
 
         # Close the socket only after call is done
         self.session.stop()
 
-    def _get_store_from_did(self, did):
-        """Determine store domain from DID number"""
-        # Normalize DID
-        normalized = (
-            did.replace("+1", "").replace("-", "").replace(" ", "").replace("+", "")
+    def _pipeline(self, commands):
+        """
+        Send several ESL commands in one write and wait for all replies.
+
+        ESL answers commands strictly in order, so each reply is matched
+        to its command through greenswitch's FIFO of pending results.
+        """
+        session = self.session
+        if session._lingering:
+            raise greenswitch.esl.OutboundSessionHasGoneAway()
+        if not session.connected:
+            raise greenswitch.esl.NotConnectedError()
+
+        results = []
+        for _ in commands:
+            result = gevent.event.AsyncResult()
+            session._commands_sent.append(result)
+            results.append(result)
+        session.sock.sendall("".join(f"{c}\n\n" for c in commands).encode("utf-8"))
+        return [result.get() for result in results]
+
+    def _admit(self, route):
+        """Take an admission slot, or send the call to overflow"""
+        if admission is None:
+            return True
+
+        limit = admission.tenant_limit(self.snapshot.stores.get(route.domain))
+        if admission.acquire(route.domain, limit):
+            self.admitted = route.domain
+            return True
+
+        call_logger.warning("⛔ No capacity for %s: %s", route.domain, admission.snapshot())
+        if ROUTER_OVERFLOW_EXTENSION:
+            self.session.call_command(
+                "transfer", f"{ROUTER_OVERFLOW_EXTENSION} XML {route.context}"
+            )
+        else:
+            # 503 lets the trunk fail over to another destination
+            self.session.hangup("NORMAL_CIRCUIT_CONGESTION")
+        return False
+
+
+# =============================================================================
+# ASYNC CALL CONTROL (parked calls driven over inbound ESL with bgapi)
+# =============================================================================
+
+# "outbound": the dialplan hands each call to us with `socket` (one TCP
+# connection and one greenlet per call). "async": the dialplan parks the
+# call and a few persistent inbound connections drive it with bgapi.
+# Must match router_call_mode in freeswitch-conf/vars.xml.
+ROUTER_CALL_MODE = os.environ.get("ROUTER_CALL_MODE", "outbound")
+# Command-only connections per node used to send bgapi (events arrive on
+# the node's main one)
+ROUTER_CONTROL_CONNECTIONS = int(os.environ.get("ROUTER_CONTROL_CONNECTIONS", "2"))
+# A job with no BACKGROUND_JOB result after this long has failed
+CALL_CONTROL_JOB_TIMEOUT = 10
+
+# Characters that would split or unquote a bgapi argument
+_COMMAND_UNSAFE = str.maketrans("", "", " '~")
+
+CALL_CONTROL_HEADERS = (
+    "Caller-Caller-ID-Number",
+    "Caller-Destination-Number",
+    "variable_sip_h_X-Store-Domain",
+    "variable_sip_h_X-Inbound-Trunk",
+    "variable_sip_h_X-Original-DID",
+    "variable_domain_name",
+    "variable_sip_invite_domain",
+    "variable_router_control",
+    "variable_originate_disposition",
+    "variable_bridge_hangup_cause",
+    "variable_bridge_channel",
+    "Job-UUID",
+)
+
+
+class CallControlPool:
+    """
+    Persistent inbound ESL connections that only send commands.
+
+    bgapi is acknowledged at once with a command/reply; the result comes
+    later as a BACKGROUND_JOB event carrying the Job-UUID we chose, on the
+    main (subscribed) connection. Nothing here waits for either: replies
+    are matched to commands through greenswitch's FIFO and a failed one
+    is reported through `on_error`, called from a greenlet of its own.
+    """
+
+    def __init__(self, size, host, port, password):
+        self.host = host
+        self.port = port
+        self.password = password
+        self.links = [None] * size
+        # One writer at a time per connection keeps commands and their
+        # FIFO entries in the same order
+        self.locks = [gevent.lock.Semaphore() for _ in range(size)]
+        self._next = itertools.count()
+        self._greenlets = []
+        self.stats = {"sent": 0, "failed": 0, "connects": 0}
+
+    def start(self):
+        for index in range(len(self.links)):
+            self._greenlets.append(gevent.spawn(self._maintain, index))
+
+    def stop(self):
+        gevent.killall(self._greenlets)
+        self._greenlets = []
+
+    def connected(self):
+        return sum(1 for link in self.links if link is not None)
+
+    def _maintain(self, index):
+        attempt = 0
+        while True:
+            inbound = ProjectedInboundESL(
+                host=self.host, port=self.port, password=self.password, headers=()
+            )
+            try:
+                inbound.connect()
+                self.links[index] = inbound
+                self.stats["connects"] += 1
+                attempt = 0
+                esl_logger.info("🎛 Call control connection %s up", index)
+                inbound._receive_events_greenlet.join()
+                esl_logger.warning("Call control connection %s lost", index)
+            except Exception as e:
+                esl_logger.error("Call control connection %s failed: %s", index, e)
+            finally:
+                self.links[index] = None
+                close_inbound(inbound)
+            gevent.sleep(reconnect_delay(attempt))
+            attempt += 1
+
+    def bgapi(self, command, job_uuid, on_error):
+        """Queue `command` as a background job; never blocks on FreeSWITCH"""
+        for _ in range(len(self.links)):
+            index = next(self._next) % len(self.links)
+            inbound = self.links[index]
+            if inbound is not None and inbound.connected:
+                break
+        else:
+            self.stats["failed"] += 1
+            on_error(job_uuid, "no call control connection")
+            return
+
+        result = gevent.event.AsyncResult()
+        result.rawlink(lambda reply: self._replied(reply, job_uuid, on_error))
+        with self.locks[index]:
+            inbound._commands_sent.append(result)
+            try:
+                inbound.sock.sendall(f"bgapi {command}\nJob-UUID: {job_uuid}\n\n".encode())
+                self.stats["sent"] += 1
+            except OSError as e:
+                inbound._commands_sent.remove(result)
+                result.set_exception(e)
+
+    def _replied(self, reply, job_uuid, on_error):
+        # rawlink callbacks run in the hub, where on_error must not run: it
+        # usually sends another command, which can wait on a lock or a full
+        # socket. Hand it to its own greenlet.
+        if not reply.successful():
+            self.stats["failed"] += 1
+            gevent.spawn(on_error, job_uuid, f"{type(reply.exception).__name__}: {reply.exception}")
+        elif not reply.value.data.startswith("+OK"):
+            self.stats["failed"] += 1
+            gevent.spawn(on_error, job_uuid, reply.value.data)
+
+
+class AsyncCall:
+    """One parked call; `state` goes parked -> (queued) -> bridging / ending"""
+
+    __slots__ = ("uuid", "caller_id", "node", "route", "state", "admitted", "timer")
+
+    def __init__(self, call_uuid, caller_id, node):
+        self.uuid = call_uuid
+        self.caller_id = caller_id
+        self.node = node
+        self.route = None
+        self.state = "parked"
+        self.admitted = None
+        self.timer = CallSetupTimer()
+
+
+class CallController:
+    """
+    Every async call as a small state machine advanced by events.
+
+    CHANNEL_PARK starts a call, BACKGROUND_JOB results move it on and
+    CHANNEL_HANGUP_COMPLETE ends it. Handlers never wait on FreeSWITCH, so
+    the cost of a call is one AsyncCall and a couple of bgapi jobs; only a
+    call queued for admission holds a greenlet while it waits. Commands
+    go to the node the call is parked on, through that node's pool.
+    """
+
+    def __init__(self, connections=ROUTER_CONTROL_CONNECTIONS, job_timeout=CALL_CONTROL_JOB_TIMEOUT):
+        self.connections = connections
+        self.job_timeout = job_timeout
+        # {node name: CallControlPool}
+        self.pools = {}
+        self._started = False
+        # {channel uuid: AsyncCall}
+        self.calls = {}
+        # {job uuid: (channel uuid, step, deadline)}
+        self.jobs = {}
+        self.stats = {
+            "parked": 0,
+            "bridged": 0,
+            "rejected": 0,
+            "overflowed": 0,
+            "ended": 0,
+            "job_errors": 0,
+            "job_timeouts": 0,
+        }
+
+    def start(self):
+        self._started = True
+        for node in cluster.nodes.values():
+            self.add_node(node)
+        for pool in self.pools.values():
+            pool.start()
+        gevent.spawn(self._expire_jobs)
+
+    def add_node(self, node):
+        if node.name in self.pools:
+            return
+        pool = CallControlPool(self.connections, node.host, node.esl_port, node.password)
+        self.pools[node.name] = pool
+        if self._started:
+            pool.start()
+
+    def remove_node(self, name):
+        pool = self.pools.pop(name, None)
+        if pool is not None:
+            pool.stop()
+        for call_uuid in [u for u, call in self.calls.items() if call.node == name]:
+            self._end(self.calls.pop(call_uuid))
+
+    def connected(self):
+        return sum(pool.connected() for pool in self.pools.values())
+
+    def command_stats(self):
+        """CallControlPool stats summed over nodes"""
+        totals = collections.Counter()
+        for pool in self.pools.values():
+            totals.update(pool.stats)
+        return dict(totals)
+
+    def snapshot(self):
+        return dict(
+            self.stats,
+            active=len(self.calls),
+            jobs=len(self.jobs),
+            connections=self.connected(),
+        )
+
+    # -- events ---------------------------------------------------------------
+
+    def on_park(self, headers, node):
+        call_uuid = headers.get("Unique-ID")
+        if not call_uuid or call_uuid in self.calls:
+            return
+        snapshot = tenants.current
+        caller_id = headers.get("Caller-Caller-ID-Number", "").translate(_COMMAND_UNSAFE)
+        call = AsyncCall(call_uuid, caller_id, node)
+        self.calls[call_uuid] = call
+        self.stats["parked"] += 1
+
+        store_domain = call_store_domain(headers, snapshot)
+        call_logger.info(
+            "📞 Parked call: %s -> %s (UUID: %s, store domain: %s)",
+            caller_id,
+            headers.get("Caller-Destination-Number"),
+            call_uuid,
+            store_domain,
+        )
+        if not store_domain:
+            call_logger.error("Cannot determine store domain, rejecting call")
+            self._reject(call, "CALL_REJECTED")
+            return
+
+        route = get_route_for_inbound_call(store_domain, caller_id, snapshot)
+        call.route = route
+        call.timer.mark("route")
+        if route.action != "bridge":
+            call_logger.info("✗ Rejecting: %s", route.reason)
+            self._reject(call, "CALL_REJECTED")
+            return
+
+        if admission is not None:
+            limit = admission.tenant_limit(snapshot.stores.get(route.domain))
+            if not admission.try_acquire(route.domain, limit):
+                call.state = "queued"
+                gevent.spawn(self._wait_for_slot, call, limit)
+                return
+            call.admitted = route.domain
+            call.timer.mark("admission")
+        self._bridge(call)
+
+    def on_job(self, headers, body):
+        entry = self.jobs.pop(headers.get("Job-UUID"), None)
+        if entry is None:
+            # Not ours, or already timed out
+            return
+        call_uuid, step, _ = entry
+        if not body.startswith("+OK"):
+            self._job_failed(call_uuid, step, body.strip())
+            return
+        call = self.calls.get(call_uuid)
+        if step == "bridge" and call is not None:
+            call.timer.mark("setup")
+            CALL_SETUP_SECONDS.observe(call.timer.total())
+            call_logger.info("⏱ Call setup %s: %s", call_uuid, call.timer.summary())
+
+    def on_hangup(self, headers):
+        call = self.calls.pop(headers.get("Unique-ID"), None)
+        if call is None:
+            return
+        if call.state == "bridging":
+            record_answer(call.route, headers)
+            BRIDGE_OUTCOMES.labels(bridge_outcome(headers)).inc()
+            call_logger.info("✓ Bridge completed (call ended)")
+        self._end(call)
+
+    def resync(self, channels, fetched_at, inbound, node):
+        """
+        Forget calls on `node` that ended during an ESL gap and pick up
+        calls that were parked during it (the CHANNEL_PARK event was never
+        seen). Calls parked after the channel list was fetched are left
+        alone.
+        """
+        gone = [
+            call_uuid
+            for call_uuid, call in self.calls.items()
+            if call.node == node
+            and call_uuid not in channels
+            and call.timer.start < fetched_at
+        ]
+        for call_uuid in gone:
+            self._end(self.calls.pop(call_uuid))
+
+        adopted = 0
+        for call_uuid, row in channels.items():
+            if row.get("application") != "park" or call_uuid in self.calls:
+                continue
+            dump = inbound.send(f"api uuid_dump {call_uuid}").data
+            headers = parse_event_headers(dump, CALL_CONTROL_HEADERS + ("Unique-ID",))
+            if headers.get("variable_router_control") == "async":
+                self.on_park(headers, node)
+                adopted += 1
+        if gone or adopted:
+            esl_logger.info(
+                "🔄 Call control resync on %s: %s call(s) gone, %s parked call(s) picked up",
+                node,
+                len(gone),
+                adopted,
+            )
+
+    # -- steps ----------------------------------------------------------------
+
+    def _wait_for_slot(self, call, limit):
+        domain = call.route.domain
+        granted = admission.acquire(domain, limit)
+        if call.uuid not in self.calls:
+            # Caller hung up while queued
+            if granted:
+                admission.release(domain)
+            return
+        if granted:
+            call.admitted = domain
+            call.timer.mark("admission")
+            self._bridge(call)
+            return
+
+        call_logger.warning("⛔ No capacity for %s: %s", domain, admission.snapshot())
+        self.stats["overflowed"] += 1
+        if ROUTER_OVERFLOW_EXTENSION:
+            call.state = "ending"
+            self._command(
+                call,
+                "overflow",
+                f"uuid_transfer {call.uuid} {ROUTER_OVERFLOW_EXTENSION} XML {call.route.context}",
+            )
+        else:
+            # 503 lets the trunk fail over to another destination
+            self._reject(call, "NORMAL_CIRCUIT_CONGESTION")
+
+    def _bridge(self, call):
+        route = call.route
+        bridge_string = route.bridge_string(call.caller_id, extension_states)
+        call_logger.info(
+            "Bridging (%s) for %s: %s", route.strategy.kind, route.domain, bridge_string
+        )
+        call.state = "bridging"
+        self.stats["bridged"] += 1
+        # Leaves the park and runs multiset, answer and bridge on the channel
+        self._command(
+            call, "bridge", f"uuid_transfer {call.uuid} '{route.inline_setup}{bridge_string}' inline"
+        )
+
+    def _reject(self, call, cause):
+        self.stats["rejected"] += 1
+        call.state = "ending"
+        self._command(call, "hangup", f"uuid_kill {call.uuid} {cause}")
+
+    def _command(self, call, step, command):
+        job_uuid = str(uuid_module.uuid4())
+        self.jobs[job_uuid] = (call.uuid, step, time.monotonic() + self.job_timeout)
+        pool = self.pools.get(call.node)
+        if pool is None:
+            self._command_failed(job_uuid, f"unknown node {call.node}")
+            return
+        pool.bgapi(command, job_uuid, self._command_failed)
+
+    def _command_failed(self, job_uuid, reason):
+        entry = self.jobs.pop(job_uuid, None)
+        if entry is not None:
+            self._job_failed(entry[0], entry[1], reason)
+
+    def _job_failed(self, call_uuid, step, reason):
+        self.stats["job_errors"] += 1
+        call_logger.warning("Call control %s failed for %s: %s", step, call_uuid, reason)
+        call = self.calls.get(call_uuid)
+        if call is None:
+            return
+        if step == "hangup":
+            # The channel is most likely gone already; stop tracking it
+            self._end(self.calls.pop(call_uuid))
+        else:
+            self._reject(call, "NORMAL_TEMPORARY_FAILURE")
+
+    def _end(self, call):
+        self.stats["ended"] += 1
+        if call.admitted is not None:
+            admission.release(call.admitted)
+            call.admitted = None
+
+    def _expire_jobs(self):
+        while True:
+            gevent.sleep(1)
+            now = time.monotonic()
+            expired = [job for job, (_, _, deadline) in self.jobs.items() if deadline < now]
+            for job_uuid in expired:
+                call_uuid, step, _ = self.jobs.pop(job_uuid)
+                self.stats["job_timeouts"] += 1
+                self._job_failed(call_uuid, step, "no BACKGROUND_JOB result")
+
+
+# Global call controller (async mode only)
+call_control = None
+
+
+@subscribe("CHANNEL_PARK", headers=CALL_CONTROL_HEADERS)
+def handle_call_park(event):
+    headers = event.headers
+    if call_control and headers.get("variable_router_control") == "async":
+        call_control.on_park(headers, event.node)
+
+
+@subscribe("BACKGROUND_JOB", headers=("Job-UUID",))
+def handle_background_job(event):
+    if call_control:
+        call_control.on_job(event.headers, getattr(event, "data", "") or "")
+
+
+@subscribe("CHANNEL_HANGUP_COMPLETE", headers=CALL_CONTROL_HEADERS)
+def handle_call_hangup(event):
+    if call_control:
+        call_control.on_hangup(event.headers)
+
+
+# =============================================================================
+# CALL DETAIL RECORDS (hangup events -> batched SQLite, spooled to disk)
+# =============================================================================
+
+# "" turns CDRs off
+CDR_DB = os.environ.get("ROUTER_CDR_DB", "/var/lib/fs-ec2/cdr.db")
+# Records are appended here as they arrive and deleted once committed, so a
+# crash or a failing database loses nothing
+CDR_SPOOL_DIR = os.environ.get("ROUTER_CDR_SPOOL", "/var/lib/fs-ec2/cdr-spool")
+# A batch is written when this many records are waiting, or every interval
+CDR_BATCH_SIZE = 1000
+CDR_FLUSH_INTERVAL = 1.0
+# Records held in memory at most; past this they are read back from the spool
+CDR_MAX_PENDING = 50000
+# Uncommitted spool segments (roughly seconds of a failing database) before
+# the writer logs an error and /health reports it
+CDR_BACKLOG_ALERT = int(os.environ.get("ROUTER_CDR_BACKLOG_ALERT", "300"))
+
+# (column, SQLite type) in record order; one record per channel (leg)
+CDR_COLUMNS = (
+    ("uuid", "TEXT PRIMARY KEY"),
+    ("node", "TEXT"),
+    ("store", "TEXT"),
+    ("direction", "TEXT"),
+    ("caller", "TEXT"),
+    ("destination", "TEXT"),
+    ("other_leg", "TEXT"),
+    ("created_at", "REAL"),
+    ("answered_at", "REAL"),
+    ("ended_at", "REAL"),
+    ("billsec", "INTEGER"),
+    ("hangup_cause", "TEXT"),
+    ("sip_status", "TEXT"),
+)
+
+CDR_HEADERS = (
+    "Call-Direction",
+    "Caller-Caller-ID-Number",
+    "Caller-Destination-Number",
+    "Other-Leg-Unique-ID",
+    "Caller-Channel-Created-Time",
+    "Caller-Channel-Answered-Time",
+    "Caller-Channel-Hangup-Time",
+    "Hangup-Cause",
+    "variable_billsec",
+    "variable_sip_term_status",
+    "variable_sip_h_X-Store-Domain",
+    "variable_sip_invite_domain",
+    "variable_domain_name",
+    "variable_sip_from_host",
+)
+
+
+def _epoch(microseconds):
+    """FreeSWITCH *-Time headers are microseconds since the epoch, 0 if never"""
+    try:
+        value = int(microseconds)
+    except (TypeError, ValueError):
+        return None
+    return value / 1_000_000 if value else None
+
+
+def call_record(headers, node):
+    """Tuple in CDR_COLUMNS order for one CHANNEL_HANGUP_COMPLETE"""
+    store = (
+        headers.get("variable_sip_h_X-Store-Domain")
+        or headers.get("variable_sip_invite_domain")
+        or headers.get("variable_domain_name")
+        or headers.get("variable_sip_from_host")
+    )
+    try:
+        billsec = int(headers.get("variable_billsec") or 0)
+    except ValueError:
+        billsec = 0
+    return (
+        headers.get("Unique-ID"),
+        node,
+        store,
+        headers.get("Call-Direction"),
+        headers.get("Caller-Caller-ID-Number"),
+        headers.get("Caller-Destination-Number"),
+        headers.get("Other-Leg-Unique-ID"),
+        _epoch(headers.get("Caller-Channel-Created-Time")),
+        _epoch(headers.get("Caller-Channel-Answered-Time")),
+        _epoch(headers.get("Caller-Channel-Hangup-Time")),
+        billsec,
+        headers.get("Hangup-Cause"),
+        headers.get("variable_sip_term_status"),
+    )
+
+
+class CdrWriter:
+    """
+    Streams call records into SQLite in batches.
+
+    submit() appends the record to the current spool segment (one JSON
+    line, flushed to the OS) and keeps it in memory. Every flush rotates
+    the segment and commits its records in one transaction on the hub's
+    thread pool, so the event loop never waits on the disk; the segment
+    file is deleted once the commit succeeds. A failed commit leaves the
+    segment on disk for the next flush, and segments left by a crash are
+    replayed at start. uuid is the primary key, so replaying a segment
+    that was already committed is harmless.
+
+    Backpressure: past max_pending the records of the current segment
+    are no longer kept in memory and are read back from the spool file
+    when it is committed. Once a commit fails, the whole backlog is
+    dropped from memory too and replayed from disk, so a long database
+    outage costs disk rather than memory; past backlog_alert segments
+    it is logged as an error and flagged in snapshot().
+    """
+
+    def __init__(
+        self,
+        path=CDR_DB,
+        spool_dir=CDR_SPOOL_DIR,
+        batch_size=CDR_BATCH_SIZE,
+        flush_interval=CDR_FLUSH_INTERVAL,
+        max_pending=CDR_MAX_PENDING,
+        backlog_alert=CDR_BACKLOG_ALERT,
+    ):
+        self.path = path
+        self.spool_dir = spool_dir
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_pending = max_pending
+        self.backlog_alert = backlog_alert
+        self.alerting = False
+        self.pending = []
+        self.overflowed = False
+        # [(segment path, records or None to read the file)], oldest first
+        self.backlog = []
+        self.stats = {
+            "records": 0,
+            "written": 0,
+            "batches": 0,
+            "failed_batches": 0,
+            "spool_reads": 0,
+            "overflowed": 0,
+            "backlog_alerts": 0,
+        }
+        self._segment = None
+        self._segment_path = None
+        self._wake = gevent.event.Event()
+        # The commit yields to the thread pool; one flush at a time
+        self._flush_lock = gevent.lock.Semaphore()
+
+        if path != ":memory:":
+            os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        os.makedirs(spool_dir, exist_ok=True)
+        self.db = sqlite3.connect(path, isolation_level=None, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.execute(
+            f"CREATE TABLE IF NOT EXISTS cdr ({', '.join(' '.join(c) for c in CDR_COLUMNS)})"
+        )
+        # Covers the per-store volume and hangup-cause aggregates (cdr_query.py)
+        self.db.execute(
+            "CREATE INDEX IF NOT EXISTS cdr_by_time"
+            " ON cdr (ended_at, store, direction, hangup_cause, answered_at, billsec)"
+        )
+        self._insert = (
+            f"INSERT OR IGNORE INTO cdr VALUES ({', '.join('?' * len(CDR_COLUMNS))})"
+        )
+
+    def start(self):
+        self.backlog = [
+            (os.path.join(self.spool_dir, name), None)
+            for name in sorted(os.listdir(self.spool_dir))
+            if name.endswith(".jsonl")
+        ]
+        if self.backlog:
+            cdr_logger.info("🧾 Replaying %d CDR spool segment(s)", len(self.backlog))
+        self._open_segment()
+        gevent.spawn(self._run)
+
+    def _open_segment(self):
+        # Names sort in creation order
+        self._segment_path = os.path.join(
+            self.spool_dir, f"{time.time_ns():020d}-{os.getpid()}.jsonl"
         )
-        if normalized.startswith("1") and len(normalized) == 11:
-            normalized = normalized[1:]
+        self._segment = open(self._segment_path, "a")
+
+    def submit(self, record):
+        self._segment.write(json.dumps(record) + "\n")
+        self._segment.flush()
+        self.stats["records"] += 1
+        if len(self.pending) < self.max_pending:
+            self.pending.append(record)
+        else:
+            self.overflowed = True
+            self.stats["overflowed"] += 1
+        if len(self.pending) >= self.batch_size:
+            self._wake.set()
+
+    def _run(self):
+        while True:
+            self._wake.wait(self.flush_interval)
+            self._wake.clear()
+            try:
+                self.flush()
+            except Exception:
+                cdr_logger.exception("CDR flush failed")
+
+    def flush(self):
+        """Commit the current segment and anything left in the backlog"""
+        with self._flush_lock:
+            self._flush()
+
+    def _flush(self):
+        if self.pending or self.overflowed:
+            records = None if self.overflowed else self.pending
+            self._segment.close()
+            self.backlog.append((self._segment_path, records))
+            self.pending = []
+            self.overflowed = False
+            self._open_segment()
+
+        while self.backlog:
+            path, records = self.backlog[0]
+            if records is None:
+                records = self._read_segment(path)
+            start = time.perf_counter()
+            error = gevent.get_hub().threadpool.apply(self._commit, (records,))
+            if error is not None:
+                self.stats["failed_batches"] += 1
+                cdr_logger.warning(
+                    "CDR batch of %d not written, kept in %s: %s", len(records), path, error
+                )
+                # Everything is on disk; hold none of it in memory meanwhile
+                self.backlog = [(path, None) for path, _ in self.backlog]
+                self._check_backlog()
+                return
+            self.backlog.pop(0)
+            os.remove(path)
+            self.stats["batches"] += 1
+            self.stats["written"] += len(records)
+            cdr_logger.debug(
+                "CDR batch of %s written in %.1f ms",
+                len(records),
+                (time.perf_counter() - start) * 1000,
+            )
+        self._check_backlog()
+
+    def _check_backlog(self):
+        if len(self.backlog) >= self.backlog_alert:
+            if not self.alerting:
+                self.alerting = True
+                self.stats["backlog_alerts"] += 1
+                cdr_logger.error(
+                    "🧾 %d CDR segments waiting in %s, database not taking writes",
+                    len(self.backlog),
+                    self.spool_dir,
+                )
+        elif self.alerting:
+            self.alerting = False
+            cdr_logger.info("🧾 CDR backlog down to %d segment(s)", len(self.backlog))
 
-        for domain, config in STORES.items():
-            if normalized == config["did"]:
-                return domain
+    def _read_segment(self, path):
+        self.stats["spool_reads"] += 1
+        records = []
+        with open(path) as f:
+            for line in f:
+                try:
+                    records.append(tuple(json.loads(line)))
+                except ValueError:
+                    # Last line cut short by a crash
+                    continue
+        return records
 
+    def _commit(self, records):
+        """Runs on a native thread; returns the error instead of raising it"""
+        try:
+            self.db.execute("BEGIN IMMEDIATE")
+        except sqlite3.Error as e:
+            return e
+        try:
+            self.db.executemany(self._insert, records)
+            self.db.execute("COMMIT")
+        except sqlite3.Error as e:
+            self.db.execute("ROLLBACK")
+            return e
         return None
 
+    def snapshot(self):
+        return dict(
+            self.stats,
+            pending=len(self.pending),
+            backlog=len(self.backlog),
+            backlog_alert=self.alerting,
+        )
+
+
+# Global CDR writer (created by run_inbound_esl unless CDR_DB is empty)
+cdr_writer = None
+
+
+@subscribe("CHANNEL_HANGUP_COMPLETE", headers=CDR_HEADERS)
+def handle_call_record(event):
+    if cdr_writer:
+        cdr_writer.submit(call_record(event.headers, event.node))
+
+
+# =============================================================================
+# HTTP STATUS (readiness / health)
+# =============================================================================
+
+ROUTER_HTTP_PORT = int(os.environ.get("ROUTER_HTTP_PORT", "5003"))
+
+
+class RouterStatsCollector:
+    """
+    Exports the counters and gauges the router already keeps, read at
+    scrape time so the hot paths pay nothing extra for them.
+    """
+
+    def collect(self):
+        counters = []
+        if presence_publisher:
+            counters.append(("router_sip_transport", presence_publisher.transport.stats))
+        if presence_dispatcher:
+            counters.append(("router_presence", presence_dispatcher.stats))
+        if event_dispatcher:
+            counters.append(("router_esl_events", event_dispatcher.stats))
+        if admission:
+            counters.append(("router_admission", admission.stats))
+        if call_control:
+            counters.append(("router_call_control", call_control.stats))
+            counters.append(("router_call_control_commands", call_control.command_stats()))
+        if cdr_writer:
+            counters.append(("router_cdr", cdr_writer.stats))
+        counters.append(("router_cluster", cluster.stats))
+        if affinity:
+            counters.append(("router_kamailio_affinity", affinity.stats))
+        for prefix, stats in counters:
+            for name, value in stats.items():
+                yield CounterMetricFamily(f"{prefix}_{name}", f"{prefix} {name}", value=value)
+
+        # Per FreeSWITCH node
+        stores = collections.Counter(cluster.assignment.values())
+        per_node = {
+            "router_esl_connected": lambda node: int(node.link.connected),
+            "router_esl_ready": lambda node: int(node.link.is_ready()),
+            "router_esl_connects": lambda node: node.link.connects,
+            "router_node_stores": lambda node: stores.get(node.name, 0),
+        }
+        for name, value in per_node.items():
+            family = GaugeMetricFamily(name, name.replace("_", " "), labels=["node"])
+            for node in cluster.nodes.values():
+                family.add_metric([node.name], value(node))
+            yield family
+
+        gauges = {}
+
+        for name, value in extension_states.snapshot().items():
+            gauges[f"router_extensions_{name}"] = value
+        if event_dispatcher:
+            gauges["router_esl_event_queue_depth"] = sum(event_dispatcher.queue_depths())
+        if presence_dispatcher:
+            gauges["router_presence_pending"] = len(presence_dispatcher.pending)
+        if admission:
+            gauges["router_calls_active"] = admission.active
+            gauges["router_calls_waiting"] = len(admission.waiters)
+            gauges["router_calls_capacity"] = admission.capacity
+        if call_control:
+            gauges["router_call_control_active"] = len(call_control.calls)
+            gauges["router_call_control_jobs"] = len(call_control.jobs)
+            gauges["router_call_control_connections"] = call_control.connected()
+        if cdr_writer:
+            gauges["router_cdr_pending"] = len(cdr_writer.pending)
+            gauges["router_cdr_backlog_segments"] = len(cdr_writer.backlog)
+            gauges["router_cdr_backlog_alert"] = int(cdr_writer.alerting)
+        for name, value in gauges.items():
+            yield GaugeMetricFamily(name, name.replace("_", " "), value=value)
+
+
+REGISTRY.register(RouterStatsCollector())
+
+
+def _json_response(start_response, status, payload):
+    body = json.dumps(payload).encode()
+    start_response(
+        status,
+        [("Content-Type", "application/json"), ("Content-Length", str(len(body)))],
+    )
+    return [body]
+
+
+def status_app(environ, start_response):
+    """
+    /ready    - 200 while the inbound ESL connection to at least one
+                FreeSWITCH node is up, resynced and hearing heartbeats,
+                503 otherwise
+    /health   - 200 while the process runs, with internal stats
+    /affinity - store -> node assignment
+    /metrics  - Prometheus text format
+    """
+    path = environ.get("PATH_INFO", "")
+    if path == "/metrics":
+        body = generate_latest(REGISTRY)
+        start_response(
+            "200 OK",
+            [("Content-Type", CONTENT_TYPE_LATEST), ("Content-Length", str(len(body)))],
+        )
+        return [body]
+    if path == "/ready":
+        ready = cluster.is_ready()
+        return _json_response(
+            start_response,
+            "200 OK" if ready else "503 Service Unavailable",
+            {"ready": ready, "nodes": cluster.snapshot()},
+        )
+    if path == "/affinity":
+        return _json_response(
+            start_response,
+            "200 OK",
+            {"healthy": sorted(cluster.healthy()), "stores": cluster.assignment},
+        )
+    if path == "/health":
+        return _json_response(
+            start_response,
+            "200 OK",
+            {
+                "status": "ok",
+                "nodes": cluster.snapshot(),
+                "cluster": cluster.stats,
+                "events": event_dispatcher.snapshot() if event_dispatcher else None,
+                "presence": presence_dispatcher.stats if presence_dispatcher else None,
+                "extensions": extension_states.snapshot(),
+                "admission": admission.snapshot() if admission else None,
+                "call_control": call_control.snapshot() if call_control else None,
+                "cdr": cdr_writer.snapshot() if cdr_writer else None,
+            },
+        )
+    return _json_response(start_response, "404 Not Found", {"error": "not found"})
+
 
 # =============================================================================
 # MAIN - Run both Outbound ESL Server and Inbound ESL Client
@@ -477,15 +4124,57 @@ if __name__ == "__main__":
     logger.info("=" * 60)
     logger.info("")
     logger.info("Architecture: Kamailio -> FreeSWITCH -> Kamailio")
-    logger.info(f"  Kamailio: {KAMAILIO_HOST}:{KAMAILIO_PORT}")
-    logger.info(f"  FreeSWITCH ESL: {FREESWITCH_HOST}:{FREESWITCH_ESL_PORT}")
+    logger.info("  Kamailio: %s:%s", KAMAILIO_HOST, KAMAILIO_PORT)
+    for name, node in node_specs(tenants.current).items():
+        logger.info("  FreeSWITCH ESL (%s): %s:%s", name, node["host"], node["esl_port"])
+    logger.info("  Tenants: %s (%d stores)", TENANTS_FILE, len(tenants.current.stores))
     logger.info("")
 
+    # Pick up tenant file and log level changes without a restart
+    tenants.start()
+    gevent.spawn(watch_log_levels)
+
+    # Readiness / health endpoints
+    gevent.pywsgi.WSGIServer(
+        ("0.0.0.0", ROUTER_HTTP_PORT), status_app, log=None
+    ).start()
+    logger.info(
+        "🩺 Status endpoints on 0.0.0.0:%d (/ready, /health, /affinity, /metrics)", ROUTER_HTTP_PORT
+    )
+
+    # Kamailio steers each store's calls to its node
+    affinity = KamailioAffinity()
+    affinity.start()
+
     # Start Inbound ESL client for presence events (in background greenlet)
     logger.info("🚀 Starting Inbound ESL client for presence events...")
     gevent.spawn(run_inbound_esl)
 
-    # Start Outbound ESL server for call routing (main greenlet)
+    # Admission control replaces a fixed connection cap
+    if ROUTER_CALL_MODE == "async":
+        admission = AdmissionController(
+            measure_call_capacity(ASYNC_FDS_PER_CALL, ASYNC_MEMORY_PER_CALL)
+        )
+    else:
+        admission = AdmissionController(measure_call_capacity())
+    logger.info(
+        "🚦 Call capacity %d, queue %d (deadline %ss)",
+        admission.capacity,
+        admission.max_queue,
+        admission.queue_timeout,
+    )
+
+    if ROUTER_CALL_MODE == "async":
+        call_control = CallController()
+        call_control.start()
+        logger.info(
+            "🎛 Async call control: parked calls driven over %d inbound ESL connection(s) per node",
+            ROUTER_CONTROL_CONNECTIONS,
+        )
+
+    # Start Outbound ESL server for call routing (main greenlet). Kept in
+    # async mode too, so calls still handed over with `socket` while the
+    # dialplan and the router switch modes are not lost.
     logger.info("🚀 Starting Outbound ESL server on 0.0.0.0:5002...")
     logger.info("Waiting for FreeSWITCH connections...")
 
@@ -493,7 +4182,8 @@ if __name__ == "__main__":
         bind_address="0.0.0.0",
         bind_port=5002,
         application=InboundCallHandler,
-        max_connections=10,
+        # Only a safety net; AdmissionController makes the real decision
+        max_connections=admission.capacity + admission.max_queue,
     )
 
     # This blocks forever, handling connections
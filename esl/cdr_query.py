@@ -0,0 +1,83 @@
+"""
+Aggregates over the router's CDR database (see CdrWriter in call_router.py).
+
+volume: per store, calls (inbound legs), answered calls, talk time and
+        every leg including the ones we dialled
+causes: hangup causes, optionally for one store
+
+Both read only the cdr_by_time index, so a day out of millions of rows
+takes a range scan, not a table scan. Safe to run against the live
+database (WAL mode: readers do not block the writer).
+
+Usage:
+    python cdr_query.py [volume|causes] [--db /var/lib/fs-ec2/cdr.db]
+                        [--hours 24] [--store store1.local] [--limit 50]
+"""
+
+import argparse
+import sqlite3
+import time
+
+
+def connect(path):
+    # Read-only, so a typo in --db does not create an empty database
+    return sqlite3.connect(f"file:{path}?mode=ro", uri=True)
+
+
+def store_volume(db, since, until, limit=None):
+    """[(store, calls, answered, billsec, legs)], busiest first"""
+    return db.execute(
+        "SELECT store,"
+        " SUM(direction = 'inbound') AS calls,"
+        " SUM(direction = 'inbound' AND answered_at IS NOT NULL),"
+        " SUM(CASE WHEN direction = 'inbound' THEN billsec ELSE 0 END),"
+        " COUNT(*)"
+        " FROM cdr WHERE ended_at >= ? AND ended_at < ?"
+        " GROUP BY store ORDER BY calls DESC LIMIT ?",
+        (since, until, limit or -1),
+    ).fetchall()
+
+
+def hangup_causes(db, since, until, store=None, limit=None):
+    """[(hangup cause, legs)], most frequent first"""
+    query = "SELECT hangup_cause, COUNT(*) AS legs FROM cdr WHERE ended_at >= ? AND ended_at < ?"
+    params = [since, until]
+    if store:
+        query += " AND store = ?"
+        params.append(store)
+    query += " GROUP BY hangup_cause ORDER BY legs DESC LIMIT ?"
+    params.append(limit or -1)
+    return db.execute(query, params).fetchall()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("report", nargs="?", default="volume", choices=("volume", "causes"))
+    parser.add_argument("--db", default="/var/lib/fs-ec2/cdr.db")
+    parser.add_argument("--hours", type=float, default=24, help="look back this far")
+    parser.add_argument("--store", help="causes for one store only")
+    parser.add_argument("--limit", type=int, default=50)
+    args = parser.parse_args()
+
+    db = connect(args.db)
+    until = time.time()
+    since = until - args.hours * 3600
+    start = time.perf_counter()
+
+    if args.report == "volume":
+        rows = store_volume(db, since, until, args.limit)
+        print(f"{'store':<30} {'calls':>9} {'answered':>9} {'talk min':>9} {'legs':>9}")
+        for store, calls, answered, billsec, legs in rows:
+            print(f"{store or '-':<30} {calls:>9} {answered:>9} {billsec / 60:>9.0f} {legs:>9}")
+    else:
+        rows = hangup_causes(db, since, until, args.store, args.limit)
+        total = sum(legs for _, legs in rows) or 1
+        print(f"{'hangup cause':<30} {'legs':>9} {'share':>7}")
+        for cause, legs in rows:
+            print(f"{cause or '-':<30} {legs:>9} {legs / total:>7.1%}")
+
+    print(f"({len(rows)} rows, last {args.hours:g}h, {(time.perf_counter() - start) * 1000:.0f} ms)")
+
+
+if __name__ == "__main__":
+    main()
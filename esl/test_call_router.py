@@ -0,0 +1,726 @@
+"""
+Tests for the router: logging, ring strategies and dial-strings, the
+node hash ring, admission control, extension state, SIP response
+parsing, the presence dispatcher and the CDR writer. None of them need
+FreeSWITCH or Kamailio; PUBLISHes go to an in-memory transport.
+
+Usage:
+    python -m pytest -q test_call_router.py
+"""
+
+import io
+import json
+import logging
+import os
+import sqlite3
+import time
+
+os.environ.setdefault("PARK_STATE_DB", ":memory:")
+os.environ.setdefault("ROUTER_CDR_DB", "")
+
+import gevent  # noqa: E402
+import gevent.event  # noqa: E402
+import pytest  # noqa: E402
+
+import call_router  # noqa: E402
+from call_router import (  # noqa: E402
+    AdmissionController,
+    CdrWriter,
+    ExtensionStateTable,
+    HashRing,
+    JsonLogHandler,
+    LogSampler,
+    PresenceDispatcher,
+    PresencePublisher,
+    RING_LEG_TIMEOUT,
+    RingStrategy,
+    Route,
+    SipResponse,
+    bridge_target,
+    call_record,
+    reconnect_delay,
+    render_targets,
+)
+
+DOMAIN = "store1.local"
+RING_GROUP = ("1000", "1001", "1002", "1003", "1004")
+
+
+def leg(extension, delay):
+    return (
+        f"[leg_delay_start={delay},leg_timeout={delay + RING_LEG_TIMEOUT}]"
+        + bridge_target(extension)
+    )
+
+
+# =============================================================================
+# LOGGING
+# =============================================================================
+
+
+def log_record(msg, args=(), level=logging.INFO, created=1700000000.5):
+    record = logging.LogRecord("router.test", level, __file__, 1, msg, args, None)
+    record.created = created
+    return record
+
+
+def test_sampler_passes_a_burst_then_one_in_every():
+    sampler = LogSampler(burst=2, every=5)
+    passed = [
+        index
+        for index in range(1, 13)
+        if sampler.filter(log_record("Call %s ended", (index,)))
+    ]
+    assert passed == [1, 2, 5, 10]
+
+
+def test_sampler_reports_skipped_records_and_resets_each_second():
+    sampler = LogSampler(burst=1, every=3)
+    records = [log_record("Call %s ended", (index,)) for index in range(3)]
+    assert [sampler.filter(record) for record in records] == [True, False, True]
+    assert records[2].sampled == 1
+    # A new second starts a new burst
+    assert sampler.filter(log_record("Call %s ended", (9,), created=1700000001.5))
+    # Templates are sampled independently; errors always pass
+    assert sampler.filter(log_record("Other template"))
+    assert all(sampler.filter(log_record("Call %s ended", (0,), logging.ERROR)) for _ in range(5))
+
+
+def written_lines(stream, count, timeout=2):
+    deadline = time.monotonic() + timeout
+    while stream.getvalue().count("\n") < count and time.monotonic() < deadline:
+        time.sleep(0.01)
+    return stream.getvalue().splitlines()
+
+
+def test_json_handler_writes_records_on_its_thread():
+    stream = io.StringIO()
+    handler = JsonLogHandler(stream)
+    record = log_record("Parked %s in %s", ("+15551234567", "700"))
+    record.sampled = 4
+    handler.emit(record)
+    (line,) = written_lines(stream, 1)
+    entry = json.loads(line)
+    assert entry["msg"] == "Parked +15551234567 in 700"
+    assert entry["sampled_out"] == 4
+    assert entry["logger"] == "router.test"
+
+
+def test_json_handler_reports_errors_and_keeps_writing(monkeypatch):
+    stream = io.StringIO()
+    handler = JsonLogHandler(stream)
+    errors = []
+    monkeypatch.setattr(handler, "handleError", errors.append)
+    bad = log_record("Two args %s %s", ("only one",))
+    handler.emit(bad)
+    handler.emit(log_record("Still logging"))
+    (line,) = written_lines(stream, 1)
+    assert json.loads(line)["msg"] == "Still logging"
+    assert errors == [bad]
+
+
+# =============================================================================
+# RING STRATEGIES
+# =============================================================================
+
+
+def test_simultaneous_rings_everyone_at_once():
+    strategy = RingStrategy({"type": "simultaneous", "skip_unregistered": False})
+    plan = strategy.plan(DOMAIN, RING_GROUP, ExtensionStateTable())
+    assert plan == [(ext, 0) for ext in RING_GROUP]
+    assert render_targets(plan) == ",".join(bridge_target(ext) for ext in RING_GROUP)
+    assert strategy.is_static
+
+
+def test_sequential_rings_one_member_per_wave():
+    strategy = RingStrategy({"type": "staggered", "wave_size": 1, "wave_delay": 15})
+    plan = strategy.plan(DOMAIN, RING_GROUP[:3], ExtensionStateTable())
+    assert plan == [("1000", 0), ("1001", 15), ("1002", 30)]
+    assert render_targets(plan) == ",".join(
+        [bridge_target("1000"), leg("1001", 15), leg("1002", 30)]
+    )
+
+
+def test_staggered_waves():
+    strategy = RingStrategy({"type": "staggered", "wave_size": 2, "wave_delay": 10})
+    plan = strategy.plan(DOMAIN, RING_GROUP, ExtensionStateTable())
+    assert [delay for _, delay in plan] == [0, 0, 10, 10, 20]
+    assert render_targets(plan) == ",".join(
+        [
+            bridge_target("1000"),
+            bridge_target("1001"),
+            leg("1002", 10),
+            leg("1003", 10),
+            leg("1004", 20),
+        ]
+    )
+
+
+def test_least_recent_orders_by_last_answer():
+    states = ExtensionStateTable()
+    states.mark_answered(DOMAIN, "1000", at=300.0)
+    states.mark_answered(DOMAIN, "1001", at=100.0)
+    states.mark_answered(DOMAIN, "1002", at=200.0)
+    strategy = RingStrategy({"type": "least_recent", "wave_delay": 5})
+    # 1003 never answered, so it goes first
+    assert strategy.plan(DOMAIN, RING_GROUP[:4], states) == [
+        ("1003", 0),
+        ("1001", 5),
+        ("1002", 10),
+        ("1000", 15),
+    ]
+
+
+def test_skip_unregistered_prunes_offline_members():
+    states = ExtensionStateTable()
+    states.set_registered(DOMAIN, "1001", False)
+    strategy = RingStrategy({"type": "simultaneous", "skip_unregistered": True})
+    assert not strategy.is_static
+    assert strategy.plan(DOMAIN, RING_GROUP[:3], states) == [("1000", 0), ("1002", 0)]
+
+    # Nobody online: ring everyone rather than nobody
+    for ext in RING_GROUP[:3]:
+        states.set_registered(DOMAIN, ext, False)
+    assert strategy.plan(DOMAIN, RING_GROUP[:3], states) == [(ext, 0) for ext in RING_GROUP[:3]]
+
+
+def test_skip_unregistered_keeps_wave_positions_dense():
+    states = ExtensionStateTable()
+    states.set_registered(DOMAIN, "1000", False)
+    strategy = RingStrategy({"type": "staggered", "wave_size": 1, "wave_delay": 10})
+    plan = strategy.plan(DOMAIN, RING_GROUP[:3], states)
+    assert render_targets(plan) == ",".join([bridge_target("1001"), leg("1002", 10)])
+
+
+def test_skip_busy_prunes_members_on_a_call():
+    states = ExtensionStateTable()
+    states.leg_answered("uuid-1", DOMAIN, "1000")
+    strategy = RingStrategy({"skip_busy": True})
+    assert strategy.plan(DOMAIN, RING_GROUP[:2], states) == [("1001", 0)]
+
+
+def test_unknown_strategy_is_rejected():
+    with pytest.raises(ValueError):
+        RingStrategy({"type": "round_robin"})
+
+
+def test_route_bridge_string():
+    strategy = RingStrategy({"type": "staggered", "wave_size": 1, "wave_delay": 20})
+    route = Route("bridge", DOMAIN, "store1", RING_GROUP[:2], strategy)
+    assert route.bridge_string("+15551234567", ExtensionStateTable()) == (
+        f"{{leg_timeout={RING_LEG_TIMEOUT},origination_caller_id_number=+15551234567,"
+        f"sip_invite_domain={DOMAIN},sip_h_X-Store-Domain={DOMAIN}}}"
+        + ",".join([bridge_target("1000"), leg("1001", 20)])
+    )
+
+
+# =============================================================================
+# ESL RECONNECT
+# =============================================================================
+
+
+def test_reconnect_delay_is_capped_for_long_outages():
+    for attempt in (0, 3, 1023, 1024, 5000):
+        assert 0 <= reconnect_delay(attempt, base=0.5, cap=15) <= 15
+    assert reconnect_delay(0, base=0.5, cap=15) <= 0.5
+
+
+# =============================================================================
+# HASH RING
+# =============================================================================
+
+
+STORES = [f"store{i}.local" for i in range(2000)]
+
+
+def placement(ring, usable=None):
+    return {store: ring.owner(store, usable) for store in STORES}
+
+
+def test_hash_ring_is_deterministic():
+    first, second = HashRing(), HashRing()
+    for name in ("fs1", "fs2", "fs3"):
+        first.add(name)
+    for name in ("fs3", "fs1", "fs2"):
+        second.add(name)
+    assert placement(first) == placement(second)
+    assert set(placement(first).values()) == {"fs1", "fs2", "fs3"}
+
+
+def test_hash_ring_adding_a_node_only_moves_stores_to_it():
+    ring = HashRing()
+    ring.add("fs1")
+    ring.add("fs2")
+    before = placement(ring)
+    ring.add("fs3")
+    after = placement(ring)
+    moved = [store for store in STORES if before[store] != after[store]]
+    assert moved
+    assert all(after[store] == "fs3" for store in moved)
+    # Roughly a third of the stores, not a reshuffle
+    assert len(moved) < len(STORES) / 2
+
+
+def test_hash_ring_removing_a_node_only_moves_its_stores():
+    ring = HashRing()
+    for name in ("fs1", "fs2", "fs3"):
+        ring.add(name)
+    before = placement(ring)
+    ring.remove("fs2")
+    after = placement(ring)
+    for store in STORES:
+        if before[store] != "fs2":
+            assert after[store] == before[store]
+        else:
+            assert after[store] in ("fs1", "fs3")
+
+
+def test_hash_ring_skips_unusable_nodes():
+    ring = HashRing()
+    for name in ("fs1", "fs2", "fs3"):
+        ring.add(name)
+    before = placement(ring)
+    after = placement(ring, usable={"fs1", "fs3"})
+    assert set(after.values()) == {"fs1", "fs3"}
+    assert all(after[store] == before[store] for store in STORES if before[store] != "fs2")
+    assert HashRing().owner("store1.local") is None
+    assert ring.owner("store1.local", usable=set()) is None
+
+
+# =============================================================================
+# ADMISSION CONTROL
+# =============================================================================
+
+
+def test_tenant_limit_from_share_or_store():
+    admission = AdmissionController(10, tenant_share=0.3)
+    assert admission.tenant_limit({}) == 3
+    assert admission.tenant_limit({"max_calls": 7}) == 7
+    assert AdmissionController(2, tenant_share=0.1).tenant_limit(None) == 1
+
+
+def test_tenant_share_caps_one_store():
+    admission = AdmissionController(10, tenant_share=0.2)
+    limit = admission.tenant_limit({})
+    assert admission.try_acquire("a", limit)
+    assert admission.try_acquire("a", limit)
+    assert not admission.try_acquire("a", limit)
+    # The platform still has room for other stores
+    assert admission.try_acquire("b", limit)
+    assert admission.active_by_tenant == {"a": 2, "b": 1}
+
+
+def test_queue_deadline_times_out():
+    admission = AdmissionController(1, queue_timeout=0.05)
+    assert admission.acquire("a", 1)
+    assert not admission.acquire("b", 1)
+    assert admission.stats["timed_out"] == 1
+    assert not admission.waiters
+
+
+def test_released_slot_goes_to_oldest_eligible_waiter():
+    admission = AdmissionController(2, queue_timeout=1)
+    assert admission.acquire("a", 1)
+    assert admission.acquire("b", 2)
+    # "a" is at its own limit, so a slot freed by "b" must skip it
+    first = gevent.spawn(admission.acquire, "a", 1)
+    second = gevent.spawn(admission.acquire, "c", 2)
+    gevent.sleep(0)
+    assert len(admission.waiters) == 2
+
+    admission.release("b")
+    assert second.get(timeout=1) is True
+    assert not first.ready()
+
+    admission.release("a")
+    assert first.get(timeout=1) is True
+    assert admission.active_by_tenant == {"a": 1, "c": 1}
+
+
+def test_full_queue_rejects():
+    admission = AdmissionController(1, max_queue=0)
+    assert admission.acquire("a", 1)
+    assert not admission.acquire("b", 1)
+    assert admission.stats["rejected"] == 1
+
+
+# =============================================================================
+# EXTENSION STATE
+# =============================================================================
+
+
+def test_unknown_extension_is_registered_and_idle():
+    states = ExtensionStateTable()
+    assert states.is_registered(DOMAIN, "1000")
+    assert not states.is_busy(DOMAIN, "1000")
+    assert states.state(DOMAIN, "1000") == "idle"
+
+
+def test_leg_transitions():
+    states = ExtensionStateTable()
+    states.leg_ringing("uuid-1", DOMAIN, "1000", node="fs1")
+    assert states.state(DOMAIN, "1000") == "ringing"
+    states.leg_answered("uuid-1", DOMAIN, "1000", node="fs1")
+    assert states.state(DOMAIN, "1000") == "in_call"
+    assert states.is_busy(DOMAIN, "1000")
+    # Duplicate events do not double count
+    states.leg_ringing("uuid-1", DOMAIN, "1000", node="fs1")
+    states.leg_answered("uuid-1", DOMAIN, "1000", node="fs1")
+    states.leg_ended("uuid-1", DOMAIN, "1000", "NORMAL_CLEARING")
+    assert states.state(DOMAIN, "1000") == "idle"
+    assert states.legs == {}
+
+
+def test_failed_dial_marks_unreachable_until_sofia_says_otherwise():
+    states = ExtensionStateTable()
+    states.leg_ended("uuid-1", DOMAIN, "1000", "USER_NOT_REGISTERED", dialled=True)
+    assert states.state(DOMAIN, "1000") == "unregistered"
+    # A leg reaching the phone proves it is online again
+    states.leg_ringing("uuid-2", DOMAIN, "1000")
+    assert states.state(DOMAIN, "1000") == "ringing"
+
+    # FreeSWITCH's own registration state is never overridden by a call
+    states.set_registered(DOMAIN, "1001", True, "sofia:fs1")
+    states.mark_unreachable(DOMAIN, "1001")
+    assert states.is_registered(DOMAIN, "1001")
+
+
+def test_drop_legs_only_touches_the_given_node():
+    states = ExtensionStateTable()
+    states.leg_answered("uuid-1", DOMAIN, "1000", node="fs1")
+    states.leg_answered("uuid-2", DOMAIN, "1001", node="fs2")
+    states.leg_ringing("uuid-3", DOMAIN, "1002", node="fs1")
+    assert states.drop_legs({"uuid-3"}, node="fs1") == {(DOMAIN, "1000")}
+    assert set(states.legs) == {"uuid-2", "uuid-3"}
+    assert states.state(DOMAIN, "1000") == "idle"
+    assert states.state(DOMAIN, "1001") == "in_call"
+
+
+def test_reconcile_is_per_node():
+    states = ExtensionStateTable()
+    states.set_registered(DOMAIN, "1000", True, "sofia:fs1")
+    states.set_registered(DOMAIN, "1001", True, "sofia:fs2")
+    states.leg_ringing("uuid-1", DOMAIN, "1002")
+
+    changed = states.reconcile({(DOMAIN, "1003")}, "sofia:fs1")
+    assert changed == 2
+    assert not states.is_registered(DOMAIN, "1000")
+    assert states.is_registered(DOMAIN, "1003")
+    # Other nodes' and call-only entries are left alone
+    assert states.is_registered(DOMAIN, "1001")
+    assert states.is_registered(DOMAIN, "1002")
+    assert states.reconcile({(DOMAIN, "1003")}, "sofia:fs1") == 0
+
+
+# =============================================================================
+# SIP RESPONSES
+# =============================================================================
+
+
+def test_sip_response_parse():
+    response = SipResponse.parse(
+        b"SIP/2.0 200 OK\r\n"
+        b"Via: SIP/2.0/UDP 10.0.0.10:5080;rport=5080;branch=z9hG4bKabc\r\n"
+        b"v: SIP/2.0/UDP 10.0.0.99;branch=z9hG4bKother\r\n"
+        b"i: presence-1@10.0.0.10\r\n"
+        b"SIP-ETag: a.1700000000.1\r\n"
+        b"Expires: 3600\r\n"
+        b"Content-Length: 0\r\n\r\n"
+    )
+    assert (response.status, response.reason) == (200, "OK")
+    assert response.branch == "z9hG4bKabc"
+    assert response.call_id == "presence-1@10.0.0.10"
+    assert response.headers["sip-etag"] == "a.1700000000.1"
+    assert response.headers["expires"] == "3600"
+
+
+def test_sip_response_parse_reason_phrase_and_no_reason():
+    response = SipResponse.parse(b"SIP/2.0 412 Conditional Request Failed\r\n\r\n")
+    assert (response.status, response.reason) == (412, "Conditional Request Failed")
+    response = SipResponse.parse(b"SIP/2.0 500\r\n\r\n")
+    assert (response.status, response.reason, response.branch) == (500, "", None)
+
+
+def test_sip_response_parse_rejects_requests_and_garbage():
+    assert SipResponse.parse(b"PUBLISH sip:700@store1.local SIP/2.0\r\n\r\n") is None
+    assert SipResponse.parse(b"SIP/2.0 OK\r\n\r\n") is None
+    assert SipResponse.parse(b"\x00\x01") is None
+
+
+# =============================================================================
+# PRESENCE DISPATCHER
+# =============================================================================
+
+
+class FakeTransport:
+    """Records PUBLISHes; the test answers each one through its AsyncResult"""
+
+    local_port = 5080
+
+    def __init__(self, host, port):
+        self.sent = []
+
+    def start(self):
+        pass
+
+    def send_request(self, data, branch, call_id):
+        result = gevent.event.AsyncResult()
+        self.sent.append((data, result))
+        return result
+
+    def answer(self, status, reason="", headers=b""):
+        raw = f"SIP/2.0 {status} {reason}\r\n".encode() + headers + b"\r\n"
+        self.sent[-1][1].set(SipResponse.parse(raw))
+        gevent.sleep(0)
+
+    def time_out(self):
+        self.sent[-1][1].set_exception(TimeoutError("Timer F"))
+        gevent.sleep(0)
+
+
+@pytest.fixture
+def presence(monkeypatch):
+    monkeypatch.setattr(call_router, "SipTransport", FakeTransport)
+    monkeypatch.setattr(call_router, "PRESENCE_RETRY_BASE", 0.01)
+    monkeypatch.setattr(call_router, "PRESENCE_RETRY_MAX_DELAY", 0.02)
+    publisher = PresencePublisher("127.0.0.1", 5060)
+    return PresenceDispatcher(publisher), publisher.transport
+
+
+def retry_due(dispatcher):
+    gevent.sleep(0.05)
+    dispatcher.flush()
+
+
+def test_permanent_rejection_is_not_retried(presence):
+    dispatcher, transport = presence
+    dispatcher.submit(DOMAIN, "700", True, "+15551234567")
+    dispatcher.flush()
+    transport.answer(403, "Forbidden")
+    retry_due(dispatcher)
+    assert len(transport.sent) == 1
+    assert dispatcher.stats["abandoned"] == 1
+    # Not recorded as published, so the same state is sent when it recurs
+    dispatcher.submit(DOMAIN, "700", True, "+15551234567")
+    dispatcher.flush()
+    assert len(transport.sent) == 2
+
+
+def test_transient_failures_retry_with_a_limit(presence):
+    dispatcher, transport = presence
+    dispatcher.submit(DOMAIN, "700", True, "+15551234567")
+    dispatcher.flush()
+    transport.time_out()
+    for _ in range(call_router.PRESENCE_MAX_RETRIES):
+        retry_due(dispatcher)
+        transport.answer(503, "Service Unavailable")
+    retry_due(dispatcher)
+    assert len(transport.sent) == 1 + call_router.PRESENCE_MAX_RETRIES
+    assert dispatcher.stats["retries"] == call_router.PRESENCE_MAX_RETRIES
+    assert dispatcher.stats["abandoned"] == 1
+    assert dispatcher.failures == {}
+
+
+def test_retry_succeeds_and_resets(presence):
+    dispatcher, transport = presence
+    dispatcher.submit(DOMAIN, "700", True, "+15551234567")
+    dispatcher.flush()
+    transport.answer(500, "Server Internal Error")
+    retry_due(dispatcher)
+    assert len(transport.sent) == 2
+    transport.answer(200, "OK", b"SIP-ETag: e1\r\nExpires: 3600\r\n")
+    assert dispatcher.failures == {}
+    assert dispatcher.published[(DOMAIN, "700")] == ("park", True, "+15551234567")
+    # Deduped again now that Kamailio has it
+    dispatcher.submit(DOMAIN, "700", True, "+15551234567")
+    dispatcher.flush()
+    assert len(transport.sent) == 2
+
+
+def test_newer_state_wins_over_a_pending_retry(presence):
+    dispatcher, transport = presence
+    dispatcher.submit(DOMAIN, "700", True, "+15551234567")
+    dispatcher.flush()
+    transport.answer(503, "Service Unavailable")
+    dispatcher.submit(DOMAIN, "700", False)
+    dispatcher.flush()
+    transport.answer(200, "OK")
+    retry_due(dispatcher)
+    assert len(transport.sent) == 2
+    assert b"<state>terminated" in transport.sent[-1][0]
+
+
+def test_updates_coalesce_and_unchanged_states_are_skipped(presence):
+    dispatcher, transport = presence
+    dispatcher.submit(DOMAIN, "700", True, "+15551234567")
+    dispatcher.submit(DOMAIN, "700", False)
+    dispatcher.submit(DOMAIN, "700", True, "+15559999999")
+    dispatcher.flush()
+    assert len(transport.sent) == 1
+    assert b"+15559999999" in transport.sent[0][0]
+    transport.answer(200, "OK")
+    dispatcher.submit(DOMAIN, "700", True, "+15559999999")
+    dispatcher.flush()
+    assert len(transport.sent) == 1
+    assert dispatcher.stats["coalesced"] == 2
+    assert dispatcher.stats["unchanged"] == 1
+
+
+def test_etag_is_used_for_modify_and_refresh(presence):
+    dispatcher, transport = presence
+    publisher = dispatcher.publisher
+    dispatcher.submit(DOMAIN, "700", True, "+15551234567")
+    dispatcher.flush()
+    assert b"SIP-If-Match" not in transport.sent[-1][0]
+    transport.answer(200, "OK", b"SIP-ETag: e1\r\nExpires: 60\r\n")
+    assert publisher.etags["sip:700@store1.local"][0] == "e1"
+
+    dispatcher.submit(DOMAIN, "700", False)
+    dispatcher.flush()
+    assert b"SIP-If-Match: e1" in transport.sent[-1][0]
+    transport.answer(200, "OK", b"SIP-ETag: e2\r\nExpires: 60\r\n")
+
+    # 60s publication with a 300s margin is due for a refresh
+    dispatcher.refresh_expiring()
+    refresh = transport.sent[-1][0]
+    assert b"SIP-If-Match: e2" in refresh
+    assert b"dialog-info" not in refresh
+    assert dispatcher.stats["refreshes"] == 1
+
+
+def test_412_on_refresh_republishes_the_last_state_in_full(presence):
+    dispatcher, transport = presence
+    publisher = dispatcher.publisher
+    dispatcher.submit(DOMAIN, "700", True, "+15551234567")
+    dispatcher.flush()
+    transport.answer(200, "OK", b"SIP-ETag: e1\r\n")
+    publisher.refresh("sip:700@store1.local", DOMAIN)
+    transport.answer(412, "Conditional Request Failed")
+
+    republish = transport.sent[-1][0]
+    assert len(transport.sent) == 3
+    assert b"SIP-If-Match" not in republish
+    assert b"<state>confirmed" in republish and b"+15551234567" in republish
+    assert "sip:700@store1.local" not in publisher.etags
+    # Recovered by the publisher itself: not a failure for the dispatcher
+    assert dispatcher.failures == {}
+
+
+def test_412_on_modify_resends_the_body_without_etag(presence):
+    dispatcher, transport = presence
+    dispatcher.submit(DOMAIN, "700", True, "+15551234567")
+    dispatcher.flush()
+    transport.answer(200, "OK", b"SIP-ETag: e1\r\n")
+    dispatcher.submit(DOMAIN, "700", False)
+    dispatcher.flush()
+    transport.answer(412, "Conditional Request Failed")
+    assert len(transport.sent) == 3
+    assert b"SIP-If-Match" not in transport.sent[-1][0]
+    assert b"<state>terminated" in transport.sent[-1][0]
+
+
+# =============================================================================
+# CALL DETAIL RECORDS
+# =============================================================================
+
+
+def hangup(index):
+    return call_record(
+        {
+            "Unique-ID": f"uuid-{index}",
+            "variable_sip_h_X-Store-Domain": DOMAIN,
+            "Call-Direction": "inbound",
+            "Caller-Caller-ID-Number": "+15551234567",
+            "Caller-Destination-Number": "1000",
+            "Caller-Channel-Created-Time": "1700000000000000",
+            "Caller-Channel-Answered-Time": "1700000005000000",
+            "Caller-Channel-Hangup-Time": "1700000065000000",
+            "variable_billsec": "60",
+            "Hangup-Cause": "NORMAL_CLEARING",
+        },
+        "fs1",
+    )
+
+
+def cdr_writer(tmp_path, **kwargs):
+    writer = CdrWriter(str(tmp_path / "cdr.db"), str(tmp_path / "spool"), flush_interval=3600, **kwargs)
+    writer.start()
+    return writer
+
+
+def stored(writer):
+    return writer.db.execute("SELECT COUNT(*) FROM cdr").fetchone()[0]
+
+
+def spooled(tmp_path):
+    return sorted(os.listdir(tmp_path / "spool"))
+
+
+def test_cdrs_are_committed_and_spool_removed(tmp_path):
+    writer = cdr_writer(tmp_path)
+    for index in range(5):
+        writer.submit(hangup(index))
+    writer.flush()
+    assert stored(writer) == 5
+    row = writer.db.execute("SELECT store, billsec, answered_at FROM cdr WHERE uuid = 'uuid-0'").fetchone()
+    assert row == (DOMAIN, 60, 1700000005.0)
+    # Only the fresh, empty segment is left
+    assert len(spooled(tmp_path)) == 1
+
+
+def test_failing_database_keeps_records_on_disk_only(tmp_path):
+    writer = cdr_writer(tmp_path, backlog_alert=2)
+    commit = writer._commit
+    writer._commit = lambda records: sqlite3.OperationalError("database is locked")
+
+    writer.submit(hangup(0))
+    writer.flush()
+    writer.submit(hangup(1))
+    writer.flush()
+    assert [records for _, records in writer.backlog] == [None, None]
+    assert writer.snapshot()["backlog_alert"]
+    assert writer.stats["backlog_alerts"] == 1
+
+    writer._commit = commit
+    writer.flush()
+    assert stored(writer) == 2
+    assert writer.backlog == []
+    assert not writer.alerting
+    assert len(spooled(tmp_path)) == 1
+
+
+def test_cdrs_left_by_a_crash_are_replayed(tmp_path):
+    crashed = cdr_writer(tmp_path)
+    for index in range(3):
+        crashed.submit(hangup(index))
+    # A line cut short by the crash is skipped
+    crashed._segment.write('["uuid-trunc')
+    crashed._segment.flush()
+
+    writer = cdr_writer(tmp_path)
+    assert len(writer.backlog) == 1
+    writer.flush()
+    assert stored(writer) == 3
+    assert writer.stats["spool_reads"] == 1
+
+
+def test_records_past_max_pending_are_read_back_from_the_spool(tmp_path):
+    writer = cdr_writer(tmp_path, max_pending=2)
+    for index in range(5):
+        writer.submit(hangup(index))
+    assert len(writer.pending) == 2
+    assert writer.stats["overflowed"] == 3
+    writer.flush()
+    assert stored(writer) == 5
+    assert writer.stats["spool_reads"] == 1
+
+
+def test_replaying_a_committed_segment_is_harmless(tmp_path):
+    writer = cdr_writer(tmp_path)
+    writer.submit(hangup(0))
+    writer.flush()
+    # As if the process died after COMMIT but before deleting the segment
+    writer.submit(hangup(0))
+    writer.submit(hangup(1))
+    writer.flush()
+    assert stored(writer) == 2